@@ -1,52 +1,223 @@
+import os
 import json
+import time
+import threading
 import requests
 import logging
-import commons
+from multiprocessing.pool import ThreadPool
 
+import commons
+from logger import log
 from geo_utils import extent_from_hv
 
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 
-__HOST__ = r'http://lcmap-test.cr.usgs.gov/changes/results'
+__HOST__ = os.environ.get('LCMAP_HOST',
+                          r'http://lcmap-test.cr.usgs.gov/changes/results')
 __ALGORITHM__ = r'lcmap-pyccd:1.4.0rc1'
 
+# Concurrent requests and requests per second when queuing a whole tile
+SUBMIT_WORKERS = 8
+SUBMIT_RATE = 10
+
+_local = threading.local()
+
+
+def set_host(host):
+    """
+    Base URL of the changes results service, ie a local mock_api
+    """
+    global __HOST__
+    __HOST__ = host.rstrip('/')
+
+
+def session():
+    """
+    A requests session per thread, so connections are reused
+    """
+    if getattr(_local, 'session', None) is None:
+        _local.session = requests.Session()
+
+    return _local.session
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared between threads
+
+    :param rate: requests per second, None or 0 for no limit
+    :param burst: number of requests that can go at once
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
 
 @commons.retry(10)
-def fetch_results_pixel(x, y, refresh=False):
-    endpoint = '/'.join([__HOST__, __ALGORITHM__, str(x), str(y)]) +\
+def fetch_results_pixel(x, y, refresh=False, algorithm=__ALGORITHM__,
+                        limiter=None):
+    endpoint = '/'.join([__HOST__, algorithm, str(x), str(y)]) +\
                '?refresh={}'.format(str(refresh).lower())
 
-    resp = requests.get(endpoint)
+    if limiter is not None:
+        limiter.wait()
+
+    resp = session().get(endpoint)
+
+    # Let the retry have transient service errors
+    if resp.status_code >= 500:
+        resp.raise_for_status()
     
     return resp.json()
 
 
 @commons.retry(10)
 def fetch_results_chip(x, y, algorithm=__ALGORITHM__):
-    url = ('http://lcmap-test.cr.usgs.gov/'
-           'changes/'
-           'results/'
+    url = ('{host}/'
            '{algorithm}/'
            'chip?x={x}&y={y}'
-           .format(x=x, y=y, algorithm=algorithm))
+           .format(host=__HOST__, x=x, y=y, algorithm=algorithm))
+
+    resp = session().get(url)
 
-    resp = requests.get(url)
+    if resp.status_code >= 500:
+        resp.raise_for_status()
 
     if resp.status_code == 200:
         return resp.json()
 
 
-def queue_tile_processing(h, v, refresh=False):
+def chip_origins(h, v):
+    """
+    Upper left of every chip in the tile, row major
+    """
     ext, _ = extent_from_hv(h, v)
-    
-    resps = []
-    for y in xrange(ext.y_max, ext.y_min, -3000):
-        for x in xrange(ext.x_min, ext.x_max, 3000):
-            resps.append(fetch_results_pixel(x, y, refresh=refresh))
-            
-    return resps       
-     
+
+    return [(x, y)
+            for y in range(ext.y_max, ext.y_min, -3000)
+            for x in range(ext.x_min, ext.x_max, 3000)]
+
+
+def chip_done(resp):
+    """
+    Whether a pixel response shows its chip has finished processing
+    """
+    return bool(resp) and resp.get('result_ok') is True
+
+
+def _submit_all(chips, refresh, algorithm, workers, rate, progress, label):
+    limiter = RateLimiter(rate, burst=workers)
+    total = len(chips)
+    counts = {'finished': 0}
+    lock = threading.Lock()
+
+    def submit(chip):
+        x, y = chip
+        try:
+            resp = fetch_results_pixel(x, y, refresh=refresh,
+                                       algorithm=algorithm, limiter=limiter)
+        except Exception:
+            log.exception('Request failed for chip x: {} y: {}'.format(x, y))
+            resp = None
+
+        with lock:
+            counts['finished'] += 1
+            finished = counts['finished']
+
+        if progress is not None:
+            progress(finished, total, chip, resp)
+        elif finished % 250 == 0 or finished == total:
+            log.info('{} {} of {} chips'.format(label, finished, total))
+
+        return resp
+
+    pool = ThreadPool(processes=max(workers, 1))
+    try:
+        return pool.map(submit, chips)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def queue_tile_processing(h, v, refresh=False, algorithm=__ALGORITHM__,
+                          workers=SUBMIT_WORKERS, rate=SUBMIT_RATE,
+                          progress=None):
+    """
+    Request every chip in a tile, which queues those without results for
+    processing
+
+    :param workers: concurrent requests
+    :param rate: requests per second across all workers, None for no limit
+    :param progress: called with (finished, total, (x, y), response) as
+        each chip returns, progress is logged if None
+    :return: list of responses in chip_origins order, None where the
+        request failed
+    """
+    return _submit_all(chip_origins(h, v), refresh, algorithm, workers, rate,
+                       progress, 'Queued')
+
+
+def poll_tile(h, v, algorithm=__ALGORITHM__, interval=300, timeout=None,
+              workers=SUBMIT_WORKERS, rate=SUBMIT_RATE, chips=None):
+    """
+    Track which chips in a tile have finished, checking only the ones still
+    outstanding each round
+
+    :param interval: seconds between rounds
+    :param timeout: give up after this many seconds, None to wait for all
+    :param chips: subset of chip_origins to track
+    :return: generator of (x, y) as chips finish
+    """
+    pending = list(chips if chips is not None else chip_origins(h, v))
+    start = time.time()
+
+    while pending:
+        resps = _submit_all(pending, False, algorithm, workers, rate, None,
+                            'Checked')
+
+        still = []
+        for chip, resp in zip(pending, resps):
+            if chip_done(resp):
+                yield chip
+            else:
+                still.append(chip)
+
+        pending = still
+        log.info('{} chips outstanding for h{:02d}v{:02d}'
+                 .format(len(pending), h, v))
+
+        if not pending:
+            break
+
+        if timeout is not None and time.time() - start + interval > timeout:
+            log.info('Timed out waiting on {} chips'.format(len(pending)))
+            break
+
+        time.sleep(interval)
+
 
 def request_results(x, y):
     resp = fetch_results_pixel(x, y)
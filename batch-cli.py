@@ -0,0 +1,87 @@
+import argparse
+import batch
+import dates
+from logger import set_level
+
+
+parser = argparse.ArgumentParser(
+        description='Process several products over many tiles with one '
+                    'shared pool of worker processes. Path templates may '
+                    'use {h}, {v} and {product}, ie '
+                    '/data/h{h:02d}v{v:02d}/json')
+
+parser.add_argument('tiles', help='Tiles to process, ie "5,2 6,2" or a '
+                                  'region "h3-5v2-4".')
+parser.add_argument('output', help='Output path template.')
+parser.add_argument('-p', '--proc',
+                    help='Number of child processes to use.',
+                    default=1, type=int, metavar='')
+parser.add_argument('--products',
+                    help='Comma separated products to make, from: '
+                         '{}'.format(', '.join(batch.PRODUCTS)),
+                    default='change', metavar='')
+parser.add_argument('--json', help='Input template of JSON chips, used by '
+                                   'matlab and change.',
+                    default=None, metavar='')
+parser.add_argument('--class', dest='class_input',
+                    help='Input template of classification pickles.',
+                    default=None, metavar='')
+parser.add_argument('--stacks', help='Input template of MTLstack files, '
+                                     'used by density.',
+                    default=None, metavar='')
+parser.add_argument('-a', '--algorithm',
+                    help='Algorithm version to request when matlab has no '
+                         'JSON input.',
+                    default=None, metavar='')
+parser.add_argument('--maps',
+                    help='Comma separated change and class maps to make, '
+                         'ie ChangeMap,CoverPrim, all of them if not given.',
+                    default=None, metavar='')
+parser.add_argument('--frequency',
+                    help='Make change and class products for one date a '
+                         'year, a month or a day: annual, monthly or daily.',
+                    default='annual', choices=dates.FREQUENCIES, metavar='')
+parser.add_argument('--start-year',
+                    help='First year to make products for.',
+                    default=1984, type=int, metavar='')
+parser.add_argument('--end-year',
+                    help='Last year to make products for.',
+                    default=2015, type=int, metavar='')
+parser.add_argument('--engine',
+                    help='How dates are evaluated: sweep or reference.',
+                    default='sweep', metavar='')
+parser.add_argument('--aoi',
+                    help='Area of interest, x_min,y_min,x_max,y_max in the '
+                         'tile projection, a shapefile or WKT. Only the '
+                         'chips and pixels within it are processed.',
+                    default=None, metavar='')
+parser.add_argument('-m', '--memory',
+                    help='MB of finished results allowed to wait on the '
+                         'writer.',
+                    default=batch.MEMORY_BUDGET // 1024 ** 2, type=int,
+                    metavar='')
+parser.add_argument('--gdal-cache',
+                    help='MB of GDAL block cache for the writer.',
+                    default=None, type=int, metavar='')
+parser.add_argument('--metrics',
+                    help='Write stage metrics to this file.',
+                    default=None, metavar='')
+parser.add_argument('--log-level', default='INFO', metavar='')
+
+args = parser.parse_args()
+
+set_level(args.log_level)
+
+inputs = {'matlab': args.json,
+          'change': args.json,
+          'class': args.class_input,
+          'density': args.stacks}
+
+batch.run(batch.parse_tiles(args.tiles), args.products.split(','), args.proc,
+          inputs, args.output, alg=args.algorithm, metrics_path=args.metrics,
+          query_dates=dates.query_dates(args.frequency, args.start_year,
+                                        args.end_year),
+          engine=args.engine, aoi=args.aoi,
+          maps=args.maps.split(',') if args.maps else None,
+          memory_budget=args.memory * 1024 ** 2,
+          gdal_cache=args.gdal_cache * 1024 ** 2 if args.gdal_cache else None)
@@ -0,0 +1,452 @@
+"""
+Multi-tile batch processing
+
+Runs any combination of products over many tiles with one worker pool that
+stays warm for the whole batch, so there is no per tile start up cost. The
+tiles are worked through one after another, with the products of a tile
+interleaved, and the next tile's work is already in the pool while one
+finishes. Compute happens in the pool, all raster writes happen in the
+parent so every GeoTIFF only ever has one writer, and chips are written in
+the order the single tile pipelines write them.
+"""
+
+import os
+import re
+import multiprocessing as mp
+from collections import OrderedDict, deque
+
+import geo_utils
+import metrics
+import ledger
+import commons
+from logger import log
+
+
+PRODUCTS = ('matlab', 'change', 'class', 'density')
+
+# Products that read local input, matlab can pull its chips from the API
+NEEDS_INPUT = ('change', 'class', 'density')
+
+# Bytes of finished chips allowed to wait on the parent to write them
+MEMORY_BUDGET = 1024 ** 3
+
+# Areas of interest rasterized by this process, keyed on (h, v). Tiles are
+# worked through in turn so only the latest few are kept
+AOI_CACHE_SIZE = 2
+
+_AOIS = OrderedDict()
+
+
+def parse_tiles(spec):
+    """
+    Parse a tile specification
+
+    '5,2 6,2' -> [(5, 2), (6, 2)]
+    'h3-5v2-3' -> every tile in the h and v ranges
+
+    :param spec: string
+    :return: list of (h, v)
+    """
+    tiles = []
+
+    for part in spec.replace(';', ' ').split():
+        region = re.match(r'^h(\d+)(?:-(\d+))?v(\d+)(?:-(\d+))?$', part.lower())
+
+        if region:
+            h0, h1, v0, v1 = region.groups()
+            h1 = h1 or h0
+            v1 = v1 or v0
+
+            tiles.extend((h, v)
+                         for v in range(int(v0), int(v1) + 1)
+                         for h in range(int(h0), int(h1) + 1))
+        else:
+            h, v = part.split(',')
+            tiles.append((int(h), int(v)))
+
+    return tiles
+
+
+def tiles_in_extent(geo_extent):
+    """
+    Every CONUS tile that intersects the extent
+
+    :param geo_extent: GeoExtent
+    :return: list of (h, v)
+    """
+    conus = geo_utils.CONUS_EXTENT
+    size = 5000 * 30
+
+    h0 = max(int((geo_extent.x_min - conus.x_min) // size), 0)
+    h1 = int((geo_extent.x_max - conus.x_min - 1) // size)
+    v0 = max(int((conus.y_max - geo_extent.y_max) // size), 0)
+    v1 = int((conus.y_max - geo_extent.y_min - 1) // size)
+
+    return [(h, v)
+            for v in range(v0, v1 + 1)
+            for h in range(h0, h1 + 1)]
+
+
+def tile_path(template, h, v, product=''):
+    """
+    Fill out a path template, ie /data/h{h:02d}v{v:02d}/{product}
+    """
+    return template.format(h=h, v=v, product=product)
+
+
+def tile_aoi(h, v, aoi):
+    """
+    geo_utils.tile_aoi, made once per tile in each process
+
+    :param aoi: bounding box, shapefile or WKT, or None
+    """
+    if aoi is None:
+        return None
+
+    ret = _AOIS.pop((h, v), None)
+    if ret is None:
+        ret = geo_utils.tile_aoi(h, v, aoi)
+
+    _AOIS[(h, v)] = ret
+    while len(_AOIS) > AOI_CACHE_SIZE:
+        _AOIS.popitem(last=False)
+
+    return ret
+
+
+def _maps(product):
+    if product == 'change':
+        import change_maps
+        return change_maps
+    elif product == 'class':
+        import class_maps
+        return class_maps
+
+    return None
+
+
+def select_maps(product, maps=None):
+    """
+    :param maps: names from change_maps.MAP_NAMES and class_maps.MAP_NAMES,
+        all of them if None
+    :return: the ones for product, all of its maps if it has none there
+    """
+    names = _maps(product).MAP_NAMES
+
+    if maps is None or not set(maps) & set(names):
+        return names
+
+    return tuple(m for m in names if m in maps)
+
+
+def _matlab_tasks(h, v, input_dir, output_dir, alg, settings):
+    return [('matlab', (h, v), (output_dir, input_dir, h, v, alg, line))
+            for line in range(0, 5000, 100)]
+
+
+def _change_tasks(h, v, input_dir, output_dir, alg, settings):
+    import change_maps
+
+    files = [os.path.join(input_dir, f) for f in os.listdir(input_dir)
+             if change_maps.is_input(f)]
+    files = change_maps.aoi_files(files, h, v, tile_aoi(h, v, settings['aoi']))
+
+    return [('change', (h, v), (f, settings))
+            for f in change_maps.order_files(files, h, v)]
+
+
+def _class_tasks(h, v, input_dir, output_dir, alg, settings):
+    import class_maps
+
+    files = [os.path.join(input_dir, f) for f in os.listdir(input_dir)]
+    files = class_maps.aoi_files(files, h, v, tile_aoi(h, v, settings['aoi']))
+
+    return [('class', (h, v), (f, settings))
+            for f in class_maps.order_files(files, h, v)]
+
+
+def _density_tasks(h, v, input_dir, output_dir, alg, settings):
+    import density
+
+    queue = density.input_queue(input_dir)
+
+    return [('density', (h, v), (queue[q], settings)) for q in sorted(queue)]
+
+
+TASK_BUILDERS = {'matlab': _matlab_tasks,
+                 'change': _change_tasks,
+                 'class': _class_tasks,
+                 'density': _density_tasks}
+
+
+def execute(task):
+    """
+    Pool side, compute a single unit of work. Failures are recorded in the
+    ledger of the product's output directory.
+    """
+    product, tile, args = task
+    h, v = tile
+
+    try:
+        if product == 'matlab':
+            import json_matlab
+            json_matlab.worker(*args)
+            ret = None
+        else:
+            infile, settings = args
+            aoi = tile_aoi(h, v, settings['aoi'])
+
+            if product == 'change':
+                import change_maps
+                ret = change_maps.product_vals(infile, h, v,
+                                               settings['query_dates'],
+                                               settings['engine'], aoi,
+                                               settings['maps'])
+            elif product == 'class':
+                import class_maps
+                ret = class_maps.chip_vals(infile, h, v,
+                                           settings['query_dates'],
+                                           settings['engine'], aoi,
+                                           settings['maps'])
+            else:
+                import density
+                ret = density.worker(infile, aoi)
+    except Exception as e:
+        log.exception('Task failed: {} {} {}'.format(product, tile, args[0]))
+        metrics.incr('chip_errors')
+
+        if product == 'matlab':
+            ledger.record(ledger.ledger_path(args[0]), args[-1], e)
+        else:
+            ledger.record(args[1]['ledger'], args[0], e)
+
+        return product, tile, None, False
+
+    metrics.flush(interval=30)
+
+    return product, tile, ret, True
+
+
+def interleave(task_lists):
+    """
+    Round robin across the task lists so each of them makes progress at the
+    same time
+    """
+    task_lists = [list(t) for t in task_lists]
+    longest = max([len(t) for t in task_lists] or [0])
+
+    return [t[i] for i in range(longest) for t in task_lists if i < len(t)]
+
+
+def build_tasks(tiles, products, inputs, outputs, alg=None, query_dates=None,
+                engine='sweep', aoi=None, maps=None):
+    """
+    :param tiles: list of (h, v)
+    :param products: subset of PRODUCTS
+    :param inputs: dictionary of product -> input path template, products
+        other than matlab without one are skipped
+    :param outputs: output path template, may use {h}, {v} and {product}
+    :param alg: algorithm version, required for matlab output from the API
+    :param query_dates: ordinals to make change and class products for,
+        each module's QUERY_DATES if None
+    :param engine: one of the change_maps/class_maps ENGINES
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi
+    :param maps: change and class maps to make, see select_maps
+    :return: task list, tile by tile with the products of a tile
+        interleaved, dictionary of (product, tile) -> count
+    """
+    tasks = []
+    counts = {}
+
+    for product in products:
+        if product in NEEDS_INPUT and inputs.get(product) is None:
+            log.warning('No input template for {}, skipping it'.format(product))
+
+    products = [p for p in products
+                if p not in NEEDS_INPUT or inputs.get(p) is not None]
+
+    for h, v in tiles:
+        task_lists = []
+
+        for product in products:
+            input_dir = inputs.get(product)
+            if input_dir is not None:
+                input_dir = tile_path(input_dir, h, v, product)
+
+            output_dir = tile_path(outputs, h, v, product)
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+
+            settings = {'aoi': aoi,
+                        'engine': engine,
+                        'ledger': ledger.ledger_path(output_dir)}
+
+            if _maps(product) is not None:
+                settings['query_dates'] = tuple(query_dates or
+                                                _maps(product).QUERY_DATES)
+                settings['maps'] = select_maps(product, maps)
+
+            product_tasks = TASK_BUILDERS[product](h, v, input_dir, output_dir,
+                                                   alg, settings)
+            counts[(product, (h, v))] = len(product_tasks)
+            task_lists.append(product_tasks)
+
+        tasks.extend(interleave(task_lists))
+
+    return tasks, counts
+
+
+def _chip_nbytes(products, query_dates, maps):
+    """
+    Largest result one task hands back to the parent
+    """
+    nbytes = [5000 * 5000 if 'density' in products else 1]
+
+    for product in ('change', 'class'):
+        if product in products:
+            module = _maps(product)
+            nbytes.append(module.chip_nbytes(
+                len(query_dates or module.QUERY_DATES),
+                len(select_maps(product, maps))))
+
+    return max(nbytes)
+
+
+def run(tiles, products, cpus, inputs, outputs, alg=None, metrics_path=None,
+        query_dates=None, engine='sweep', aoi=None, maps=None,
+        memory_budget=MEMORY_BUDGET, gdal_cache=None):
+    """
+    Process every product for every tile with one shared pool
+
+    :param tiles: list of (h, v), see parse_tiles and tiles_in_extent
+    :param products: subset of PRODUCTS
+    :param cpus: number of pool processes
+    :param inputs: dictionary of product -> input path template
+    :param outputs: output path template, may use {h}, {v} and {product}
+    :param alg: algorithm version, for matlab output pulled from the API
+    :param metrics_path: see metrics.configure
+    :param query_dates: ordinals to make change and class products for
+    :param engine: one of the change_maps/class_maps ENGINES
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi.
+        Only the chips and pixels of each tile within it are processed
+    :param maps: change and class maps to make, see select_maps
+    :param memory_budget: bytes of finished results allowed to wait on the
+        parent, no more tasks are handed out once it is used
+    :param gdal_cache: bytes of GDAL block cache for the writes, the
+        change_maps default if None
+    :return: dictionary of (product, tile) -> number of failed tasks
+    """
+    import density
+    import tile_stats
+
+    metrics.configure(metrics_path)
+
+    if maps is not None:
+        import change_maps
+        import class_maps
+
+        unknown = set(maps) - set(change_maps.MAP_NAMES) - set(class_maps.MAP_NAMES)
+        if unknown:
+            raise ValueError('Unknown maps: {}'.format(', '.join(sorted(unknown))))
+
+    tasks, remaining = build_tasks(tiles, products, inputs, outputs, alg,
+                                   query_dates, engine, aoi, maps)
+    failures = dict((k, 0) for k in remaining)
+    density_accum = {}
+    datasets = {}
+    chip_stats = {}
+
+    in_flight = max(cpus, commons.queue_size(memory_budget,
+                                             _chip_nbytes(products, query_dates,
+                                                          maps)))
+
+    log.info('Queued {} tasks over {} tiles, up to {} at once'
+             .format(len(tasks), len(tiles), in_flight))
+
+    if 'change' in products or 'class' in products:
+        import change_maps
+        geo_utils.set_cache_max(gdal_cache or change_maps.GDAL_CACHE_MAX)
+
+    for key, count in remaining.items():
+        if not count:
+            log.info('Nothing to do for {} h{:02d}v{:02d}'.format(key[0], *key[1]))
+
+    pool = mp.Pool(processes=cpus)
+    tasks = iter(tasks)
+    pending = deque()
+
+    def submit():
+        task = next(tasks, None)
+        if task is not None:
+            pending.append(pool.apply_async(execute, (task,)))
+
+    try:
+        for _ in range(in_flight):
+            submit()
+
+        # Results are taken in the order the tasks were built, so each tile's
+        # chips reach its rasters row major as in the single tile pipelines
+        while pending:
+            product, tile, ret, ok = pending.popleft().get()
+            submit()
+
+            h, v = tile
+            key = (product, tile)
+            output_dir = tile_path(outputs, h, v, product)
+            tile_area = tile_aoi(h, v, aoi)
+            window = tile_area.window if tile_area is not None else None
+
+            remaining[key] -= 1
+
+            if not ok:
+                failures[key] += 1
+            elif product in ('change', 'class'):
+                maps_module = _maps(product)
+                held = datasets.setdefault(key, OrderedDict())
+                stats = chip_stats.setdefault(key, {})
+
+                if product == 'change':
+                    data, coverage = ret
+                    stats[tile_stats.chip_key(data)] = tile_stats.change_chip(data, coverage)
+                    with metrics.timer('change.output_chip'):
+                        maps_module.output_chip(data, coverage, output_dir, h, v,
+                                                held, window)
+                else:
+                    stats[tile_stats.chip_key(ret)] = tile_stats.class_chip(ret)
+                    with metrics.timer('class.output_chip'):
+                        maps_module.output_chip(ret, output_dir, h, v, held,
+                                                window)
+                metrics.incr('chips_written')
+            elif product == 'density':
+                if tile in density_accum:
+                    density_accum[tile] = density.reduce_results(density_accum[tile], ret)
+                else:
+                    density_accum[tile] = ret.astype(int)
+
+            if remaining[key] == 0:
+                if product == 'density' and tile in density_accum:
+                    density.density_map(density_accum.pop(tile), output_dir, h, v,
+                                        window=window)
+                elif product in ('change', 'class'):
+                    _maps(product).close_datasets(datasets.pop(key, {}))
+
+                    if product == 'change':
+                        tile_stats.write_change_chips(output_dir, h, v,
+                                                      chip_stats.pop(key, {}))
+                    else:
+                        tile_stats.write_class_chips(output_dir, h, v,
+                                                     chip_stats.pop(key, {}))
+
+                log.info('Finished {} for h{:02d}v{:02d}'.format(product, h, v))
+
+            metrics.dump(interval=60)
+    finally:
+        pool.close()
+        pool.join()
+
+        for key, held in datasets.items():
+            _maps(key[0]).close_datasets(held)
+
+    metrics.finish()
+
+    return failures
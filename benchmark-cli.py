@@ -0,0 +1,94 @@
+import sys
+import argparse
+import benchmark as bm
+
+
+parser = argparse.ArgumentParser(
+        description='Time each processing stage against a synthetic '
+                    'workload. Optionally save the results as a baseline, '
+                    'or compare them against a previously saved one.')
+
+parser.add_argument('-c', '--chips', help='Number of chips to generate.',
+                    default=2, type=int, metavar='')
+parser.add_argument('--pixels', help='Pixels with results per chip.',
+                    default=10000, type=int, metavar='')
+parser.add_argument('--segments', help='Mean number of segments per pixel.',
+                    default=3, type=float, metavar='')
+parser.add_argument('--break-freq', help='Probability a segment ends in a '
+                                         'confirmed break.',
+                    default=0.5, type=float, metavar='')
+parser.add_argument('--class-probs', help='Comma separated relative '
+                                          'frequency of each class.',
+                    default=None, metavar='')
+parser.add_argument('--stages', help='Comma separated stages to run.',
+                    default=','.join(bm.STAGES), metavar='')
+parser.add_argument('--seed', default=0, type=int, metavar='')
+parser.add_argument('--save', help='Save the results to this baseline file.',
+                    default=None, metavar='')
+parser.add_argument('--compare', help='Baseline file to compare against.',
+                    default=None, metavar='')
+parser.add_argument('--tolerance', help='Allowed fractional slowdown.',
+                    default=0.1, type=float, metavar='')
+parser.add_argument('--write-chips',
+                    help='Instead of the stages, time the change writer over '
+                         'this many chip positions, 2500 for a whole tile, '
+                         'in shuffled and in row major order. Needs GDAL.',
+                    default=None, type=int, metavar='')
+parser.add_argument('--write-orders', help='Comma separated write orders to '
+                                           'time.',
+                    default=','.join(bm.WRITE_ORDERS), metavar='')
+parser.add_argument('--gdal-cache', help='GDAL cache in MB for the row major '
+                                         'writes, the writer default if unset.',
+                    default=None, type=int, metavar='')
+
+args = parser.parse_args()
+
+if args.write_chips:
+    gdal_cache = args.gdal_cache * 1024 ** 2 if args.gdal_cache else None
+    orders = tuple(o for o in args.write_orders.split(',') if o)
+
+    throughput = bm.write_throughput(chips=args.write_chips, seed=args.seed,
+                                     gdal_cache=gdal_cache, orders=orders,
+                                     pixels=args.pixels,
+                                     segments=args.segments,
+                                     break_freq=args.break_freq)
+
+    if 'skipped' in throughput:
+        print('write throughput skipped: {}'.format(throughput['skipped']))
+    else:
+        for order in orders:
+            print('{:<20}{:>10.2f} chips/sec {:>10.2f} MB/sec'
+                  .format(order, throughput[order]['chips_per_sec'],
+                          throughput[order]['mb_per_sec']))
+
+    if args.save:
+        bm.save_baseline({'write_throughput': throughput}, args.save)
+
+    sys.exit(0)
+
+class_probs = None
+if args.class_probs:
+    class_probs = [float(p) for p in args.class_probs.split(',')]
+
+results = bm.run(chips=args.chips, stages=args.stages.split(','),
+                 seed=args.seed, pixels=args.pixels, segments=args.segments,
+                 break_freq=args.break_freq, class_probs=class_probs)
+
+for stage in args.stages.split(','):
+    res = results['stages'][stage]
+
+    if 'chips_per_sec' in res:
+        print('{:<20}{:>10.2f} chips/sec {:>10d} KB peak RSS'
+              .format(stage, res['chips_per_sec'], res['peak_rss_kb']))
+    else:
+        print('{:<20}{}'.format(stage, res.get('skipped', res.get('error'))))
+
+if args.save:
+    bm.save_baseline(results, args.save)
+
+if args.compare:
+    for stage, base, cur, ratio, regressed in bm.compare(results,
+                                                         bm.load_baseline(args.compare),
+                                                         args.tolerance):
+        print('{:<20}{:>10.2f} -> {:>10.2f} ({:.2f}x){}'
+              .format(stage, base, cur, ratio, ' REGRESSION' if regressed else ''))
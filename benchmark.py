@@ -0,0 +1,533 @@
+"""
+Synthetic workloads and stage timings
+
+Generates chips shaped like real LCMAP output, in the JSON layout read by
+json_matlab and change_maps and the pickle layout read by class_maps, then
+times each processing stage against them.
+"""
+
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import resource
+import multiprocessing as mp
+import datetime as dt
+from collections import OrderedDict
+from timeit import default_timer
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+import numpy as np
+
+from logger import log
+
+
+BAND_NAMES = ('blue',
+              'green',
+              'red',
+              'nir',
+              'swir1',
+              'swir2',
+              'thermal')
+
+CLASS_VALS = (1, 2, 3, 4, 5, 6, 7, 8)
+
+FIRST_DAY = dt.date(year=1984, month=1, day=1).toordinal()
+LAST_DAY = dt.date(year=2015, month=12, day=31).toordinal()
+
+# Seconds between checks that a stage's child process is still alive
+POLL_INTERVAL = 1
+
+STAGES = ('parse', 'result_to_records', 'changemap_vals',
+          'changemap_vals_monthly', 'classmap_vals', 'output_chip',
+          'output_chip_ordered', 'save_record', 'fetch')
+
+
+def chip_origins(h, v, count):
+    """
+    Upper left coordinates of the first count chips in a tile, row major
+    """
+    import geo_utils
+
+    ext, _ = geo_utils.extent_from_hv(h, v)
+
+    origins = [(x, y)
+               for y in range(ext.y_max, ext.y_min, -3000)
+               for x in range(ext.x_min, ext.x_max, 3000)]
+
+    return origins[:count]
+
+
+def segment_bounds(rng, segments, break_freq, first_day=FIRST_DAY,
+                   last_day=LAST_DAY):
+    """
+    Split the time range into non-overlapping segments
+
+    :return: list of (start_day, end_day, break_day, change_probability)
+    """
+    count = max(1, rng.poisson(segments))
+    # Keep cuts apart so every segment has a positive length
+    cuts = np.sort(rng.choice(np.arange(first_day + 365, last_day - 365, 60),
+                              size=count - 1, replace=False))
+
+    starts = [first_day] + [int(c) + 30 for c in cuts]
+    ends = [int(c) for c in cuts] + [last_day]
+
+    bounds = []
+    for idx, (start, end) in enumerate(zip(starts, ends)):
+        last = idx == len(starts) - 1
+
+        if not last and rng.random_sample() < break_freq:
+            bounds.append((start, end, end + 1, 1.0))
+        elif not last:
+            bounds.append((start, end, end + 1, float(rng.random_sample() * 0.9)))
+        else:
+            bounds.append((start, end, 0, 0.0))
+
+    return bounds
+
+
+def synthetic_model(rng, start_day, end_day, break_day, change_prob, n_coef=6):
+    model = {'start_day': start_day,
+             'end_day': end_day,
+             'break_day': break_day,
+             'change_probability': change_prob,
+             'observation_count': int(rng.randint(12, 800)),
+             'curve_qa': int(rng.choice((4, 6, 8, 14)))}
+
+    for b in BAND_NAMES:
+        model[b] = {'magnitude': float(rng.normal(0, 200)),
+                    'rmse': float(rng.uniform(50, 300)),
+                    'intercept': float(rng.uniform(-5000, 5000)),
+                    'coefficients': [float(c) for c in rng.normal(0, 1, n_coef)]}
+
+    return model
+
+
+def synthetic_chip(chip_x, chip_y, pixels=10000, segments=3, break_freq=0.5,
+                   n_obs=1000, seed=0):
+    """
+    Results chip in the layout returned by the LCMAP changes API
+
+    :param chip_x: upper left x of the chip
+    :param chip_y: upper left y of the chip
+    :param pixels: number of pixels with results, out of 10000
+    :param segments: mean number of segments per pixel
+    :param break_freq: probability a segment ends with a confirmed break
+    :param n_obs: length of the processing mask
+    :param seed:
+    :return: list of result dictionaries
+    """
+    rng = np.random.RandomState(seed)
+
+    chip = []
+    for idx in range(pixels):
+        row, col = divmod(idx, 100)
+
+        models = [synthetic_model(rng, *bounds)
+                  for bounds in segment_bounds(rng, segments, break_freq)]
+
+        result = {'change_models': models,
+                  'processing_mask': [bool(b) for b in rng.random_sample(n_obs) < 0.8]}
+
+        chip.append({'x': chip_x + col * 30,
+                     'y': chip_y - row * 30,
+                     'chip_x': chip_x,
+                     'chip_y': chip_y,
+                     'algorithm': 'lcmap-pyccd:synthetic',
+                     'result_ok': True,
+                     'result': json.dumps(result)})
+
+    return chip
+
+
+def synthetic_classchip(pixels=10000, segments=3, class_probs=None, seed=0):
+    """
+    Classification chip in the layout read by class_maps.classmap_vals
+
+    :param pixels: number of pixels, out of 10000
+    :param segments: mean number of segments per pixel
+    :param class_probs: relative frequency of each of CLASS_VALS being the
+        dominant class, uniform if None
+    :param seed:
+    :return: list, per pixel, of model dictionaries
+    """
+    rng = np.random.RandomState(seed)
+
+    if class_probs is None:
+        class_probs = np.ones(len(CLASS_VALS))
+    class_probs = np.asarray(class_probs, dtype=np.float64)
+    class_probs /= class_probs.sum()
+
+    chip = []
+    for _ in range(pixels):
+        models = []
+
+        for start, end, _, _ in segment_bounds(rng, segments, 1):
+            dominant = rng.choice(len(CLASS_VALS), p=class_probs)
+            alpha = np.ones(len(CLASS_VALS))
+            alpha[dominant] = 10
+
+            models.append({'start_day': start,
+                           'end_day': end,
+                           'class_vals': list(CLASS_VALS),
+                           'class_probs': rng.dirichlet(alpha).reshape(1, -1)})
+
+        chip.append(models)
+
+    return chip
+
+
+def write_synthetic_tile(output_dir, h, v, chips=1, seed=0, **kwargs):
+    """
+    Write synthetic JSON and class pickle chips using the file naming
+    conventions the pipelines expect
+
+    :return: list of JSON paths, list of class pickle paths
+    """
+    json_dir = os.path.join(output_dir, 'json')
+    class_dir = os.path.join(output_dir, 'class')
+
+    for d in (json_dir, class_dir):
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    class_kwargs = dict((k, v) for k, v in kwargs.items()
+                        if k in ('pixels', 'segments', 'class_probs'))
+    chip_kwargs = dict((k, v) for k, v in kwargs.items()
+                       if k != 'class_probs')
+
+    json_files = []
+    class_files = []
+    for idx, (x, y) in enumerate(chip_origins(h, v, chips)):
+        json_file = os.path.join(json_dir,
+                                 'H{:02d}V{:02d}_{}_{}.json'.format(h, v, x, y))
+        with open(json_file, 'w') as f:
+            json.dump(synthetic_chip(x, y, seed=seed + idx, **chip_kwargs), f)
+        json_files.append(json_file)
+
+        class_file = os.path.join(class_dir,
+                                  'H{:02d}V{:02d}_{}_{}'.format(h, v, x, y))
+        with open(class_file, 'wb') as f:
+            pickle.dump(synthetic_classchip(seed=seed + idx, **class_kwargs), f)
+        class_files.append(class_file)
+
+    return json_files, class_files
+
+
+def _stage_parse(json_files, class_files, h, v, scratch):
+    import change_maps
+
+    for f in json_files:
+        change_maps.load_jsondata(change_maps.get_json(f))
+
+
+def _stage_result_to_records(json_files, class_files, h, v, scratch):
+    import geo_utils
+    import change_maps
+    import json_matlab
+
+    ext, _ = geo_utils.extent_from_hv(h, v)
+
+    for f in json_files:
+        json_matlab.chip_to_records(change_maps.get_json(f), ext.x_min, ext.y_max)
+
+
+def _stage_changemap_vals(json_files, class_files, h, v, scratch):
+    import change_maps
+
+    for f in json_files:
+        change_maps.changemap_vals(f)
+
+
+def _stage_changemap_vals_monthly(json_files, class_files, h, v, scratch):
+    import dates
+    import change_maps
+
+    query_dates = dates.query_dates('monthly')
+
+    for f in json_files:
+        change_maps.changemap_vals(f, query_dates)
+
+
+def _stage_classmap_vals(json_files, class_files, h, v, scratch):
+    import class_maps
+
+    for f in class_files:
+        class_maps.classmap_vals(f)
+
+
+def _stage_output_chip(json_files, class_files, h, v, scratch):
+    import change_maps
+
+    chips = [change_maps.changemap_vals(f) for f in json_files]
+
+    start = default_timer()
+    for data, coverage in chips:
+        change_maps.output_chip(data, coverage, scratch, h, v)
+
+    return default_timer() - start
+
+
+def _stage_output_chip_ordered(json_files, class_files, h, v, scratch):
+    """
+    As output_chip, with the chips in row major order, the rasters held open
+    and the writer's GDAL cache set, as multi_output does
+    """
+    import geo_utils
+    import change_maps
+
+    chips = [change_maps.changemap_vals(f)
+             for f in change_maps.order_files(json_files, h, v)]
+
+    start = default_timer()
+    geo_utils.set_cache_max(change_maps.GDAL_CACHE_MAX)
+    datasets = OrderedDict()
+    for data, coverage in chips:
+        change_maps.output_chip(data, coverage, scratch, h, v, datasets)
+    change_maps.close_datasets(datasets)
+
+    return default_timer() - start
+
+
+def _stage_save_record(json_files, class_files, h, v, scratch):
+    import numpy as np
+    import geo_utils
+    import change_maps
+    import json_matlab
+
+    ext, _ = geo_utils.extent_from_hv(h, v)
+    records = json_matlab.compress_record_chips(
+        [json_matlab.chip_to_records(change_maps.get_json(f),
+                                     ext.x_min, ext.y_max)
+         for f in json_files])
+
+    start = default_timer()
+    for row in records:
+        json_matlab.save_record(os.path.join(scratch, 'record_change{}.mat'.format(row)),
+                                np.concatenate(records[row]))
+
+    return default_timer() - start
+
+
+def _stage_fetch(json_files, class_files, h, v, scratch):
+    """
+    The synthetic chips served through a local mock_api
+    """
+    import api
+    import mock_api
+    import json_matlab
+
+    config = mock_api.MockConfig(record_dir=os.path.dirname(json_files[0]))
+    server, base = mock_api.start(config)
+    api.set_host(base)
+
+    try:
+        for f in json_files:
+            x, y = os.path.basename(f)[:-5].split('_')[1:]
+            json_matlab.get_data(None, h, v, int(x), int(y), 'synthetic')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _run_stage(stage, json_files, class_files, h, v, queue):
+    """
+    Runs in a child process so peak RSS is isolated to the stage
+    """
+    scratch = tempfile.mkdtemp(prefix='bench_{}_'.format(stage))
+
+    try:
+        func = globals()['_stage_{}'.format(stage)]
+
+        start = default_timer()
+        timed = func(json_files, class_files, h, v, scratch)
+        elapsed = default_timer() - start if timed is None else timed
+
+        queue.put({'seconds': elapsed,
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    except ImportError as e:
+        queue.put({'skipped': str(e)})
+    except Exception as e:
+        log.exception('Stage failed: {}'.format(stage))
+        queue.put({'error': repr(e)})
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _stage_result(proc, queue):
+    """
+    Wait on a stage's result, a child that dies without reporting one, ie
+    crashed or was killed by the OOM killer, is reported as an error
+    """
+    while True:
+        try:
+            return queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            if proc.is_alive():
+                continue
+
+        # It may have put its result just before exiting
+        try:
+            return queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            return {'error': 'Stage process exited with code {} before '
+                             'reporting'.format(proc.exitcode)}
+
+
+def run(chips=2, h=5, v=2, stages=STAGES, seed=0, work_dir=None, **kwargs):
+    """
+    Generate a synthetic workload and time each stage against it
+
+    :param chips: number of chips to generate
+    :param stages: subset of STAGES to run
+    :param work_dir: where to write the synthetic chips, a temporary
+        directory is used and removed if None
+    :param kwargs: passed to synthetic_chip/synthetic_classchip
+    :return: dictionary keyed on stage
+    """
+    cleanup = work_dir is None
+    if cleanup:
+        work_dir = tempfile.mkdtemp(prefix='bench_')
+
+    try:
+        json_files, class_files = write_synthetic_tile(work_dir, h, v, chips,
+                                                       seed=seed, **kwargs)
+
+        results = {}
+        for stage in stages:
+            queue = mp.Queue()
+            proc = mp.Process(target=_run_stage,
+                              args=(stage, json_files, class_files, h, v, queue),
+                              name='Bench-{}'.format(stage))
+            proc.start()
+            res = _stage_result(proc, queue)
+            proc.join()
+
+            if 'seconds' in res:
+                res['chips_per_sec'] = (chips / res['seconds']
+                                        if res['seconds'] else 0)
+
+            log.debug('{}: {}'.format(stage, res))
+            results[stage] = res
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'params': dict(chips=chips, seed=seed, **kwargs),
+            'stages': results}
+
+
+WRITE_ORDERS = ('unordered', 'row_major')
+
+
+def write_throughput(chips=2500, h=5, v=2, seed=0, work_dir=None,
+                     gdal_cache=None, orders=WRITE_ORDERS, **kwargs):
+    """
+    Time the change writer over many chip positions, in shuffled order
+    opening and closing the rasters for every chip, and in row major order
+    with the rasters held open and the GDAL cache set, as multi_output
+    does. One synthetic chip's values are written at every position, so
+    only the writes are timed. Needs GDAL, and the disk space of the full
+    products for both orders in turn.
+
+    :param chips: chip positions to write, 2500 is the whole tile
+    :param work_dir: scratch space, a temporary directory if None
+    :param gdal_cache: GDAL cache bytes for row major order, the writer's
+        GDAL_CACHE_MAX if None
+    :param orders: which of WRITE_ORDERS to time
+    :param kwargs: passed to synthetic_chip
+    :return: dictionary of order -> seconds, chips/sec and MB/sec written,
+        or {'skipped': reason} without GDAL
+    """
+    try:
+        import geo_utils
+        import change_maps
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    cleanup = work_dir is None
+    if cleanup:
+        work_dir = tempfile.mkdtemp(prefix='bench_write_')
+
+    try:
+        json_files, _ = write_synthetic_tile(work_dir, h, v, 1, seed=seed,
+                                             **kwargs)
+        data, coverage = change_maps.changemap_vals(json_files[0])
+
+        positions = chip_origins(h, v, chips)
+        shuffled = list(positions)
+        np.random.RandomState(seed).shuffle(shuffled)
+
+        results = {}
+        for order in orders:
+            scratch = os.path.join(work_dir, order)
+            os.makedirs(scratch)
+
+            start = default_timer()
+            if order == 'unordered':
+                for x, y in shuffled:
+                    data['chip_x'], data['chip_y'] = x, y
+                    change_maps.output_chip(data, coverage, scratch, h, v)
+            else:
+                geo_utils.set_cache_max(gdal_cache or
+                                        change_maps.GDAL_CACHE_MAX)
+                datasets = OrderedDict()
+                for x, y in positions:
+                    data['chip_x'], data['chip_y'] = x, y
+                    change_maps.output_chip(data, coverage, scratch, h, v,
+                                            datasets)
+                change_maps.close_datasets(datasets)
+            elapsed = default_timer() - start
+
+            written = sum(os.path.getsize(os.path.join(scratch, f))
+                          for f in os.listdir(scratch))
+            results[order] = {'seconds': elapsed,
+                              'chips_per_sec': len(positions) / elapsed,
+                              'mb_per_sec': written / 1024.0 ** 2 / elapsed}
+            log.debug('{}: {}'.format(order, results[order]))
+
+            shutil.rmtree(scratch, ignore_errors=True)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def save_baseline(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare throughput against a saved baseline
+
+    :param tolerance: allowed fractional slowdown before a stage is flagged
+    :return: list of (stage, baseline chips/sec, current chips/sec, ratio,
+        regressed)
+    """
+    report = []
+
+    for stage, res in sorted(results['stages'].items()):
+        base = baseline['stages'].get(stage, {})
+
+        if 'chips_per_sec' not in res or not base.get('chips_per_sec'):
+            continue
+
+        ratio = res['chips_per_sec'] / base['chips_per_sec']
+        report.append((stage, base['chips_per_sec'], res['chips_per_sec'],
+                       ratio, ratio < 1 - tolerance))
+
+    return report
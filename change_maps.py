@@ -4,14 +4,22 @@ Change Maps for CCDC visualizations
 
 import os
 import multiprocessing as mp
+from collections import OrderedDict
 import datetime as dt
 import json
+from timeit import default_timer
 
 from osgeo import gdal
 import numpy as np
 
 import geo_utils
+import dates
+import commons
+import metrics
+import ledger
+import tile_stats
 import change_products as cp
+import json_matlab
 from logger import log
 
 
@@ -33,8 +41,32 @@ YEARS = tuple(i for i in range(1984, 2016))
 QUERY_DATES = tuple(dt.date(year=i, month=7, day=1).toordinal()
                     for i in YEARS)
 
+# Functions behind each of MAP_NAMES
+PRODUCT_FUNCS = dict(zip(MAP_NAMES, (cp.changedate_val, cp.changemag_val,
+                                     cp.qa_val, cp.seglength_val,
+                                     cp.lastchange_val)))
 
-def map_template():
+# 'sweep' evaluates all the dates for a pixel in one pass over its models,
+# 'reference' asks the change_products functions for every date
+ENGINES = ('sweep', 'reference')
+
+# Bytes of finished chips allowed to queue up waiting on the writer
+MEMORY_BUDGET = 1024 ** 3
+
+# GDAL block cache for the writer. A row of chips across every annual
+# output raster is about 170MB, with less blocks are flushed and re-read
+# (benchmark-cli.py --write-chips 2500 --gdal-cache: 128MB 1.6, 256MB 26,
+# 512MB 42-49, 1024MB 36 chips/sec, the larger cache crowding the page cache)
+GDAL_CACHE_MAX = 512 * 1024 ** 2
+
+# Rasters the writer holds open at once, every annual product fits. With
+# monthly or daily dates a row of chips spans more rasters than this, or
+# than GDAL_CACHE_MAX holds, so blocks are flushed and re-read as the row
+# is written, see check_writer
+MAX_OPEN_DATASETS = 256
+
+
+def map_template(shape=(100, 100), labels=YEARS, products=MAP_NAMES):
     """
     Return a new dictionary to store annual change map values
 
@@ -44,21 +76,24 @@ def map_template():
                       }
      'next product': {years:
                      }
+
+    :param labels: keys for each date, see dates.date_labels
+    :param products: subset of MAP_NAMES
     """
     ret = {}
 
-    for m in MAP_NAMES:
-        ret[m] = {}
-        for yr in YEARS:
-            ret[m][yr] = np.zeros(shape=(100, 100))
+    for m in products:
+        # One block per product, each date's array is a view into it
+        stack = np.zeros(shape=(len(labels),) + tuple(shape))
+        ret[m] = dict(zip(labels, stack))
 
     return ret
 
 
 def get_json(path):
     if os.path.exists(path):
-        with open(path, 'r') as f:
-            return json.load(f)
+        metrics.incr('bytes_read', os.path.getsize(path))
+        return commons.read_json(path)
     else:
         return None
 
@@ -66,12 +101,17 @@ def get_json(path):
 def load_jsondata(data):
     outdata = np.full(fill_value=None, shape=(100, 100), dtype=object)
 
-    if data is not None:
-        for d in data:
-            # Could leverage geo_utils to do this
-            col = int((d['x'] - d['chip_x']) / 30)
-            row = int((d['chip_y'] - d['y']) / 30)
+    if data:
+        chip_x = data[0]['chip_x']
+        chip_y = data[0]['chip_y']
+        affine = geo_utils.GeoAffine(ul_x=chip_x, x_res=30, rot_1=0,
+                                     ul_y=chip_y, rot_2=0, y_res=-30)
 
+        rows, cols = geo_utils.geo_to_rowcol_array(affine,
+                                                   [d['x'] for d in data],
+                                                   [d['y'] for d in data])
+
+        for d, row, col in zip(data, rows.tolist(), cols.tolist()):
             if d.get('result_ok') is True:
                 result = d.get('result', 'null')
                 outdata[row][col] = json.loads(result)
@@ -90,113 +130,376 @@ def determine_coverage(data):
 
 
 def coords_frompath(file_path):
-    parts = os.path.split(file_path)[-1].split('_')
+    parts = commons.strip_compression_ext(os.path.split(file_path)[-1]).split('_')
     return parts[1], parts[2][:-5]
 
 
-def changemap_vals(input, query_dates=QUERY_DATES):
+def select_products(products=None):
+    """
+    :param products: names from MAP_NAMES, all of them if None
+    :return: tuple of the names in MAP_NAMES order
+    """
+    if products is None:
+        return MAP_NAMES
+
+    unknown = set(products) - set(MAP_NAMES)
+    if unknown:
+        raise ValueError('Unknown products: {}'.format(', '.join(sorted(unknown))))
+
+    return tuple(m for m in MAP_NAMES if m in products)
+
+
+def pixel_models(result):
+    return [cp.ChangeModel(r['start_day'], r['end_day'], r['break_day'],
+                           r['curve_qa'], [r[b]['magnitude'] for b in BAND_NAMES], r['change_probability'])
+            for r in result['change_models']]
+
+
+def changemap_vals(input, query_dates=QUERY_DATES, engine='sweep', mask=None,
+                   products=MAP_NAMES):
+    """
+    :param query_dates: ordinals to make the products for, see
+        dates.query_dates
+    :param engine: one of ENGINES
+    :param mask: bool array shape=(100, 100) of the pixels to compute, the
+        rest are left out of the products and the coverage
+    :param products: subset of MAP_NAMES to compute, coverage is always
+        included
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine: {}'.format(engine))
+
+    products = select_products(products)
+
     data = load_jsondata(get_json(input)).flatten()
     chip_x, chip_y = coords_frompath(input)
 
-    temp = map_template()
+    coverage = determine_coverage(data)
+
+    if mask is not None:
+        coverage[~mask] = 0
+
+    # Nothing to compute or write other than the coverage
+    if not coverage.any():
+        metrics.incr('chips_empty')
+        return {'chip_x': int(chip_x), 'chip_y': int(chip_y)}, coverage
+
+    labels = dates.date_labels(query_dates)
+
+    if engine == 'sweep':
+        names = tuple(cp.PRODUCTS[MAP_NAMES.index(m)] for m in products)
+
+        # product, date, row, col
+        stack = np.zeros(shape=(len(products), len(labels), 100, 100))
+
+        for pix in np.flatnonzero(coverage):
+            result = data[pix]
+
+            if result:
+                row, col = divmod(pix, 100)
+                stack[:, :, row, col] = cp.sweep(pixel_models(result),
+                                                 query_dates, products=names)
+
+        temp = dict((m, dict(zip(labels, prod)))
+                    for m, prod in zip(products, stack))
+        temp['chip_x'] = int(chip_x)
+        temp['chip_y'] = int(chip_y)
+
+        return temp, coverage
+
+    temp = map_template(labels=labels, products=products)
     temp['chip_x'] = int(chip_x)
     temp['chip_y'] = int(chip_y)
 
-    coverage = determine_coverage(data)
+    for pix in np.flatnonzero(coverage):
+        result = data[pix]
+        row, col = divmod(pix, 100)
 
-    row = 0
-    col = 0
-    for result in data:
         if result:
-            models = [cp.ChangeModel(r['start_day'], r['end_day'], r['break_day'],
-                                     r['curve_qa'], [r[b]['magnitude'] for b in BAND_NAMES], r['change_probability'])
-                      for r in result['change_models']]
+            models = pixel_models(result)
+
+            for prod in products:
+                func = PRODUCT_FUNCS[prod]
+
+                for label, qd in zip(labels, query_dates):
+                    temp[prod][label][row, col] = func(models, qd)
+
+    return temp, coverage
+
+
+def is_matfile(file_path):
+    name = os.path.split(file_path)[-1]
+    return name.startswith('record_change') and name.endswith('.mat')
+
+
+def load_matdata(file_path):
+    """
+    Read a record_change{row}.mat file from json_matlab into segment arrays
+
+    :return: cp.Segments with pix relative to the first row in the file,
+        first row (0 based), number of rows
+    """
+    record = json_matlab.load_record(file_path)
+
+    pos = record['pos'].astype(np.int64) - 1
+    rows = pos // 5000
+    first_row = matfile_row(file_path)
+    nrows = int(rows.max()) - first_row + 1 if len(rows) else 1
+
+    if len(rows) and rows.min() < first_row:
+        raise ValueError('{} has pixels above its row {}'
+                         .format(file_path, first_row + 1))
+
+    to_py = json_matlab.matordinal_to_pyordinal
 
-            changedates = [cp.changedate_val(models, qd)
-                           for qd in query_dates]
+    segs = cp.Segments(pix=pos - first_row * 5000,
+                       start_day=to_py(record['t_start'].astype(np.int64)),
+                       end_day=to_py(record['t_end'].astype(np.int64)),
+                       break_day=to_py(record['t_break'].astype(np.int64)),
+                       qa=record['category'],
+                       magnitudes=record['magnitude'].astype(np.float64),
+                       change_prob=record['change_prob'])
 
-            changemag = [cp.changemag_val(models, qd)
-                         for qd in query_dates]
+    return segs, first_row, nrows
 
-            qa = [cp.qa_val(models, qd)
-                  for qd in query_dates]
 
-            seglength = [cp.seglength_val(models, qd)
-                         for qd in query_dates]
+def matmap_vals(input, h, v, query_dates=QUERY_DATES, aoi=None,
+                products=MAP_NAMES):
+    """
+    Change map values for a row file made by json_matlab, computed for every
+    pixel in the row and every date at once with cp.sweep_arr
+
+    :param aoi: geo_utils.AOI, only its pixels are computed and the values
+        are cropped to its window
+    :param products: subset of MAP_NAMES to compute
+    """
+    products = select_products(products)
+    segs, first_row, nrows = load_matdata(input)
+    ext, _ = geo_utils.extent_from_hv(h, v)
+    npix = nrows * 5000
+
+    if aoi is not None:
+        rows, cols = np.divmod(segs.pix, 5000)
+        keep = geo_utils.aoi_pixels(aoi, rows + first_row, cols)
+        segs = cp.Segments(*[field[keep] for field in segs])
+
+    covered = np.zeros(npix, dtype=bool)
+    covered[segs.pix] = True
+    coverage = covered.reshape(nrows, 5000).astype(np.uint8)
+
+    if not len(segs.pix):
+        metrics.incr('chips_empty')
+        temp = {'chip_x': ext.x_min, 'chip_y': ext.y_max - first_row * 30}
 
-            lastchange = [cp.lastchange_val(models, qd)
-                          for qd in query_dates]
+        if aoi is not None:
+            return crop_rows(temp, coverage, first_row, aoi.window)
 
-            for idx, qdate in enumerate(query_dates):
-                year = dt.date.fromordinal(qdate).year
+        return temp, coverage
 
-                temp['ChangeMap'][year][row, col] = changedates[idx]
-                temp['ChangeMagMap'][year][row, col] = changemag[idx]
-                temp['QAMap'][year][row, col] = qa[idx]
-                temp['SegLength'][year][row, col] = seglength[idx]
-                temp['LastChange'][year][row, col] = lastchange[idx]
+    labels = dates.date_labels(query_dates)
+    names = tuple(cp.PRODUCTS[MAP_NAMES.index(m)] for m in products)
+    stacks = cp.sweep_arr(segs, npix, query_dates, covered, products=names)
 
-        col += 1
+    # Each date's values are a view into the product's stack, as in
+    # map_template
+    temp = dict((prod, dict(zip(labels, stack.reshape(-1, nrows, 5000))))
+                for prod, stack in zip(products, stacks))
+    temp['chip_x'] = ext.x_min
+    temp['chip_y'] = ext.y_max - first_row * 30
 
-        if col > 99:
-            row += 1
-            col = 0
+    if aoi is not None:
+        return crop_rows(temp, coverage, first_row, aoi.window)
 
     return temp, coverage
 
 
-def xyoff(h, v, chip_x, chip_y):
+def crop_rows(data, coverage, first_row, window):
+    """
+    Cut full width row values from matmap_vals down to the part within a
+    window, chip_x and chip_y are moved to match
+    """
+    nrows = coverage.shape[0]
+    start = min(max(window.start_row - first_row, 0), nrows)
+    end = max(min(window.end_row - first_row, nrows), start)
+    cols = slice(window.start_col, window.end_col)
+
+    ret = {'chip_x': data['chip_x'] + window.start_col * 30,
+           'chip_y': data['chip_y'] - start * 30}
+
+    for prod in MAP_NAMES:
+        if prod in data:
+            ret[prod] = dict((k, a[start:end, cols]) for k, a in data[prod].items())
+
+    return ret, coverage[start:end, cols]
+
+
+def product_vals(input, h, v, query_dates=QUERY_DATES, engine='sweep',
+                 aoi=None, products=MAP_NAMES):
+    """
+    Dispatch on the input type, JSON chips or json_matlab row files
+
+    :param aoi: geo_utils.AOI to restrict the pixels computed to
+    :param products: subset of MAP_NAMES to compute
+    """
+    if is_matfile(input):
+        return matmap_vals(input, h, v, query_dates, aoi, products)
+
+    mask = None
+    if aoi is not None:
+        chip_x, chip_y = coords_frompath(input)
+        mask = geo_utils.aoi_chip_mask(aoi, h, v, int(chip_x), int(chip_y))
+
+    return changemap_vals(input, query_dates, engine, mask, products)
+
+
+def is_input(file_name):
+    return (commons.strip_compression_ext(file_name)[-5:] == '.json' or
+            is_matfile(file_name))
+
+
+def matfile_row(file_path):
+    """
+    First tile row, 0 based, of a record_change{row}.mat file
+    """
+    return int(os.path.split(file_path)[-1][13:-4]) - 1
+
+
+def aoi_files(files, h, v, aoi):
+    """
+    Only the inputs with pixels in the area of interest
+
+    :param aoi: geo_utils.AOI, every file is kept if None
+    """
+    if aoi is None:
+        return list(files)
+
+    chips = geo_utils.aoi_chips(h, v, aoi)
+    rows = set(aoi.window.start_row + r
+               for r in np.flatnonzero(aoi.mask.any(axis=1)).tolist())
+
+    ret = []
+    for f in files:
+        if is_matfile(f):
+            keep = matfile_row(f) in rows
+        else:
+            chip_x, chip_y = coords_frompath(f)
+            keep = (int(chip_x), int(chip_y)) in chips
+
+        if keep:
+            ret.append(f)
+        else:
+            metrics.incr('chips_skipped')
+
+    return ret
+
+
+def xyoff(h, v, chip_x, chip_y, window=None):
+    """
+    :param window: offsets are within this window of the tile if given
+    """
     coord = geo_utils.GeoCoordinate(x=chip_x, y=chip_y)
     _, geo = geo_utils.extent_from_hv(h, v)
 
     rowcol = geo_utils.geo_to_rowcol(geo, coord)
+
+    if window is not None:
+        return rowcol.column - window.start_col, rowcol.row - window.start_row
+
     return rowcol.column, rowcol.row
 
 
-def output_chip(data, coverage, output_dir, h, v):
+def output_chip(data, coverage, output_dir, h, v, datasets=None, window=None):
+    """
+    :param datasets: OrderedDict the caller keeps to hold up to
+        MAX_OPEN_DATASETS rasters open between chips, see close_datasets.
+        Each raster is opened and closed for every chip if None
+    :param window: write rasters covering only this window of the tile
+    """
     chip_y = data.pop('chip_y')
     chip_x = data.pop('chip_x')
 
-    x_off, y_off = xyoff(h, v, chip_x, chip_y)
+    x_off, y_off = xyoff(h, v, chip_x, chip_y, window)
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     for prod in data:
         for year in data[prod]:
-            ds = get_raster_ds(output_dir, prod, year, h, v)
-            ds.GetRasterBand(1).WriteArray(data[prod][year], x_off, y_off)
+            write_array(data[prod][year], output_dir, prod, year, h, v,
+                        x_off, y_off, datasets, window)
+
+    write_array(coverage, output_dir, 'coverage', '', h, v, x_off, y_off,
+                datasets, window)
+
+
+def write_array(array, output_dir, product, year, h, v, x_off, y_off,
+                datasets=None, window=None):
+    if datasets is None:
+        ds = get_raster_ds(output_dir, product, year, h, v, window)
+        ds.GetRasterBand(1).WriteArray(array, x_off, y_off)
+
+        ds.FlushCache()
+        ds = None
+    else:
+        ds = geo_utils.held_dataset(datasets, (product, year),
+                                    lambda: get_raster_ds(output_dir, product,
+                                                          year, h, v, window),
+                                    MAX_OPEN_DATASETS)
+        ds.GetRasterBand(1).WriteArray(array, x_off, y_off)
+
+    metrics.incr('rasters_written')
 
-            ds.FlushCache()
-            ds = None
 
-    ds = get_raster_ds(output_dir, 'coverage', '', h, v)
-    ds.GetRasterBand(1).WriteArray(coverage, x_off, y_off)
-    ds.FlushCache()
-    ds = None
+def close_datasets(datasets):
+    for key in list(datasets):
+        datasets.pop(key).FlushCache()
 
 
-def get_raster_ds(output_dir, product, year, h, v):
+def raster_path(output_dir, product, year, h, v):
     key = '{0}_{1}'.format(product, year)
 
-    file_path = os.path.join(output_dir, key + '.tif')
+    return os.path.join(output_dir, key + '.tif')
+
+
+def get_raster_ds(output_dir, product, year, h, v, window=None):
+    """
+    Open a product raster for writing, creating it if needed
+
+    :param window: the raster covers only this window of the tile, an
+        existing one that does not is an error
+    """
+    file_path = raster_path(output_dir, product, year, h, v)
 
     if os.path.exists(file_path):
         ds = gdal.Open(file_path, gdal.GA_Update)
+
+        if ds is None:
+            raise IOError('Unable to open raster: {}'.format(file_path))
+
+        geo_utils.check_raster(ds, file_path,
+                               *geo_utils.output_geometry(h, v, window))
     else:
-        ds = create_geotif(file_path, product, h, v)
+        ds = create_geotif(file_path, product, h, v, window=window)
 
     return ds
 
 
-def create_geotif(file_path, product, h, v, rows=5000, cols=5000, proj=CONUS_WKT):
+def create_geotif(file_path, product, h, v, rows=5000, cols=5000, proj=CONUS_WKT,
+                  window=None):
+    """
+    :param window: geo_utils.RowColumnExtent, the raster covers only this
+        part of the tile
+    """
     data_type = prod_data_type(product)
-    _, geo = geo_utils.extent_from_hv(h, v)
+    rows, cols, geo = geo_utils.output_geometry(h, v, window, rows, cols)
 
     ds = (gdal
           .GetDriverByName('GTiff')
           .Create(file_path, cols, rows, 1, data_type))
 
+    if ds is None:
+        raise IOError('Unable to create raster: {}'.format(file_path))
+
     ds.SetGeoTransform(geo)
     ds.SetProjection(proj)
 
@@ -215,81 +518,321 @@ def prod_data_type(product):
         raise ValueError
 
 
-def multi_output(output_dir, output_q, kill_count, h, v):
+def check_writer(data, gdal_cache=GDAL_CACHE_MAX, window=None):
+    """
+    Warn when a row of chips spans more rasters than the writer holds open,
+    or more than the GDAL cache holds, blocks are then flushed and re-read
+    as each row is written
+
+    :param data: a chip's map dictionary
+    :return: False if the chip has no products to judge by
+    """
+    prods = [p for p in data if p not in ('chip_x', 'chip_y')]
+
+    if not prods:
+        return False
+
+    cols = 5000 if window is None else window.end_col - window.start_col
+    rasters = sum(len(data[p]) for p in prods) + 1
+    row_bytes = (sum(len(data[p]) * gdal.GetDataTypeSize(prod_data_type(p)) // 8
+                     for p in prods) + 1) * 100 * cols
+
+    if rasters > MAX_OPEN_DATASETS:
+        log.warning('Writing {} rasters, only {} are held open at once'
+                    .format(rasters, MAX_OPEN_DATASETS))
+
+    if gdal_cache and row_bytes > gdal_cache:
+        log.warning('A row of chips is {}MB across the rasters, more than the '
+                    '{}MB GDAL cache'.format(row_bytes // 1024 ** 2,
+                                             gdal_cache // 1024 ** 2))
+
+    return True
+
+
+def chip_nbytes(date_count=len(YEARS), product_count=len(MAP_NAMES)):
+    """
+    Approximate size of one finished chip waiting on the writer
+    """
+    return (product_count * date_count + 1) * 100 * 100 * 8
+
+
+def multi_output(output_dir, output_q, kill_count, h, v, metrics_interval=60,
+                 gdal_cache=GDAL_CACHE_MAX, window=None):
+    """
+    Single writer, consumes finished chips until every worker has sent kill.
+    The output rasters are held open for the whole run.
+
+    :param window: write rasters covering only this window of the tile
+
+    :return: dictionary of chips written, seconds the writer waited on an
+        empty queue, and seconds workers were blocked on a full one
+    """
+    geo_utils.set_cache_max(gdal_cache)
+    datasets = OrderedDict()
+    chip_stats = {}
+    checked = False
+
     count = 0
     progress = 0
+    waited = 0.0
+    blocked = 0.0
     while True:
         if count >= kill_count:
             break
 
+        metrics.gauge('output_queue_depth', commons.queue_depth(output_q))
+        start = default_timer()
         outdata = output_q.get()
+        waited += default_timer() - start
 
-        if outdata == 'kill':
+        if commons.is_kill(outdata):
             count += 1
+            if isinstance(outdata, tuple):
+                blocked += outdata[1]
             continue
 
         outdata, coverage = outdata
 
-        log.debug('Outputting chip: {0} {1}'.format(outdata['chip_x'],
-                                                    outdata['chip_y']))
-        output_chip(outdata, coverage, output_dir, h, v)
+        log.debug('Outputting chip: %s %s', outdata['chip_x'], outdata['chip_y'])
+        chip_stats[tile_stats.chip_key(outdata)] = tile_stats.change_chip(outdata, coverage)
+        if not checked:
+            checked = check_writer(outdata, gdal_cache, window)
+        with metrics.timer('change.output_chip'):
+            output_chip(outdata, coverage, output_dir, h, v, datasets, window)
         progress += 1
-        log.debug('Total chips written: {}'.format(progress))
+        metrics.incr('chips_written')
+        log.debug('Total chips written: %s', progress)
+
+        metrics.dump(interval=metrics_interval)
 
+    metrics.add_time('change.writer_waiting', waited)
     log.debug('Finalizing Writes')
+    close_datasets(datasets)
+    tile_stats.write_change_chips(output_dir, h, v, chip_stats)
+    log.info('Wrote {} chips, writer waited {:.1f}s for chips, workers were '
+             'blocked {:.1f}s on the output queue'.format(progress, waited, blocked))
+
+    return {'chips': progress, 'writer_waiting': waited, 'workers_blocked': blocked}
 
 
-def multi_worker(input_q, output_q):
+def multi_worker(input_q, output_q, h, v, ledger_file=None, resolve=False,
+                 query_dates=QUERY_DATES, engine='sweep', aoi=None,
+                 products=MAP_NAMES, metrics_interval=60):
+    """
+    :param ledger_file: failures are recorded here
+    :param resolve: mark chips in the ledger as resolved once they succeed
+    :param metrics_interval: seconds between metrics snapshots, so a worker
+        that dies still leaves its progress behind
+    """
+    blocked = 0.0
     while True:
         try:
             infile = input_q.get()
 
-            log.debug('received {}'.format(infile))
+            log.debug('received %s', infile)
 
             if infile == 'kill':
-                output_q.put('kill')
+                metrics.flush()
+                output_q.put(('kill', blocked))
                 break
 
-            map_dict, coverage = changemap_vals(infile)
+            with metrics.timer('change.changemap_vals'):
+                map_dict, coverage = product_vals(infile, h, v,
+                                                  query_dates, engine, aoi,
+                                                  products)
+            metrics.incr('chips_read')
 
-            log.debug('finished {}'.format(infile))
+            log.debug('finished %s', infile)
+
+            # Blocks when the writer is behind and the memory budget is used
+            start = default_timer()
             output_q.put((map_dict, coverage))
+            elapsed = default_timer() - start
+            blocked += elapsed
+            metrics.add_time('change.workers_blocked', elapsed)
+            if resolve:
+                ledger.resolve(ledger_file, infile)
+
+            metrics.flush(interval=metrics_interval)
         except Exception as e:
             log.exception('EXCEPTION')
+            metrics.incr('chip_errors')
+            ledger.record(ledger_file, infile, e)
+            metrics.flush(interval=metrics_interval)
             continue
 
-#
-# def single_run(input_dir, output_dir, h, v):
-#     for infile in os.listdir(input_dir):
-#         log.debug('received {}'.format(infile))
-#         filename = os.path.split(infile)[-1]
-#
-#         map_dict, coverage = changemap_vals(infile)
-#         map_dict['y_off'] = int(filename[13:-4]) - 1
-#
-#         log.debug('Outputting line: {0}'.format(map_dict['y_off']))
-#         output_line(map_dict, coverage, output_dir, h, v)
 
+def single_run(input_dir, output_dir, h, v, gdal_cache=GDAL_CACHE_MAX,
+               query_dates=QUERY_DATES, engine='sweep', aoi=None,
+               products=MAP_NAMES):
+    """
+    Process every JSON chip or json_matlab row file in the current process
 
-def multi_run(input_dir, output_dir, num_procs, h, v):
-    input_q = mp.Queue()
-    output_q = mp.Queue()
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi. Only
+        the pixels within it are computed and the rasters cover its window
+    :param products: subset of MAP_NAMES to compute and write
+    """
+    products = select_products(products)
+    geo_utils.set_cache_max(gdal_cache)
+    datasets = OrderedDict()
+    chip_stats = {}
+    checked = False
+    aoi = geo_utils.tile_aoi(h, v, aoi)
+    window = aoi.window if aoi is not None else None
+
+    files = order_files(aoi_files([os.path.join(input_dir, f)
+                                   for f in os.listdir(input_dir)
+                                   if is_input(f)], h, v, aoi), h, v)
+
+    for infile in files:
+        log.debug('received %s', infile)
+
+        try:
+            map_dict, coverage = product_vals(infile, h, v, query_dates,
+                                              engine, aoi, products)
+        except Exception as e:
+            log.exception('EXCEPTION')
+            ledger.record(ledger.ledger_path(output_dir), infile, e)
+            continue
+
+        chip_stats[tile_stats.chip_key(map_dict)] = tile_stats.change_chip(map_dict, coverage)
+        if not checked:
+            checked = check_writer(map_dict, gdal_cache, window)
+        output_chip(map_dict, coverage, output_dir, h, v, datasets, window)
+
+    close_datasets(datasets)
+    tile_stats.write_change_chips(output_dir, h, v, chip_stats)
+
+
+def multi_run(input_dir, output_dir, num_procs, h, v, metrics_path=None,
+              memory_budget=MEMORY_BUDGET, gdal_cache=GDAL_CACHE_MAX,
+              query_dates=QUERY_DATES, engine='sweep', aoi=None,
+              products=MAP_NAMES):
+    """
+    :param memory_budget: bytes of finished chips allowed to wait on the
+        writer, workers block once it is used
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi. Only
+        the chips and pixels within it are processed and the rasters cover
+        its window
+    :param products: subset of MAP_NAMES to compute and write
+    """
+    files = (os.path.join(input_dir, f) for f in os.listdir(input_dir)
+             if is_input(f))
+
+    return run_files(files, output_dir, num_procs, h, v, metrics_path,
+                     memory_budget, gdal_cache=gdal_cache,
+                     query_dates=query_dates, engine=engine, aoi=aoi,
+                     products=products)
+
+
+def check_outputs(output_dir, h, v, aoi=None, query_dates=QUERY_DATES,
+                  products=MAP_NAMES):
+    """
+    Raise ValueError if any existing product raster does not cover the area
+    of interest, as a run writing into them would
+
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi
+    """
+    aoi = geo_utils.tile_aoi(h, v, aoi)
+    geometry = geo_utils.output_geometry(h, v,
+                                         aoi.window if aoi is not None else None)
+
+    rasters = [(prod, label) for prod in select_products(products)
+               for label in dates.date_labels(query_dates)]
+    rasters.append(('coverage', ''))
+
+    for prod, label in rasters:
+        file_path = raster_path(output_dir, prod, label, h, v)
+
+        if os.path.exists(file_path):
+            geo_utils.check_raster(geo_utils.get_raster_ds(file_path),
+                                   file_path, *geometry)
+            geo_utils.close_raster_ds(file_path)
+
+
+def rerun(output_dir, num_procs, h, v, metrics_path=None,
+          memory_budget=MEMORY_BUDGET, query_dates=QUERY_DATES,
+          engine='sweep', aoi=None, products=MAP_NAMES):
+    """
+    Re-process only the chips outstanding in the failure ledger, writing
+    into the existing outputs
+
+    :param aoi: the area of interest the outputs were made with
+    :param products: the products the outputs were made with
+    """
+    check_outputs(output_dir, h, v, aoi, query_dates, products)
+
+    files = [entry['key']
+             for entry in ledger.outstanding(ledger.ledger_path(output_dir))]
+
+    log.info('Retrying {} failed chips'.format(len(files)))
+
+    return run_files(files, output_dir, num_procs, h, v, metrics_path,
+                     memory_budget, resolve=True, query_dates=query_dates,
+                     engine=engine, aoi=aoi, products=products)
+
+
+def order_files(files, h, v):
+    """
+    Row major by chip, top to bottom then left to right, so the writer
+    works through the output rasters a row of chips at a time, see
+    benchmark.write_throughput to measure what that gains
+    """
+    ext, _ = geo_utils.extent_from_hv(h, v)
+
+    def key(file_path):
+        if is_matfile(file_path):
+            name = os.path.split(file_path)[-1]
+            return -(ext.y_max - (int(name[13:-4]) - 1) * 30), ext.x_min
+
+        chip_x, chip_y = coords_frompath(file_path)
+        return -int(chip_y), int(chip_x)
+
+    return sorted(files, key=key)
+
+
+def run_files(files, output_dir, num_procs, h, v, metrics_path=None,
+              memory_budget=MEMORY_BUDGET, resolve=False,
+              gdal_cache=GDAL_CACHE_MAX, query_dates=QUERY_DATES,
+              engine='sweep', aoi=None, products=MAP_NAMES):
+    """
+    :param gdal_cache: bytes of GDAL block cache for the writer
+    :param query_dates: ordinals to make the products for
+    :param engine: one of ENGINES
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi
+    :param products: subset of MAP_NAMES to compute and write
+    """
+    metrics.configure(metrics_path)
+
+    products = select_products(products)
+
+    aoi = geo_utils.tile_aoi(h, v, aoi)
+    files = order_files(aoi_files(files, h, v, aoi), h, v)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
     worker_count = num_procs - 1
+    ledger_file = ledger.ledger_path(output_dir)
 
-    for f in os.listdir(input_dir):
-        if f[-5:] == '.json':
-            input_q.put(os.path.join(input_dir, f))
+    input_q = mp.Queue(maxsize=worker_count * 2)
+    nbytes = chip_nbytes(len(query_dates), len(products))
+    output_q = mp.Queue(maxsize=commons.queue_size(memory_budget, nbytes))
 
-    for _ in range(worker_count):
-        input_q.put('kill')
+    commons.start_feeder(input_q, files, worker_count)
 
     for _ in range(worker_count):
         mp.Process(target=multi_worker,
-                   args=(input_q, output_q),
+                   args=(input_q, output_q, h, v, ledger_file, resolve,
+                         query_dates, engine, aoi, products),
                    name='Process-{}'.format(_)).start()
 
-    multi_output(output_dir, output_q, worker_count, h, v)
+    report = multi_output(output_dir, output_q, worker_count, h, v,
+                          gdal_cache=gdal_cache,
+                          window=aoi.window if aoi is not None else None)
+    metrics.finish()
+
+    return report
 #
 #
 # if __name__ == '__main__':
@@ -1,12 +1,15 @@
 import argparse
 import change_maps as cm
+import dates
+from logger import set_level
 
 
 parser = argparse.ArgumentParser(
-        description='Create annual change products from Matlab '
-                    'formatted files.')
+        description='Create annual, monthly or daily change products from '
+                    'JSON chips or Matlab formatted files.')
 
-parser.add_argument('input', help='Input location of Matlab files.')
+parser.add_argument('input', help='Input location of JSON chips or Matlab '
+                                  'record_change files.')
 parser.add_argument('output', help='Output location to for the products.')
 parser.add_argument('h', help='ARD Grid h value.', type=int)
 parser.add_argument('v', help='ARD Grid v value.', type=int)
@@ -14,9 +17,70 @@ parser.add_argument('-p', '--proc',
                     help='Number of child processes to use.',
                     default=1, type=int, metavar='')
 
+parser.add_argument('--metrics',
+                    help='Write stage metrics to this file, Prometheus text '
+                         'if it ends in .prom, otherwise JSON.',
+                    default=None, metavar='')
+parser.add_argument('-m', '--memory',
+                    help='MB of finished chips allowed to wait on the writer.',
+                    default=cm.MEMORY_BUDGET // 1024 ** 2, type=int, metavar='')
+parser.add_argument('--gdal-cache',
+                    help='MB of GDAL block cache for the writer.',
+                    default=cm.GDAL_CACHE_MAX // 1024 ** 2, type=int,
+                    metavar='')
+parser.add_argument('--products',
+                    help='Comma separated products to make, from: '
+                         '{}'.format(', '.join(cm.MAP_NAMES)),
+                    default=','.join(cm.MAP_NAMES), metavar='')
+parser.add_argument('--frequency',
+                    help='Make products for one date a year, a month or a '
+                         'day: annual, monthly or daily.',
+                    default='annual', choices=dates.FREQUENCIES, metavar='')
+parser.add_argument('--start-year',
+                    help='First year to make products for.',
+                    default=cm.YEARS[0], type=int, metavar='')
+parser.add_argument('--end-year',
+                    help='Last year to make products for.',
+                    default=cm.YEARS[-1], type=int, metavar='')
+parser.add_argument('--engine',
+                    help='How dates are evaluated for JSON chips: sweep or '
+                         'reference.',
+                    default='sweep', choices=cm.ENGINES, metavar='')
+parser.add_argument('--aoi',
+                    help='Area of interest, x_min,y_min,x_max,y_max in the '
+                         'tile projection, a shapefile or WKT. Only the '
+                         'chips and pixels within it are processed.',
+                    default=None, metavar='')
+parser.add_argument('--rerun',
+                    help='Only re-process chips in the failure ledger of a '
+                         'previous run, writing into its output.',
+                    action='store_true')
+parser.add_argument('--log-level',
+                    help='Logging level, ie DEBUG, INFO, WARNING.',
+                    default='DEBUG', metavar='')
+
 args = parser.parse_args()
 
-if args.proc < 2:
-    cm.single_run(args.input, args.output, args.h, args.v)
+set_level(args.log_level)
+
+query_dates = dates.query_dates(args.frequency, args.start_year, args.end_year)
+products = cm.select_products(args.products.split(','))
+
+if args.rerun:
+    cm.rerun(args.output, max(args.proc, 2), args.h, args.v,
+             metrics_path=args.metrics,
+             memory_budget=args.memory * 1024 ** 2,
+             query_dates=query_dates, engine=args.engine,
+             aoi=args.aoi, products=products)
+elif args.proc < 2:
+    cm.single_run(args.input, args.output, args.h, args.v,
+                  gdal_cache=args.gdal_cache * 1024 ** 2,
+                  query_dates=query_dates, engine=args.engine,
+                  aoi=args.aoi, products=products)
 else:
-    cm.multi_run(args.input, args.output, args.proc, args.h, args.v)
+    cm.multi_run(args.input, args.output, args.proc, args.h, args.v,
+                 metrics_path=args.metrics,
+                 memory_budget=args.memory * 1024 ** 2,
+                 gdal_cache=args.gdal_cache * 1024 ** 2,
+                 query_dates=query_dates, engine=args.engine,
+                 aoi=args.aoi, products=products)
@@ -3,6 +3,8 @@ import datetime as dt
 
 import numpy as np
 
+import dates
+
 
 ChangeModel = namedtuple('ChangeModel', ['start_day', 'end_day', 'break_day',
                                          'qa', 'magnitudes', 'change_prob'])
@@ -10,22 +12,23 @@ ChangeModel = namedtuple('ChangeModel', ['start_day', 'end_day', 'break_day',
 
 beginning_of_time = dt.date(year=1982, month=1, day=1).toordinal()
 
+# Products sweep can compute, in the order of change_maps.MAP_NAMES
+PRODUCTS = ('changedate', 'changemag', 'qa', 'seglength', 'lastchange')
+
 
 def changedate_val(models, ord_date):
     if ord_date <= 0:
         return 0
 
-    query_date = dt.date.fromordinal(ord_date)
+    query_year = dates.year(ord_date)
 
     ret = 0
     for m in models:
         if m.break_day <= 0:
             continue
 
-        break_date = dt.date.fromordinal(m.break_day)
-
-        if query_date.year == break_date.year and m.change_prob == 1:
-            ret = break_date.timetuple().tm_yday
+        if query_year == dates.year(m.break_day) and m.change_prob == 1:
+            ret = dates.doy(m.break_day)
             break
 
     return ret
@@ -35,16 +38,14 @@ def changemag_val(models, ord_date):
     if ord_date <= 0:
         return 0
 
-    query_date = dt.date.fromordinal(ord_date)
+    query_year = dates.year(ord_date)
 
     ret = 0
     for m in models:
         if m.break_day <= 0:
             continue
 
-        break_date = dt.date.fromordinal(m.break_day)
-
-        if query_date.year == break_date.year and m.change_prob == 1:
+        if query_year == dates.year(m.break_day) and m.change_prob == 1:
             ret = np.linalg.norm(m.magnitudes[1:-1])
             break
 
@@ -97,3 +98,304 @@ def lastchange_val(models, ord_date):
         return 0
 
     return min(diff)
+
+
+def _ordered(ord_dates):
+    """
+    Sorted array of the query dates and the order to put results back in
+    """
+    ord_dates = np.asarray(ord_dates, dtype=np.int64)
+    order = np.argsort(ord_dates, kind='mergesort')
+
+    return ord_dates[order], order
+
+
+def _since_last(bounds, ord_dates):
+    """
+    Per date, the smallest positive difference to any of the bounds
+    """
+    bounds = np.sort(np.asarray(bounds, dtype=np.int64))
+    idx = np.searchsorted(bounds, ord_dates, side='left') - 1
+
+    ret = np.zeros(len(ord_dates))
+    valid = idx >= 0
+    ret[valid] = ord_dates[valid] - bounds[idx[valid]]
+
+    return ret
+
+
+def sweep(models, ord_dates, bot=beginning_of_time, products=PRODUCTS):
+    """
+    Every product for a pixel over many dates at once, each model and date
+    is visited a fixed number of times rather than the models being scanned
+    again for each date. Matches the *_val functions above.
+
+    :param products: which of PRODUCTS to compute, the rest are skipped
+    :return: an array for each of products, in that order, with values in
+        the order of ord_dates
+    """
+    qdates, order = _ordered(ord_dates)
+    n = len(qdates)
+    vals = dict((p, np.zeros(n)) for p in products
+                if p in ('changedate', 'changemag', 'qa'))
+
+    changedate = vals.get('changedate')
+    changemag = vals.get('changemag')
+    qa = vals.get('qa')
+
+    if changedate is not None or changemag is not None:
+        query_years = dates.year(qdates)
+
+    # Going through the models backwards leaves the first match in place
+    for m in reversed(models):
+        if (changedate is not None or changemag is not None) and \
+                m.break_day > 0 and m.change_prob == 1:
+            hit = query_years == dates.year(m.break_day)
+
+            if changedate is not None:
+                changedate[hit] = dates.doy(m.break_day)
+            if changemag is not None:
+                changemag[hit] = np.linalg.norm(m.magnitudes[1:-1])
+
+        if qa is not None:
+            lo = np.searchsorted(qdates, m.start_day, side='left')
+            hi = np.searchsorted(qdates, m.end_day, side='right')
+            qa[lo:hi] = m.qa
+
+    if 'seglength' in products:
+        vals['seglength'] = _since_last([bot] +
+                                        [m.start_day for m in models] +
+                                        [m.end_day for m in models], qdates)
+    if 'lastchange' in products:
+        vals['lastchange'] = _since_last([m.break_day for m in models
+                                          if m.change_prob == 1], qdates)
+
+    ret = []
+    for p in products:
+        values = vals[p]
+        values[qdates <= 0] = 0
+        out = np.empty(n)
+        out[order] = values
+        ret.append(out)
+
+    return tuple(ret)
+
+
+# Vectorized versions of the above, operating on every segment of a chip or
+# row at once. Segments for a pixel must be in the same order as the models
+# list would be, where more than one matches the first one wins.
+Segments = namedtuple('Segments', ['pix', 'start_day', 'end_day', 'break_day',
+                                   'qa', 'magnitudes', 'change_prob'])
+
+
+def _first(pix, mask, values, npix):
+    """
+    Value from the first masked segment per pixel, 0 where there are none
+    """
+    ret = np.zeros(npix, dtype=np.asarray(values).dtype)
+
+    if not np.any(mask):
+        return ret
+
+    idx = np.flatnonzero(mask)
+    upix, first = np.unique(pix[idx], return_index=True)
+    ret[upix] = np.asarray(values)[idx[first]]
+
+    return ret
+
+
+def _min_positive(pix, diffs, npix):
+    """
+    Smallest positive difference per pixel, 0 where there are none
+    """
+    ret = np.full(npix, np.inf)
+    valid = diffs > 0
+
+    np.minimum.at(ret, pix[valid], diffs[valid])
+    ret[np.isinf(ret)] = 0
+
+    return ret
+
+
+def changedate_arr(segs, npix, ord_date):
+    if ord_date <= 0:
+        return np.zeros(npix)
+
+    query_year = dates.year(ord_date)
+    break_year, break_doy = dates.year_doy(segs.break_day)
+
+    mask = ((segs.break_day > 0) & (segs.change_prob == 1) &
+            (break_year == query_year))
+
+    return _first(segs.pix, mask, break_doy, npix)
+
+
+def changemag_arr(segs, npix, ord_date):
+    if ord_date <= 0:
+        return np.zeros(npix)
+
+    query_year = dates.year(ord_date)
+    break_year = dates.year(segs.break_day)
+
+    mask = ((segs.break_day > 0) & (segs.change_prob == 1) &
+            (break_year == query_year))
+    values = np.zeros(len(segs.pix))
+    values[mask] = np.linalg.norm(segs.magnitudes[mask][:, 1:-1], axis=1)
+
+    return _first(segs.pix, mask, values, npix)
+
+
+def qa_arr(segs, npix, ord_date):
+    if ord_date <= 0:
+        return np.zeros(npix)
+
+    mask = (segs.start_day <= ord_date) & (ord_date <= segs.end_day)
+
+    return _first(segs.pix, mask, segs.qa, npix)
+
+
+def seglength_arr(segs, npix, ord_date, covered, bot=beginning_of_time):
+    """
+    :param covered: boolean array, pixels that have a result and so also
+        measure from the beginning of time
+    """
+    if ord_date <= 0:
+        return np.zeros(npix)
+
+    pix = np.concatenate((segs.pix, segs.pix, np.flatnonzero(covered)))
+    bounds = np.concatenate((segs.start_day, segs.end_day,
+                             np.full(np.count_nonzero(covered), bot)))
+
+    return _min_positive(pix, ord_date - bounds, npix)
+
+
+def lastchange_arr(segs, npix, ord_date):
+    if ord_date <= 0:
+        return np.zeros(npix)
+
+    mask = segs.change_prob == 1
+
+    return _min_positive(segs.pix[mask], ord_date - segs.break_day[mask], npix)
+
+
+def _first_in_range(pix, lo, hi, values, n, npix):
+    """
+    Per date and pixel, the value of the first segment whose [lo, hi) range
+    of date indices holds the date, 0 where none do
+    """
+    ret = np.zeros(n * npix)
+
+    counts = np.maximum(hi - lo, 0)
+    total = int(counts.sum())
+
+    if not total:
+        return ret.reshape(n, npix)
+
+    # One entry per segment and date it covers, in segment order
+    seg = np.repeat(np.arange(len(pix)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    keys = (lo[seg] + offsets) * npix + pix[seg]
+
+    keys, first = np.unique(keys, return_index=True)
+    ret[keys] = np.asarray(values)[seg[first]]
+
+    return ret.reshape(n, npix)
+
+
+def _since_last_arr(pix, bounds, qdates, npix):
+    """
+    Per date and pixel, the smallest positive difference to any of the
+    pixel's bounds, 0 where there are none
+    """
+    ret = np.zeros((len(qdates), npix))
+
+    if not len(pix):
+        return ret
+
+    # One sorted key per bound, pixel first, so a search for a pixel and
+    # date lands just after that pixel's last bound before the date
+    order = np.lexsort((bounds, pix))
+    pix = pix[order].astype(np.int64)
+    bounds = bounds[order].astype(np.int64)
+    stride = 2 ** 32
+    keys = pix * stride + bounds
+
+    # Pixel by date so the queries are sorted too, which searchsorted is
+    # much quicker with
+    cols = np.unique(pix)
+    queries = cols[:, np.newaxis] * stride + qdates[np.newaxis, :]
+    idx = np.searchsorted(keys, queries, side='left') - 1
+
+    valid = idx >= 0
+    valid[valid] = pix[idx[valid]] == np.broadcast_to(cols[:, np.newaxis],
+                                                      idx.shape)[valid]
+
+    diffs = np.where(valid, qdates[np.newaxis, :] - bounds[np.maximum(idx, 0)], 0)
+    ret[:, cols] = diffs.T
+
+    return ret
+
+
+def sweep_arr(segs, npix, ord_dates, covered, bot=beginning_of_time,
+              products=PRODUCTS):
+    """
+    sweep for every pixel of a chip or row at once, the segments are put
+    against the sorted dates once rather than scanned again for each date.
+    Matches the *_arr functions above.
+
+    :param covered: boolean array, pixels that have a result
+    :param products: which of PRODUCTS to compute, the rest are skipped
+    :return: an array shape=(len(ord_dates), npix) for each of products, in
+        that order, with dates in the order of ord_dates
+    """
+    qdates, order = _ordered(ord_dates)
+    n = len(qdates)
+    vals = {}
+
+    if 'changedate' in products or 'changemag' in products:
+        brk = (segs.break_day > 0) & (segs.change_prob == 1)
+        break_year, break_doy = dates.year_doy(segs.break_day[brk])
+
+        query_years = dates.year(qdates)
+        lo = np.searchsorted(query_years, break_year, side='left')
+        hi = np.searchsorted(query_years, break_year, side='right')
+
+        if 'changedate' in products:
+            vals['changedate'] = _first_in_range(segs.pix[brk], lo, hi,
+                                                 break_doy, n, npix)
+        if 'changemag' in products:
+            mags = np.linalg.norm(segs.magnitudes[brk][:, 1:-1], axis=1)
+            vals['changemag'] = _first_in_range(segs.pix[brk], lo, hi, mags,
+                                                n, npix)
+
+    if 'qa' in products:
+        lo = np.searchsorted(qdates, segs.start_day, side='left')
+        hi = np.searchsorted(qdates, segs.end_day, side='right')
+        vals['qa'] = _first_in_range(segs.pix, lo, hi, segs.qa, n, npix)
+
+    if 'seglength' in products:
+        covered_pix = np.flatnonzero(covered)
+        vals['seglength'] = _since_last_arr(
+            np.concatenate((segs.pix, segs.pix, covered_pix)),
+            np.concatenate((segs.start_day, segs.end_day,
+                            np.full(len(covered_pix), bot))),
+            qdates, npix)
+
+    if 'lastchange' in products:
+        mask = segs.change_prob == 1
+        vals['lastchange'] = _since_last_arr(segs.pix[mask],
+                                             segs.break_day[mask], qdates, npix)
+
+    ret = []
+    for p in products:
+        values = vals[p]
+        values[qdates <= 0] = 0
+
+        if np.any(order != np.arange(n)):
+            out = np.empty_like(values)
+            out[order] = values
+            values = out
+
+        ret.append(values)
+
+    return tuple(ret)
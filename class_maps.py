@@ -5,14 +5,21 @@ Classification Maps for CCDC visualizations
 import os
 import sys
 import multiprocessing as mp
+from collections import OrderedDict
 import datetime as dt
 import pickle
+from timeit import default_timer
 
 from osgeo import gdal
 import numpy as np
 
 import geo_utils
-from class_products import ClassModel, class_primary, class_secondary, conf_primary, conf_secondary, segchange, sort_models
+import dates
+import commons
+import metrics
+import ledger
+import tile_stats
+from class_products import ClassModel, class_primary, class_secondary, conf_primary, conf_secondary, segchange, sort_models, sweep, PRODUCTS
 from logger import log
 
 
@@ -23,6 +30,27 @@ YEARS = tuple(i for i in range(1984, 2016))
 QUERY_DATES = tuple(dt.date(year=i, month=7, day=1).toordinal()
                     for i in YEARS)
 
+# Functions behind each of MAP_NAMES
+PRODUCT_FUNCS = dict(zip(MAP_NAMES, (class_primary, class_secondary,
+                                     conf_primary, conf_secondary, segchange)))
+
+# 'sweep' evaluates all the dates for a pixel in one pass over its models,
+# 'reference' asks the class_products functions for every date
+ENGINES = ('sweep', 'reference')
+
+# Bytes of finished chips allowed to queue up waiting on the writer
+MEMORY_BUDGET = 1024 ** 3
+
+# GDAL block cache for the writer, enough to hold a row of chips across
+# every annual output raster, the size measured best for the change writer
+GDAL_CACHE_MAX = 512 * 1024 ** 2
+
+# Rasters the writer holds open at once, every annual product fits. With
+# monthly or daily dates a row of chips spans more rasters than this, or
+# than GDAL_CACHE_MAX holds, so blocks are flushed and re-read as the row
+# is written, see check_writer
+MAX_OPEN_DATASETS = 256
+
 SEGCHG_CT = gdal.ColorTable()
 SEGCHG_CT.SetColorEntry(0, (0, 0, 0, 0))  # Black
 SEGCHG_CT.SetColorEntry(11, (227, 26, 28, 0))  # Red Developed
@@ -43,7 +71,7 @@ for i in range(1, 9):
             SEGCHG_CT.SetColorEntry(int('{}{}'.format(i, j)), (162, 1, 255, 0))
 
 
-def map_template():
+def map_template(labels=YEARS, products=MAP_NAMES):
     """
     Return a new dictionary to store annual change map values
 
@@ -53,26 +81,45 @@ def map_template():
                       }
      'next product': {years:
                      }
+
+    :param labels: keys for each date, see dates.date_labels
+    :param products: subset of MAP_NAMES
     """
     ret = {}
 
-    for m in MAP_NAMES:
-        ret[m] = {}
-        for yr in YEARS:
-            ret[m][yr] = np.zeros(shape=(100, 100))
+    for m in products:
+        # One block per product, each date's array is a view into it
+        stack = np.zeros(shape=(len(labels), 100, 100))
+        ret[m] = dict(zip(labels, stack))
 
     return ret
 
 
-def get_raster_ds(output_dir, product, year, h, v):
+def raster_path(output_dir, product, year, h, v):
     key = 'h{:02d}v{:02d}_{}_{}'.format(h, v, product, year)
 
-    file_path = os.path.join(output_dir, key + '.tif')
+    return os.path.join(output_dir, key + '.tif')
+
+
+def get_raster_ds(output_dir, product, year, h, v, window=None):
+    """
+    Open a product raster for writing, creating it if needed
+
+    :param window: the raster covers only this window of the tile, an
+        existing one that does not is an error
+    """
+    file_path = raster_path(output_dir, product, year, h, v)
 
     if os.path.exists(file_path):
         ds = gdal.Open(file_path, gdal.GA_Update)
+
+        if ds is None:
+            raise IOError('Unable to open raster: {}'.format(file_path))
+
+        geo_utils.check_raster(ds, file_path,
+                               *geo_utils.output_geometry(h, v, window))
     else:
-        ds = create_geotif(file_path, product, h, v)
+        ds = create_geotif(file_path, product, h, v, window=window)
 
         if product == 'SegChange':
             ds.GetRasterBand(1).SetColorTable(SEGCHG_CT)
@@ -80,14 +127,22 @@ def get_raster_ds(output_dir, product, year, h, v):
     return ds
 
 
-def create_geotif(file_path, product, h, v, rows=5000, cols=5000, proj=CONUS_WKT):
+def create_geotif(file_path, product, h, v, rows=5000, cols=5000, proj=CONUS_WKT,
+                  window=None):
+    """
+    :param window: geo_utils.RowColumnExtent, the raster covers only this
+        part of the tile
+    """
     data_type = prod_data_type(product)
-    _, geo = geo_utils.extent_from_hv(h, v)
+    rows, cols, geo = geo_utils.output_geometry(h, v, window, rows, cols)
 
     ds = (gdal
           .GetDriverByName('GTiff')
           .Create(file_path, cols, rows, 1, data_type))
 
+    if ds is None:
+        raise IOError('Unable to create raster: {}'.format(file_path))
+
     ds.SetGeoTransform(geo)
     ds.SetProjection(proj)
 
@@ -116,137 +171,475 @@ def coords_frompath(file_path):
     return parts[1], parts[2]
 
 
-def classmap_vals(input, query_dates=QUERY_DATES):
+def select_products(products=None):
+    """
+    :param products: names from MAP_NAMES, all of them if None
+    :return: tuple of the names in MAP_NAMES order
+    """
+    if products is None:
+        return MAP_NAMES
+
+    unknown = set(products) - set(MAP_NAMES)
+    if unknown:
+        raise ValueError('Unknown products: {}'.format(', '.join(sorted(unknown))))
+
+    return tuple(m for m in MAP_NAMES if m in products)
+
+
+def pixel_models(result):
+    models = [ClassModel(class_probs=r['class_probs'],
+                         class_vals=r['class_vals'],
+                         end_day=r['end_day'],
+                         start_day=r['start_day'])
+              for r in result]
+
+    return sort_models(models)
+
+
+def classmap_vals(input, query_dates=QUERY_DATES, engine='sweep', mask=None,
+                  products=MAP_NAMES):
+    """
+    :param query_dates: ordinals to make the products for, see
+        dates.query_dates
+    :param engine: one of ENGINES
+    :param mask: bool array shape=(100, 100) of the pixels to compute, the
+        rest are left at 0
+    :param products: subset of MAP_NAMES to compute
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine: {}'.format(engine))
+
+    products = select_products(products)
+
     data = open_classpickle(input)
     chip_x, chip_y = coords_frompath(input)
 
-    temp = map_template()
+    if mask is not None:
+        data = [r if keep else None for r, keep in zip(data, mask.ravel())]
+
+    if not any(data):
+        metrics.incr('chips_empty')
+
+    labels = dates.date_labels(query_dates)
+
+    # Pixels without models still get the products' values for no models,
+    # ie CoverConfSec is 1, only those outside the mask are left at 0
+    empty = np.array([pix for pix, result in enumerate(data)
+                      if result is not None and not result], dtype=int)
+    empty_rows, empty_cols = np.divmod(empty, 100)
+
+    if engine == 'sweep':
+        names = tuple(PRODUCTS[MAP_NAMES.index(m)] for m in products)
+
+        # product, date, row, col
+        stack = np.zeros(shape=(len(products), len(labels), 100, 100))
+
+        if len(empty):
+            fill = np.array(sweep([], query_dates, products=names))
+            stack[:, :, empty_rows, empty_cols] = fill[:, :, np.newaxis]
+
+        for pix, result in enumerate(data):
+            if result:
+                row, col = divmod(pix, 100)
+                stack[:, :, row, col] = sweep(pixel_models(result), query_dates,
+                                              products=names)
+
+        temp = dict((m, dict(zip(labels, prod)))
+                    for m, prod in zip(products, stack))
+        temp['chip_x'] = int(chip_x)
+        temp['chip_y'] = int(chip_y)
+
+        return temp
+
+    temp = map_template(labels, products)
     temp['chip_x'] = int(chip_x)
     temp['chip_y'] = int(chip_y)
 
-    row = 0
-    col = 0
-    for result in data:
-        models = [ClassModel(class_probs=r['class_probs'],
-                             class_vals=r['class_vals'],
-                             end_day=r['end_day'],
-                             start_day=r['start_day'])
-                  for r in result]
+    if len(empty):
+        for prod in products:
+            func = PRODUCT_FUNCS[prod]
 
-        models = sort_models(models)
+            for label, d in zip(labels, query_dates):
+                temp[prod][label][empty_rows, empty_cols] = func([], d)
 
-        cl_pr = [class_primary(models, d) for d in query_dates]
-        cl_sc = [class_secondary(models, d) for d in query_dates]
-        conf_pr = [conf_primary(models, d) for d in query_dates]
-        conf_sc = [conf_secondary(models, d) for d in query_dates]
-        cl_segchg = [segchange(models, d) for d in query_dates]
+    for pix, result in enumerate(data):
+        if not result:
+            continue
 
-        # ('CoverPrim', 'CoverSec', 'CoverConfPrim', 'CoverConfSec',
-        #  'CoverFromTo')
-        for idx, qdate in enumerate(query_dates):
-            year = dt.date.fromordinal(qdate).year
+        row, col = divmod(pix, 100)
 
-            temp['CoverPrim'][year][row, col] = cl_pr[idx]
-            temp['CoverSec'][year][row, col] = cl_sc[idx]
-            temp['CoverConfPrim'][year][row, col] = conf_pr[idx]
-            temp['CoverConfSec'][year][row, col] = conf_sc[idx]
-            temp['SegChange'][year][row, col] = cl_segchg[idx]
+        models = pixel_models(result)
 
-        col += 1
+        for prod in products:
+            func = PRODUCT_FUNCS[prod]
 
-        if col > 99:
-            row += 1
-            col = 0
+            for label, d in zip(labels, query_dates):
+                temp[prod][label][row, col] = func(models, d)
 
     return temp
 
 
-def xyoff(h, v, chip_x, chip_y):
+def chip_vals(input, h, v, query_dates=QUERY_DATES, engine='sweep', aoi=None,
+              products=MAP_NAMES):
+    """
+    classmap_vals restricted to the pixels in an area of interest
+
+    :param aoi: geo_utils.AOI, all pixels if None
+    """
+    mask = None
+    if aoi is not None:
+        chip_x, chip_y = coords_frompath(input)
+        mask = geo_utils.aoi_chip_mask(aoi, h, v, int(chip_x), int(chip_y))
+
+    return classmap_vals(input, query_dates, engine, mask, products)
+
+
+def aoi_files(files, h, v, aoi):
+    """
+    Only the chips with pixels in the area of interest
+
+    :param aoi: geo_utils.AOI, every file is kept if None
+    """
+    if aoi is None:
+        return list(files)
+
+    chips = geo_utils.aoi_chips(h, v, aoi)
+
+    ret = []
+    for f in files:
+        try:
+            chip_x, chip_y = coords_frompath(f)
+            keep = (int(chip_x), int(chip_y)) in chips
+        except (IndexError, ValueError):
+            keep = False
+
+        if keep:
+            ret.append(f)
+        else:
+            metrics.incr('chips_skipped')
+
+    return ret
+
+
+def xyoff(h, v, chip_x, chip_y, window=None):
+    """
+    :param window: offsets are within this window of the tile if given
+    """
     coord = geo_utils.GeoCoordinate(x=chip_x, y=chip_y)
     _, geo = geo_utils.extent_from_hv(h, v)
 
     rowcol = geo_utils.geo_to_rowcol(geo, coord)
+
+    if window is not None:
+        return rowcol.column - window.start_col, rowcol.row - window.start_row
+
     return rowcol.column, rowcol.row
 
 
-def output_chip(data, output_dir, h, v):
+def output_chip(data, output_dir, h, v, datasets=None, window=None):
+    """
+    :param datasets: OrderedDict the caller keeps to hold up to
+        MAX_OPEN_DATASETS rasters open between chips, see close_datasets.
+        Each raster is opened and closed for every chip if None
+    :param window: write rasters covering only this window of the tile
+    """
     chip_y = data.pop('chip_y')
     chip_x = data.pop('chip_x')
 
-    x_off, y_off = xyoff(h, v, chip_x, chip_y)
+    x_off, y_off = xyoff(h, v, chip_x, chip_y, window)
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     for prod in data:
         for year in data[prod]:
-            ds = get_raster_ds(output_dir, prod, year, h, v)
-            ds.GetRasterBand(1).WriteArray(data[prod][year], x_off, y_off)
+            if datasets is None:
+                ds = get_raster_ds(output_dir, prod, year, h, v, window)
+                ds.GetRasterBand(1).WriteArray(data[prod][year], x_off, y_off)
 
-            ds = None
+                ds = None
+            else:
+                ds = geo_utils.held_dataset(datasets, (prod, year),
+                                            lambda: get_raster_ds(output_dir,
+                                                                  prod, year,
+                                                                  h, v, window),
+                                            MAX_OPEN_DATASETS)
+                ds.GetRasterBand(1).WriteArray(data[prod][year], x_off, y_off)
 
+            metrics.incr('rasters_written')
+
+
+def close_datasets(datasets):
+    for key in list(datasets):
+        datasets.pop(key).FlushCache()
+
+
+def check_writer(data, gdal_cache=GDAL_CACHE_MAX, window=None):
+    """
+    Warn when a row of chips spans more rasters than the writer holds open,
+    or more than the GDAL cache holds, blocks are then flushed and re-read
+    as each row is written
+
+    :param data: a chip's map dictionary
+    :return: False if the chip has no products to judge by
+    """
+    prods = [p for p in data if p not in ('chip_x', 'chip_y')]
+
+    if not prods:
+        return False
+
+    cols = 5000 if window is None else window.end_col - window.start_col
+    rasters = sum(len(data[p]) for p in prods)
+    row_bytes = (sum(len(data[p]) * gdal.GetDataTypeSize(prod_data_type(p)) // 8
+                     for p in prods)) * 100 * cols
+
+    if rasters > MAX_OPEN_DATASETS:
+        log.warning('Writing {} rasters, only {} are held open at once'
+                    .format(rasters, MAX_OPEN_DATASETS))
+
+    if gdal_cache and row_bytes > gdal_cache:
+        log.warning('A row of chips is {}MB across the rasters, more than the '
+                    '{}MB GDAL cache'.format(row_bytes // 1024 ** 2,
+                                             gdal_cache // 1024 ** 2))
+
+    return True
+
+
+def chip_nbytes(date_count=len(YEARS), product_count=len(MAP_NAMES)):
+    """
+    Approximate size of one finished chip waiting on the writer
+    """
+    return product_count * date_count * 100 * 100 * 8
+
+
+def multi_output(output_dir, output_q, kill_count, h, v, metrics_interval=60,
+                 gdal_cache=GDAL_CACHE_MAX, window=None):
+    """
+    Single writer, consumes finished chips until every worker has sent kill.
+    The output rasters are held open for the whole run.
+
+    :param window: write rasters covering only this window of the tile
+
+    :return: dictionary of chips written, seconds the writer waited on an
+        empty queue, and seconds workers were blocked on a full one
+    """
+    geo_utils.set_cache_max(gdal_cache)
+    datasets = OrderedDict()
+    chip_stats = {}
+    checked = False
 
-def multi_output(output_dir, output_q, kill_count, h, v):
     count = 0
     progress = 0
+    waited = 0.0
+    blocked = 0.0
     while True:
         if count >= kill_count:
             break
 
+        metrics.gauge('output_queue_depth', commons.queue_depth(output_q))
+        start = default_timer()
         outdata = output_q.get()
+        waited += default_timer() - start
 
-        if outdata == 'kill':
+        if commons.is_kill(outdata):
             count += 1
+            if isinstance(outdata, tuple):
+                blocked += outdata[1]
             continue
 
-        log.debug('Outputting chip: {0} {1}'.format(outdata['chip_x'],
-                                                    outdata['chip_y']))
-        output_chip(outdata, output_dir, h, v)
+        log.debug('Outputting chip: %s %s', outdata['chip_x'], outdata['chip_y'])
+        chip_stats[tile_stats.chip_key(outdata)] = tile_stats.class_chip(outdata)
+        if not checked:
+            checked = check_writer(outdata, gdal_cache, window)
+        with metrics.timer('class.output_chip'):
+            output_chip(outdata, output_dir, h, v, datasets, window)
         progress += 1
-        log.debug('Total chips written: {}'.format(progress))
+        metrics.incr('chips_written')
+        log.debug('Total chips written: %s', progress)
 
+        metrics.dump(interval=metrics_interval)
+
+    metrics.add_time('class.writer_waiting', waited)
     log.debug('Finalizing Writes')
+    close_datasets(datasets)
+    tile_stats.write_class_chips(output_dir, h, v, chip_stats)
+    log.info('Wrote {} chips, writer waited {:.1f}s for chips, workers were '
+             'blocked {:.1f}s on the output queue'.format(progress, waited, blocked))
+
+    return {'chips': progress, 'writer_waiting': waited, 'workers_blocked': blocked}
 
 
-def multi_worker(input_q, output_q):
+def multi_worker(input_q, output_q, ledger_file=None, resolve=False,
+                 query_dates=QUERY_DATES, engine='sweep', h=None, v=None,
+                 aoi=None, products=MAP_NAMES, metrics_interval=60):
+    """
+    :param ledger_file: failures are recorded here
+    :param resolve: mark chips in the ledger as resolved once they succeed
+    :param aoi: geo_utils.AOI of tile h, v to restrict the pixels to
+    :param metrics_interval: seconds between metrics snapshots, so a worker
+        that dies still leaves its progress behind
+    """
+    blocked = 0.0
     while True:
         try:
             infile = input_q.get()
 
-            log.debug('Received {}'.format(infile))
+            log.debug('Received %s', infile)
 
             if infile == 'kill':
-                output_q.put('kill')
+                metrics.flush()
+                output_q.put(('kill', blocked))
                 break
 
-            map_dict = classmap_vals(infile)
+            with metrics.timer('class.classmap_vals'):
+                map_dict = chip_vals(infile, h, v, query_dates, engine, aoi,
+                                     products)
+            metrics.incr('chips_read')
 
-            log.debug('Finished: {0} {1}'.format(map_dict['chip_x'],
-                                                 map_dict['chip_y']))
+            log.debug('Finished: %s %s', map_dict['chip_x'], map_dict['chip_y'])
+
+            # Blocks when the writer is behind and the memory budget is used
+            start = default_timer()
             output_q.put(map_dict)
+            elapsed = default_timer() - start
+            blocked += elapsed
+            metrics.add_time('class.workers_blocked', elapsed)
+            if resolve:
+                ledger.resolve(ledger_file, infile)
+
+            metrics.flush(interval=metrics_interval)
         except Exception as e:
             log.exception('EXCEPTION')
+            metrics.incr('chip_errors')
+            ledger.record(ledger_file, infile, e)
+            metrics.flush(interval=metrics_interval)
             continue
 
 
-def multi_run(input_dir, output_dir, num_procs, h, v):
-    input_q = mp.Queue()
-    output_q = mp.Queue()
+def multi_run(input_dir, output_dir, num_procs, h, v, metrics_path=None,
+              memory_budget=MEMORY_BUDGET, gdal_cache=GDAL_CACHE_MAX,
+              query_dates=QUERY_DATES, engine='sweep', aoi=None,
+              products=MAP_NAMES):
+    """
+    :param memory_budget: bytes of finished chips allowed to wait on the
+        writer, workers block once it is used
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi. Only
+        the chips and pixels within it are processed and the rasters cover
+        its window
+    :param products: subset of MAP_NAMES to compute and write
+    """
+    files = (os.path.join(input_dir, f) for f in os.listdir(input_dir))
+
+    return run_files(files, output_dir, num_procs, h, v, metrics_path,
+                     memory_budget, gdal_cache=gdal_cache,
+                     query_dates=query_dates, engine=engine, aoi=aoi,
+                     products=products)
+
+
+def check_outputs(output_dir, h, v, aoi=None, query_dates=QUERY_DATES,
+                  products=MAP_NAMES):
+    """
+    Raise ValueError if any existing product raster does not cover the area
+    of interest, as a run writing into them would
+
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi
+    """
+    aoi = geo_utils.tile_aoi(h, v, aoi)
+    geometry = geo_utils.output_geometry(h, v,
+                                         aoi.window if aoi is not None else None)
+
+    rasters = [(prod, label) for prod in select_products(products)
+               for label in dates.date_labels(query_dates)]
+
+    for prod, label in rasters:
+        file_path = raster_path(output_dir, prod, label, h, v)
+
+        if os.path.exists(file_path):
+            geo_utils.check_raster(geo_utils.get_raster_ds(file_path),
+                                   file_path, *geometry)
+            geo_utils.close_raster_ds(file_path)
+
+
+def rerun(output_dir, num_procs, h, v, metrics_path=None,
+          memory_budget=MEMORY_BUDGET, query_dates=QUERY_DATES,
+          engine='sweep', aoi=None, products=MAP_NAMES):
+    """
+    Re-process only the chips outstanding in the failure ledger, writing
+    into the existing outputs
+
+    :param aoi: the area of interest the outputs were made with
+    :param products: the products the outputs were made with
+    """
+    check_outputs(output_dir, h, v, aoi, query_dates, products)
+
+    files = [entry['key']
+             for entry in ledger.outstanding(ledger.ledger_path(output_dir))]
+
+    log.info('Retrying {} failed chips'.format(len(files)))
+
+    return run_files(files, output_dir, num_procs, h, v, metrics_path,
+                     memory_budget, resolve=True, query_dates=query_dates,
+                     engine=engine, aoi=aoi, products=products)
+
+
+def order_files(files, h, v):
+    """
+    Row major by chip, top to bottom then left to right, so the writer
+    works through the output rasters a row of chips at a time, see
+    benchmark.write_throughput to measure what that gains
+    """
+    def key(file_path):
+        try:
+            chip_x, chip_y = coords_frompath(file_path)
+            return 0, -int(chip_y), int(chip_x)
+        except (IndexError, ValueError):
+            return 1, 0, 0
+
+    return sorted(files, key=key)
+
+
+def run_files(files, output_dir, num_procs, h, v, metrics_path=None,
+              memory_budget=MEMORY_BUDGET, resolve=False,
+              gdal_cache=GDAL_CACHE_MAX, query_dates=QUERY_DATES,
+              engine='sweep', aoi=None, products=MAP_NAMES):
+    """
+    :param gdal_cache: bytes of GDAL block cache for the writer
+    :param query_dates: ordinals to make the products for
+    :param engine: one of ENGINES
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi
+    :param products: subset of MAP_NAMES to compute and write
+    """
+    metrics.configure(metrics_path)
+
+    products = select_products(products)
+
+    aoi = geo_utils.tile_aoi(h, v, aoi)
+    files = order_files(aoi_files(files, h, v, aoi), h, v)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
     worker_count = num_procs - 1
+    ledger_file = ledger.ledger_path(output_dir)
 
-    for f in os.listdir(input_dir):
-        input_q.put(os.path.join(input_dir, f))
+    input_q = mp.Queue(maxsize=worker_count * 2)
+    nbytes = chip_nbytes(len(query_dates), len(products))
+    output_q = mp.Queue(maxsize=commons.queue_size(memory_budget, nbytes))
 
-    for _ in range(worker_count):
-        input_q.put('kill')
+    commons.start_feeder(input_q, files, worker_count)
 
     for _ in range(worker_count):
         mp.Process(target=multi_worker,
-                   args=(input_q, output_q),
+                   args=(input_q, output_q, ledger_file, resolve,
+                         query_dates, engine, h, v, aoi, products),
                    name='Process-{}'.format(_)).start()
 
-    multi_output(output_dir, output_q, worker_count, h, v)
+    report = multi_output(output_dir, output_q, worker_count, h, v,
+                          gdal_cache=gdal_cache,
+                          window=aoi.window if aoi is not None else None)
+    metrics.finish()
+
+    return report
 
 
 def main(indir, outdir, h, v, procs):
@@ -0,0 +1,80 @@
+import argparse
+import class_maps as clm
+import dates
+from logger import set_level
+
+
+parser = argparse.ArgumentParser(
+        description='Create annual, monthly or daily classification products '
+                    'from classification pickles.')
+
+parser.add_argument('input', help='Input location of the classification '
+                                  'pickles.')
+parser.add_argument('output', help='Output location to for the products.')
+parser.add_argument('h', help='ARD Grid h value.', type=int)
+parser.add_argument('v', help='ARD Grid v value.', type=int)
+parser.add_argument('-p', '--proc',
+                    help='Number of child processes to use, at least 2.',
+                    default=2, type=int, metavar='')
+
+parser.add_argument('--metrics',
+                    help='Write stage metrics to this file, Prometheus text '
+                         'if it ends in .prom, otherwise JSON.',
+                    default=None, metavar='')
+parser.add_argument('-m', '--memory',
+                    help='MB of finished chips allowed to wait on the writer.',
+                    default=clm.MEMORY_BUDGET // 1024 ** 2, type=int, metavar='')
+parser.add_argument('--gdal-cache',
+                    help='MB of GDAL block cache for the writer.',
+                    default=clm.GDAL_CACHE_MAX // 1024 ** 2, type=int,
+                    metavar='')
+parser.add_argument('--products',
+                    help='Comma separated products to make, from: '
+                         '{}'.format(', '.join(clm.MAP_NAMES)),
+                    default=','.join(clm.MAP_NAMES), metavar='')
+parser.add_argument('--frequency',
+                    help='Make products for one date a year, a month or a '
+                         'day: annual, monthly or daily.',
+                    default='annual', choices=dates.FREQUENCIES, metavar='')
+parser.add_argument('--start-year',
+                    help='First year to make products for.',
+                    default=clm.YEARS[0], type=int, metavar='')
+parser.add_argument('--end-year',
+                    help='Last year to make products for.',
+                    default=clm.YEARS[-1], type=int, metavar='')
+parser.add_argument('--engine',
+                    help='How dates are evaluated: sweep or reference.',
+                    default='sweep', choices=clm.ENGINES, metavar='')
+parser.add_argument('--aoi',
+                    help='Area of interest, x_min,y_min,x_max,y_max in the '
+                         'tile projection, a shapefile or WKT. Only the '
+                         'chips and pixels within it are processed.',
+                    default=None, metavar='')
+parser.add_argument('--rerun',
+                    help='Only re-process chips in the failure ledger of a '
+                         'previous run, writing into its output.',
+                    action='store_true')
+parser.add_argument('--log-level',
+                    help='Logging level, ie DEBUG, INFO, WARNING.',
+                    default='DEBUG', metavar='')
+
+args = parser.parse_args()
+
+set_level(args.log_level)
+
+query_dates = dates.query_dates(args.frequency, args.start_year, args.end_year)
+products = clm.select_products(args.products.split(','))
+
+if args.rerun:
+    clm.rerun(args.output, max(args.proc, 2), args.h, args.v,
+              metrics_path=args.metrics,
+              memory_budget=args.memory * 1024 ** 2,
+              query_dates=query_dates, engine=args.engine,
+              aoi=args.aoi, products=products)
+else:
+    clm.multi_run(args.input, args.output, max(args.proc, 2), args.h, args.v,
+                  metrics_path=args.metrics,
+                  memory_budget=args.memory * 1024 ** 2,
+                  gdal_cache=args.gdal_cache * 1024 ** 2,
+                  query_dates=query_dates, engine=args.engine,
+                  aoi=args.aoi, products=products)
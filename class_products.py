@@ -3,12 +3,18 @@ import datetime as dt
 
 import numpy as np
 
+import dates
+
 
 ClassModel = namedtuple('ClassModel', ['start_day', 'end_day',
                                        'class_probs', 'class_vals'])
 
 trans_class = 9
 
+# Products sweep can compute, in the order of class_maps.MAP_NAMES
+PRODUCTS = ('class_primary', 'class_secondary', 'conf_primary',
+            'conf_secondary', 'segchange')
+
 
 def sort_models(models):
     if len(models) == 1:
@@ -56,10 +62,10 @@ def segchange(models, ord_date):
         return 0
 
     ret = 0
-    query_yr = dt.date.fromordinal(ord_date).year
+    query_yr = dates.year(ord_date)
 
     for idx, m in enumerate(models):
-        yr = dt.date.fromordinal(m.end_day).year
+        yr = dates.year(m.end_day)
 
         if yr == query_yr:
             class_val = m.class_vals[np.argmax(m.class_probs[0])]
@@ -108,3 +114,71 @@ def conf_secondary(models, ord_date):
         prev_end = m.end_day
 
     return 1
+
+
+def sweep(models, ord_dates, products=PRODUCTS):
+    """
+    Every class product for a pixel over many dates at once, models must
+    already be sorted. Matches the functions above.
+
+    :param products: which of PRODUCTS to compute, the rest are skipped
+    :return: an array for each of products, in that order, with values in
+        the order of ord_dates
+    """
+    ord_dates = np.asarray(ord_dates, dtype=np.int64)
+    order = np.argsort(ord_dates, kind='mergesort')
+    qdates = ord_dates[order]
+    n = len(qdates)
+
+    vals = dict((p, np.ones(n) if p == 'conf_secondary' else np.zeros(n))
+                for p in products)
+
+    primary = vals.get('class_primary')
+    secondary = vals.get('class_secondary')
+    conf_pr = vals.get('conf_primary')
+    conf_sc = vals.get('conf_secondary')
+    segchg = vals.get('segchange')
+
+    if segchg is not None:
+        query_years = dates.year(qdates)
+
+    prims = [m.class_vals[np.argmax(m.class_probs[0])] for m in models]
+
+    # Each model decides the dates within it, and those in the gap since
+    # the one before. Going backwards leaves the first model's values.
+    for idx in reversed(range(len(models))):
+        m = models[idx]
+        prev_end = models[idx - 1].end_day if idx else 0
+        probs = m.class_probs[0]
+        second = np.argsort(probs)[-2]
+
+        lo = np.searchsorted(qdates, prev_end, side='right')
+        start = np.searchsorted(qdates, m.start_day, side='left')
+        end = np.searchsorted(qdates, m.end_day, side='right')
+
+        if primary is not None:
+            primary[lo:start] = trans_class
+            primary[start:end] = prims[idx]
+        if secondary is not None:
+            secondary[lo:start] = trans_class
+            secondary[start:end] = m.class_vals[second]
+        if conf_pr is not None:
+            conf_pr[lo:start] = 100
+            conf_pr[start:end] = int(max(probs) * 100)
+        if conf_sc is not None:
+            conf_sc[lo:start] = 100
+            conf_sc[start:end] = int(probs[second] * 100)
+
+        if segchg is not None:
+            next_val = prims[idx + 1] if idx + 1 < len(models) else 0
+            segchg[query_years == dates.year(m.end_day)] = int('{}{}'.format(prims[idx], next_val))
+
+    ret = []
+    for p in products:
+        values = vals[p]
+        values[qdates <= 0] = 0
+        out = np.empty(n)
+        out[order] = values
+        ret.append(out)
+
+    return tuple(ret)
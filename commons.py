@@ -1,4 +1,21 @@
+import bz2
+import gzip
+import json
+import os
+import threading
+
 from logger import log
+import metrics
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 def retry(retries):
@@ -11,6 +28,7 @@ def retry(retries):
                     return func(*args, **kwargs)
                 except:
                     count += 1
+                    metrics.incr('retries')
 
                     if count > retries:
                         log.debug('Retry limit exceeded')
@@ -18,3 +36,228 @@ def retry(retries):
 
         return wrapper
     return retry_dec
+
+
+COMPRESSED_EXTS = ('.gz', '.bz2', '.xz', '.zst')
+
+_MAGIC = ((b'\x1f\x8b', 'gzip'),
+          (b'BZh', 'bz2'),
+          (b'\xfd7zXZ\x00', 'xz'),
+          (b'\x28\xb5\x2f\xfd', 'zstd'))
+
+_EXT_COMPRESSION = {'.gz': 'gzip',
+                    '.bz2': 'bz2',
+                    '.xz': 'xz',
+                    '.zst': 'zstd'}
+
+
+def detect_compression(path):
+    """
+    Determine the compression of a file from its leading bytes
+
+    :return: 'gzip', 'bz2', 'xz', 'zstd' or None
+    """
+    with open(path, 'rb') as f:
+        head = f.read(6)
+
+    for magic, name in _MAGIC:
+        if head.startswith(magic):
+            return name
+
+    return None
+
+
+def strip_compression_ext(path):
+    """
+    Remove a trailing compression extension, data.json.gz -> data.json
+    """
+    for ext in COMPRESSED_EXTS:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+
+    return path
+
+
+def find_input(path):
+    """
+    Locate path, or a compressed version of it
+
+    :return: the existing file path or None
+    """
+    if os.path.exists(path):
+        return path
+
+    for ext in COMPRESSED_EXTS:
+        if os.path.exists(path + ext):
+            return path + ext
+
+    return None
+
+
+def open_input(path):
+    """
+    Open a file for binary reading, transparently stream decompressing it if
+    it is gzip, bz2, xz or zstd compressed
+
+    :return: file like object
+    """
+    compression = detect_compression(path)
+
+    if compression is None:
+        return open(path, 'rb')
+    elif compression == 'gzip':
+        return gzip.GzipFile(path, 'rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(path, 'rb')
+    elif compression == 'xz':
+        if lzma is None:
+            raise IOError('lzma is not available to read {}'.format(path))
+        return lzma.LZMAFile(path, 'rb')
+    else:
+        if zstandard is None:
+            raise IOError('zstandard is not available to read {}'.format(path))
+        return _ZstdReader(path)
+
+
+def open_output(path, compression=None, level=None):
+    """
+    Open a file for binary writing, optionally compressed
+
+    :param path: should already carry the matching extension
+    :param compression: None, 'gzip', 'bz2', 'xz' or 'zstd'
+    :param level: compression level, library default if None
+    :return: file like object
+    """
+    if compression is None:
+        return open(path, 'wb')
+    elif compression == 'gzip':
+        return gzip.GzipFile(path, 'wb', compresslevel=level or 9)
+    elif compression == 'bz2':
+        return bz2.BZ2File(path, 'wb', compresslevel=level or 9)
+    elif compression == 'xz':
+        if lzma is None:
+            raise IOError('lzma is not available to write {}'.format(path))
+        return lzma.LZMAFile(path, 'wb', preset=level)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise IOError('zstandard is not available to write {}'.format(path))
+        return _ZstdWriter(path, level or 3)
+    else:
+        raise ValueError('Unknown compression: {}'.format(compression))
+
+
+def compression_ext(compression):
+    """
+    File extension used for the given compression
+    """
+    if compression is None:
+        return ''
+
+    for ext, name in _EXT_COMPRESSION.items():
+        if name == compression:
+            return ext
+
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+
+def read_json(path):
+    with open_input(path) as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+class _ZstdReader(object):
+    def __init__(self, path):
+        self.fh = open(path, 'rb')
+        self.reader = zstandard.ZstdDecompressor().stream_reader(self.fh)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.reader.read(1 << 20)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+
+        return self.reader.read(size)
+
+    def close(self):
+        self.reader.close()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _ZstdWriter(object):
+    def __init__(self, path, level):
+        self.fh = open(path, 'wb')
+        self.writer = (zstandard.ZstdCompressor(level=level)
+                       .stream_writer(self.fh))
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def close(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def queue_depth(queue):
+    """
+    qsize is not implemented on every platform
+    """
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return 0
+
+
+def start_feeder(queue, items, kill_count):
+    """
+    Put items and then kill_count 'kill' sentinels on a queue from a
+    background thread, so a bounded queue can be fed without blocking the
+    caller
+
+    :return: the started thread
+    """
+    def feed():
+        for item in items:
+            queue.put(item)
+
+        for _ in range(kill_count):
+            queue.put('kill')
+
+    thread = threading.Thread(target=feed, name='QueueFeeder')
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def queue_size(memory_budget, item_nbytes):
+    """
+    How many items of the given size fit within the memory budget, at least 1
+    """
+    return max(1, int(memory_budget // item_nbytes))
+
+
+def is_kill(msg):
+    """
+    Workers signal they are finished with 'kill', or ('kill', seconds
+    spent blocked on a full output queue)
+    """
+    if isinstance(msg, tuple):
+        return len(msg) == 2 and msg[0] == 'kill'
+
+    return msg == 'kill'
@@ -3,12 +3,53 @@ import os
 import multiprocessing as mp
 from logger import log
 from functools import partial
+import struct
 import sys
+import zlib
 
 import numpy as np
 
+import commons
 
-def run(input_path, output_path, cpus):
+
+BAND_NAMES = ('blue',
+              'green',
+              'red',
+              'nir',
+              'swir1',
+              'swir2',
+              'thermal')
+
+# Compact binary chip layout
+BINARY_MAGIC = b'CCDC'
+BINARY_VERSION = 2
+BINARY_EXT = '.ccd'
+
+MODEL_INT_FIELDS = ('start_day', 'end_day', 'break_day',
+                    'observation_count', 'curve_qa')
+MODEL_FLOAT_FIELDS = ('change_probability',)
+BAND_FLOAT_FIELDS = ('magnitude', 'rmse', 'intercept')
+BAND_KEYS = set(BAND_FLOAT_FIELDS + ('coefficients',))
+MODEL_KEYS = set(MODEL_INT_FIELDS + MODEL_FLOAT_FIELDS + BAND_NAMES)
+
+# Numeric columns outside of MODEL_INT_FIELDS, each stored in the narrowest
+# of these that keeps every value, and its JSON type, exactly
+NUMERIC_COLUMNS = MODEL_FLOAT_FIELDS + BAND_FLOAT_FIELDS + ('coefficients',)
+COLUMN_DTYPES = ('<i4', '<f4', '<f8')
+
+INT32_MIN = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+
+
+def run(input_path, output_path, cpus, fmt='json', compression=None):
+    """
+    Rewrite every chip in input_path to output_path
+
+    :param fmt: 'json' or 'binary'
+    :param compression: optionally compress JSON output, 'gzip', 'bz2',
+        'xz' or 'zstd'
+    :return: dictionary of size statistics
+    """
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
@@ -16,29 +57,59 @@ def run(input_path, output_path, cpus):
 
     files = [os.path.join(input_path, f) for f in os.listdir(input_path)]
 
-    pool.map(worker, ((f, output_path) for f in files))
+    sizes = pool.map(worker, ((f, output_path, fmt, compression)
+                              for f in files))
+    sizes = [s for s in sizes if s is not None]
+
+    stats = {'files': len(sizes),
+             'input_bytes': sum(s[0] for s in sizes),
+             'output_bytes': sum(s[1] for s in sizes)}
+    stats['ratio'] = (float(stats['input_bytes']) / stats['output_bytes']
+                      if stats['output_bytes'] else 0)
+
+    log.info('Wrote {files} files, {input_bytes} -> {output_bytes} bytes, '
+             'ratio {ratio:.2f}'.format(**stats))
+
+    return stats
 
 
 def worker(args):
-    file_path, output_path = args
+    file_path, output_path, fmt, compression = args
     result_chip = get_data(file_path)
-    filename = os.path.split(file_path)[-1]
+    filename = commons.strip_compression_ext(os.path.split(file_path)[-1])
     log.debug('Working file: {}'.format(filename))
 
     if result_chip is None or len(result_chip) == 0:
         log.debug('No results for {}'.format(filename))
         return
 
-    outls = [simplify_mask(result) for result in result_chip]
+    if fmt == 'binary':
+        outfile = os.path.join(output_path, binary_filename(filename))
+        log.debug('Saving to {}'.format(outfile))
+        write_binary(result_chip, outfile)
+    else:
+        outls = [simplify_mask(result) for result in result_chip]
 
-    outfile = os.path.join(output_path, filename)
-    log.debug('Saving to {}'.format(outfile))
-    write_json(outls, outfile)
+        outfile = os.path.join(output_path,
+                               filename + commons.compression_ext(compression))
+        log.debug('Saving to {}'.format(outfile))
+        write_json(outls, outfile, compression)
+
+    return os.path.getsize(file_path), os.path.getsize(outfile)
 
 
 def get_data(path):
-    with open(path, 'r') as f:
-        return json.load(f)
+    """
+    Read a chip, either as JSON or the compact binary layout, which may be
+    compressed
+    """
+    with commons.open_input(path) as f:
+        data = f.read()
+
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return unpack_chip(data)
+
+    return json.loads(data.decode('utf-8'))
 
 
 def simplify_mask(result):
@@ -52,15 +123,412 @@ def simplify_mask(result):
     return json.dumps(models, separators=(',', ':'))
 
 
-def write_json(data, output_path):
-    with open(output_path, 'w') as f:
-        json.dump(data, f, separators=(',', ':'))
-        # f.write(json.dumps(data, separators=(',', ':')))
+def write_json(data, output_path, compression=None):
+    with commons.open_output(output_path, compression) as f:
+        f.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+def binary_filename(filename):
+    if filename.endswith('.json'):
+        filename = filename[:-5]
+
+    return filename + BINARY_EXT
+
+
+def write_binary(chip, output_path):
+    with open(output_path, 'wb') as f:
+        f.write(pack_chip(chip))
+
+
+def _is_int(val):
+    return (isinstance(val, (int, np.integer)) and
+            not isinstance(val, bool) and
+            INT32_MIN <= val <= INT32_MAX)
+
+
+def _is_float(val):
+    return isinstance(val, (int, float)) and not isinstance(val, bool)
+
+
+def _mask_type(mask):
+    if all(m is True or m is False for m in mask):
+        return 'bool'
+    elif all(_is_int(m) and m in (0, 1) for m in mask):
+        return 'int'
+
+    return None
+
+
+def _split_result(result):
+    """
+    Break a result into the parts that can be stored as fixed width arrays,
+    returns None if anything about it falls outside the known layout, in
+    which case it is stored verbatim
+    """
+    if result.get('result_ok') is not True:
+        return None
+
+    try:
+        models = json.loads(result['result'])
+    except (TypeError, ValueError):
+        return None
+
+    if not isinstance(models, dict):
+        return None
+
+    change_models = models.pop('change_models', None)
+    mask = models.pop('processing_mask', None)
+
+    if not isinstance(change_models, list):
+        return None
+
+    mask_type = None
+    if mask is not None:
+        if not isinstance(mask, list):
+            return None
+
+        mask_type = _mask_type(mask)
+
+        if mask_type is None:
+            return None
+
+    for model in change_models:
+        if not isinstance(model, dict) or set(model) != MODEL_KEYS:
+            return None
+        if not all(_is_int(model[f]) for f in MODEL_INT_FIELDS):
+            return None
+        if not all(_is_float(model[f]) for f in MODEL_FLOAT_FIELDS):
+            return None
+
+        for b in BAND_NAMES:
+            band = model[b]
+
+            if not isinstance(band, dict) or set(band) != BAND_KEYS:
+                return None
+            if not all(_is_float(band[f]) for f in BAND_FLOAT_FIELDS):
+                return None
+            if (not isinstance(band['coefficients'], list) or
+                    len(band['coefficients']) > 255 or
+                    not all(_is_float(c) for c in band['coefficients'])):
+                return None
+
+    return models, change_models, mask, mask_type
+
+
+def _result_columns(change_models):
+    """
+    Flatten the numeric values of a result's change models by column
+    """
+    columns = dict((c, []) for c in NUMERIC_COLUMNS)
+
+    for model in change_models:
+        for f in MODEL_FLOAT_FIELDS:
+            columns[f].append(model[f])
+
+        for b in BAND_NAMES:
+            for f in BAND_FLOAT_FIELDS:
+                columns[f].append(model[b][f])
+
+            columns['coefficients'].extend(model[b]['coefficients'])
+
+    return columns
+
+
+def _fits_column(values, is_float):
+    """
+    Whether the values come back with the same JSON type from a float, or
+    an integer, column
+    """
+    if is_float:
+        return all(isinstance(v, float) for v in values)
+
+    return all(_is_int(v) for v in values)
+
+
+def _column_dtype(values, is_float):
+    """
+    Narrowest dtype that holds every value of a column exactly
+    """
+    if not is_float:
+        return '<i4'
+
+    arr = np.array(values, dtype='<f8')
+    with np.errstate(over='ignore', invalid='ignore'):
+        narrow = arr.astype('<f4').astype('<f8')
+
+    if np.all((narrow == arr) | (np.isnan(arr) & np.isnan(narrow))):
+        return '<f4'
+
+    return '<f8'
+
+
+def pack_chip(chip, level=6):
+    """
+    Pack a results chip into the compact binary layout
+
+    MAGIC | version | zlib(header length | JSON header | arrays)
+
+    Model values are stored as fixed width columns across the whole chip,
+    processing masks are bit packed. Columns holding only integers are
+    stored as integers, float columns as float32 when that is lossless.
+    Anything outside of the known layout, or a result with integers in an
+    otherwise float column, is kept verbatim in the JSON header.
+
+    :param chip: list of result dictionaries
+    :param level: zlib compression level
+    :return: bytes
+    """
+    splits = []
+    for result in chip:
+        split = _split_result(result)
+        columns = _result_columns(split[1]) if split is not None else None
+        splits.append((result, split, columns))
+
+    float_columns = set(c for _, split, columns in splits
+                        if split is not None
+                        for c in NUMERIC_COLUMNS
+                        if any(isinstance(v, float) for v in columns[c]))
+
+    header = []
+    ints, ncoefs, masks = [], [], []
+    values = dict((c, []) for c in NUMERIC_COLUMNS)
+    coefs = []
+
+    for result, split, columns in splits:
+        if split is None or not all(_fits_column(columns[c],
+                                                 c in float_columns)
+                                    for c in NUMERIC_COLUMNS):
+            header.append({'verbatim': result})
+            continue
+
+        models, change_models, mask, mask_type = split
+
+        entry = dict((k, v) for k, v in result.items() if k != 'result')
+        header.append({'packed': entry,
+                       'extra': models,
+                       'n_models': len(change_models),
+                       'n_obs': len(mask) if mask is not None else None,
+                       'mask': mask_type})
+
+        for model in change_models:
+            ints.append([model[f] for f in MODEL_INT_FIELDS])
+            coefs.append([model[b]['coefficients'] for b in BAND_NAMES])
+            ncoefs.append([len(c) for c in coefs[-1]])
+
+        for c in NUMERIC_COLUMNS:
+            values[c].extend(columns[c])
+
+        if mask is not None:
+            masks.extend(mask)
+
+    dtypes = [_column_dtype(values[c], c in float_columns)
+              for c in NUMERIC_COLUMNS]
+
+    n_coef = max([max(n) for n in ncoefs] or [0])
+    coef_arr = np.zeros(shape=(len(coefs), len(BAND_NAMES), n_coef),
+                        dtype=dtypes[-1])
+    for i, model_coefs in enumerate(coefs):
+        for j, c in enumerate(model_coefs):
+            coef_arr[i, j, :len(c)] = c
+
+    arrays = [np.array(ints, dtype='<i4').reshape(-1, len(MODEL_INT_FIELDS))]
+    arrays.extend(np.array(values[c], dtype=dt).reshape(-1, len(BAND_NAMES))
+                  if c in BAND_FLOAT_FIELDS else
+                  np.array(values[c], dtype=dt)
+                  for c, dt in zip(NUMERIC_COLUMNS[:-1], dtypes))
+    arrays.extend((coef_arr,
+                   np.array(ncoefs, dtype='<u1').reshape(-1, len(BAND_NAMES)),
+                   np.packbits(np.array(masks, dtype=bool))))
+
+    head = json.dumps({'results': header,
+                       'n_models': len(ints),
+                       'n_coef': n_coef,
+                       'n_obs': len(masks),
+                       'dtypes': dtypes},
+                      separators=(',', ':')).encode('utf-8')
+
+    body = b''.join([struct.pack('<I', len(head)), head] +
+                    [a.tobytes() for a in arrays])
+
+    return (BINARY_MAGIC + struct.pack('<B', BINARY_VERSION) +
+            zlib.compress(body, level))
+
+
+def _take(body, offset, dtype, shape):
+    count = int(np.prod(shape))
+    arr = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+
+    return arr.reshape(shape), offset + arr.nbytes
+
+
+def _take_columns(body, offset, head, version):
+    """
+    Read the numeric columns, version 1 chips kept every float column as
+    float64 in a (models, 1) and a (models, bands, fields) array
+    """
+    m = head['n_models']
+    n_bands = len(BAND_NAMES)
+    columns = {}
+
+    if version == 1:
+        floats, offset = _take(body, offset, '<f8',
+                               (m, len(MODEL_FLOAT_FIELDS)))
+        bands, offset = _take(body, offset, '<f8',
+                              (m, n_bands, len(BAND_FLOAT_FIELDS)))
+
+        for i, f in enumerate(MODEL_FLOAT_FIELDS):
+            columns[f] = floats[:, i]
+        for i, f in enumerate(BAND_FLOAT_FIELDS):
+            columns[f] = bands[:, :, i]
+
+        dtypes = ['<f8'] * len(NUMERIC_COLUMNS)
+    else:
+        dtypes = head['dtypes']
+
+        for c, dt in zip(NUMERIC_COLUMNS[:-1], dtypes):
+            shape = (m, n_bands) if c in BAND_FLOAT_FIELDS else (m,)
+            columns[c], offset = _take(body, offset, dt, shape)
+
+    columns['coefficients'], offset = _take(body, offset, dtypes[-1],
+                                            (m, n_bands, head['n_coef']))
+
+    return dict((c, a.tolist()) for c, a in columns.items()), offset
+
+
+def unpack_chip(data):
+    """
+    Inverse of pack_chip, returns the list of result dictionaries with the
+    'result' value as a compact JSON string
+
+    :param data: bytes
+    :return: list
+    """
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError('Not a binary chip')
+
+    version = struct.unpack('<B', data[len(BINARY_MAGIC):len(BINARY_MAGIC) + 1])[0]
+    if version not in (1, BINARY_VERSION):
+        raise ValueError('Unsupported binary chip version: {}'.format(version))
+
+    body = zlib.decompress(data[len(BINARY_MAGIC) + 1:])
+
+    head_len = struct.unpack('<I', body[:4])[0]
+    head = json.loads(body[4:4 + head_len].decode('utf-8'))
+
+    m = head['n_models']
+    n_bands = len(BAND_NAMES)
+    offset = 4 + head_len
+
+    ints, offset = _take(body, offset, '<i4', (m, len(MODEL_INT_FIELDS)))
+    columns, offset = _take_columns(body, offset, head, version)
+    ncoefs, offset = _take(body, offset, '<u1', (m, n_bands))
+    packed, offset = _take(body, offset, '<u1', ((head['n_obs'] + 7) // 8,))
+
+    masks = np.unpackbits(packed)[:head['n_obs']].tolist()
+    ints, ncoefs = ints.tolist(), ncoefs.tolist()
+
+    chip = []
+    model_idx = 0
+    obs_idx = 0
+    for entry in head['results']:
+        if 'verbatim' in entry:
+            chip.append(entry['verbatim'])
+            continue
+
+        change_models = []
+        for i in range(model_idx, model_idx + entry['n_models']):
+            model = dict(zip(MODEL_INT_FIELDS, ints[i]))
+            model.update((f, columns[f][i]) for f in MODEL_FLOAT_FIELDS)
+
+            for j, b in enumerate(BAND_NAMES):
+                model[b] = dict((f, columns[f][i][j])
+                                for f in BAND_FLOAT_FIELDS)
+                model[b]['coefficients'] = \
+                    columns['coefficients'][i][j][:ncoefs[i][j]]
+
+            change_models.append(model)
+        model_idx += entry['n_models']
+
+        models = entry['extra']
+        models['change_models'] = change_models
+
+        if entry['mask'] is not None:
+            mask = masks[obs_idx:obs_idx + entry['n_obs']]
+            obs_idx += entry['n_obs']
+
+            if entry['mask'] == 'bool':
+                mask = [bool(b) for b in mask]
+
+            models['processing_mask'] = mask
+
+        result = entry['packed']
+        result['result'] = json.dumps(models, separators=(',', ':'))
+        chip.append(result)
+
+    return chip
+
+
+def _same_value(a, b):
+    """
+    Exact comparison of decoded JSON values, an integer never equals a float
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        return (set(a) == set(b) and
+                all(_same_value(a[k], b[k]) for k in a))
+    elif isinstance(a, list) and isinstance(b, list):
+        return (len(a) == len(b) and
+                all(_same_value(i, j) for i, j in zip(a, b)))
+    elif isinstance(a, float) and isinstance(b, float):
+        return a == b or (a != a and b != b)
+
+    return type(a) == type(b) and a == b
+
+
+def results_equal(chip_a, chip_b):
+    """
+    Compare two chips by value, decoding the nested 'result' strings
+    """
+    if len(chip_a) != len(chip_b):
+        return False
+
+    for a, b in zip(chip_a, chip_b):
+        a, b = dict(a), dict(b)
+
+        if a.get('result_ok') is True and b.get('result_ok') is True:
+            if not _same_value(json.loads(a.pop('result')),
+                               json.loads(b.pop('result'))):
+                return False
+
+        if not _same_value(a, b):
+            return False
+
+    return True
+
+
+def convert(input_file, output_file, fmt='binary'):
+    """
+    Lossless conversion of a single chip between JSON and the binary layout
+
+    :param input_file: chip in either layout
+    :param output_file:
+    :param fmt: layout to write, 'binary' or 'json'
+    """
+    chip = get_data(input_file)
+
+    if fmt == 'binary':
+        write_binary(chip, output_file)
+    else:
+        write_json(chip, output_file)
+
+    if not results_equal(chip, get_data(output_file)):
+        raise ValueError('Round trip mismatch converting {}'.format(input_file))
 
 
 if __name__ == '__main__':
     indir = sys.argv[1]
     outdir = sys.argv[2]
     cpu_count = int(sys.argv[3])
+    out_fmt = sys.argv[4] if len(sys.argv) > 4 else 'json'
+    out_compression = sys.argv[5] if len(sys.argv) > 5 else None
 
-    run(indir, outdir, cpu_count)
+    run(indir, outdir, cpu_count, out_fmt, out_compression)
@@ -0,0 +1,132 @@
+"""
+Ordinal date lookups
+
+Year and day of year for every ordinal in the range the products cover are
+computed once, so converting dates, singly or as arrays, is an index into
+a table instead of building a date per call.
+"""
+
+import numbers
+import datetime as dt
+
+import numpy as np
+
+
+FIRST_ORDINAL = dt.date(year=1900, month=1, day=1).toordinal()
+LAST_ORDINAL = dt.date(year=2100, month=12, day=31).toordinal()
+
+_EPOCH_ORDINAL = dt.date(year=1970, month=1, day=1).toordinal()
+
+
+def _compute(ord_dates):
+    days = (np.asarray(ord_dates, dtype=np.int64) - _EPOCH_ORDINAL).astype('datetime64[D]')
+    years = days.astype('datetime64[Y]')
+
+    return (years.astype(np.int64) + 1970,
+            (days - years.astype('datetime64[D]')).astype(np.int64) + 1)
+
+
+_YEARS, _DOYS = _compute(np.arange(FIRST_ORDINAL, LAST_ORDINAL + 1))
+_YEARS = _YEARS.astype(np.int32)
+_DOYS = _DOYS.astype(np.int32)
+
+# Indexing a list is quicker than a numpy array for single dates
+_YEAR_LIST = _YEARS.tolist()
+_DOY_LIST = _DOYS.tolist()
+_SPAN = len(_YEAR_LIST)
+
+
+def _lookup(table, ord_dates):
+    ords = np.asarray(ord_dates, dtype=np.int64)
+    idx = ords - FIRST_ORDINAL
+
+    outside = (idx < 0) | (idx >= len(table))
+    if not outside.any():
+        return table[idx]
+
+    # Unbroken segments have a break_day of 0 or less, only the dates off
+    # the table are computed and the rest still come from it
+    ret = np.array(table[np.clip(idx, 0, len(table) - 1)])
+    years, doys = _compute(np.maximum(ords[outside], 1))
+    ret[outside] = years if table is _YEARS else doys
+
+    return ret
+
+
+def year(ord_date):
+    """
+    Calendar year of an ordinal, or an array of them
+    """
+    if type(ord_date) is int:
+        idx = ord_date - FIRST_ORDINAL
+        if 0 <= idx < _SPAN:
+            return _YEAR_LIST[idx]
+        return dt.date.fromordinal(ord_date).year
+
+    if isinstance(ord_date, numbers.Integral):
+        return year(int(ord_date))
+
+    return _lookup(_YEARS, ord_date)
+
+
+def doy(ord_date):
+    """
+    Day of year, 1 based, of an ordinal or an array of them
+    """
+    if type(ord_date) is int:
+        idx = ord_date - FIRST_ORDINAL
+        if 0 <= idx < _SPAN:
+            return _DOY_LIST[idx]
+        return dt.date.fromordinal(ord_date).timetuple().tm_yday
+
+    if isinstance(ord_date, numbers.Integral):
+        return doy(int(ord_date))
+
+    return _lookup(_DOYS, ord_date)
+
+
+def year_doy(ord_dates):
+    """
+    :return: array of years, array of days of year
+    """
+    return _lookup(_YEARS, ord_dates), _lookup(_DOYS, ord_dates)
+
+
+FREQUENCIES = ('annual', 'monthly', 'daily')
+
+
+def query_dates(freq='annual', start_year=1984, end_year=2015, month=7, day=1):
+    """
+    Ordinal dates to evaluate the products on, in ascending order
+
+    :param freq: 'annual' for month/day of every year, 'monthly' for day of
+        every month, 'daily' for every day
+    :return: tuple of ordinals
+    """
+    if freq == 'annual':
+        return tuple(dt.date(year=y, month=month, day=day).toordinal()
+                     for y in range(start_year, end_year + 1))
+    elif freq == 'monthly':
+        return tuple(dt.date(year=y, month=m, day=day).toordinal()
+                     for y in range(start_year, end_year + 1)
+                     for m in range(1, 13))
+    elif freq == 'daily':
+        return tuple(range(dt.date(year=start_year, month=1, day=1).toordinal(),
+                           dt.date(year=end_year, month=12, day=31).toordinal() + 1))
+
+    raise ValueError('Unknown frequency: {}'.format(freq))
+
+
+def date_labels(ord_dates):
+    """
+    Names for the products of each date, the year when there is one date a
+    year, YYYY-MM when there is one a month, otherwise YYYY-MM-DD
+    """
+    days = [dt.date.fromordinal(d) for d in ord_dates]
+
+    if len(set(d.year for d in days)) == len(days):
+        return tuple(d.year for d in days)
+    elif len(set((d.year, d.month) for d in days)) == len(days):
+        return tuple('{:04d}-{:02d}'.format(d.year, d.month) for d in days)
+
+    return tuple(d.isoformat() for d in days)
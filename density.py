@@ -1,6 +1,7 @@
 import os
 import sys
 import multiprocessing as mp
+from functools import partial
 
 import numpy as np
 
@@ -9,17 +10,35 @@ from logger import log
 import geo_utils
 
 
-def worker(files):
+def worker(files, aoi=None):
+    """
+    :param aoi: geo_utils.AOI, only its window is read and only its pixels
+        are counted
+    """
     log.debug('Reading file {}'.format(files))
 
-    ret = np.zeros(shape=(5000, 5000), dtype=bool)
+    if aoi is None:
+        ret = np.zeros(shape=(5000, 5000), dtype=bool)
+    else:
+        ret = np.zeros(shape=aoi.mask.shape, dtype=bool)
+
     for f in files:
-        ds = geo_utils.get_raster_ds(f)
+        ds = geo_utils.get_raster_ds(geo_utils.vsi_path(f))
         band = ds.GetRasterBand(8)
-        arr = band.ReadAsArray()
+
+        if aoi is None:
+            arr = band.ReadAsArray()
+        else:
+            win = aoi.window
+            arr = band.ReadAsArray(win.start_col, win.start_row,
+                                   win.end_col - win.start_col,
+                                   win.end_row - win.start_row)
 
         ret[(arr == 0) | (arr == 1)] = 1
 
+    if aoi is not None:
+        ret &= aoi.mask
+
     return ret
 
 
@@ -27,7 +46,7 @@ def date_from_filename(filename):
     return int(filename[9:16])
 
 
-def density_map(array, outdir, h, v):
+def density_map(array, outdir, h, v, window=None):
     log.debug('Outputting density map')
     outfile = os.path.join(outdir, 'density.tif')
     # out_arr = np.zeros(shape=(5000, 5000), dtype=np.int)
@@ -35,7 +54,7 @@ def density_map(array, outdir, h, v):
     # for arr in arrays:
     #     out_arr += arr
 
-    ds = cm.create_geotif(outfile, 'ChangeMap', h, v)
+    ds = cm.create_geotif(outfile, 'ChangeMap', h, v, window=window)
     band = ds.GetRasterBand(1)
     band.WriteArray(array)
 
@@ -48,7 +67,8 @@ def input_queue(indir):
 
     for root, dirs, files in os.walk(indir):
         for f in files:
-            if f[-8:] == 'MTLstack':
+            # GDAL can only stream gzip compressed stacks
+            if f[-8:] == 'MTLstack' or f[-11:] == 'MTLstack.gz':
                 jdate = date_from_filename(f)
 
                 if jdate not in fqueue:
@@ -77,22 +97,29 @@ class AsyncResults(object):
         return self.it.get()
 
 
-def run(indir, output_dir, h, v, cpus):
-
+def run(indir, output_dir, h, v, cpus, aoi=None):
+    """
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi. Only
+        its window is read and the density raster covers just that window
+    """
     log.debug('Queueing files')
     queue = input_queue(indir)
 
     log.debug('Number of files queued: {}'.format(len(queue)))
 
+    aoi = geo_utils.tile_aoi(h, v, aoi)
+
     pool = mp.Pool(processes=cpus)
-    async_res = pool.map_async(worker, (queue[q] for q in queue))
+    async_res = pool.map_async(partial(worker, aoi=aoi),
+                               (queue[q] for q in queue))
 
     results = AsyncResults(async_res)
 
     reduced = reduce(reduce_results, results)
 
     log.debug('Outputting map')
-    density_map(reduced, output_dir, h, v)
+    density_map(reduced, output_dir, h, v,
+                window=aoi.window if aoi is not None else None)
 
 
 if __name__ == '__main__':
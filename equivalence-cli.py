@@ -0,0 +1,85 @@
+import sys
+import json
+import argparse
+import dates
+import equivalence as eq
+from logger import set_level
+
+
+parser = argparse.ArgumentParser(
+        description='Check that alternative engines match the reference '
+                    'implementation on synthetic or recorded chips, and '
+                    'compare their throughput. Exits non-zero on any '
+                    'mismatch or any check that did not run.')
+
+parser.add_argument('--checks', help='Comma separated checks to run, from: '
+                                     '{}'.format(', '.join(eq.CHECKS)),
+                    default=','.join(eq.CHECKS), metavar='')
+parser.add_argument('--candidate',
+                    help='Replace the candidate of a check, ie '
+                         'change=mymodule:changemap_vals. May be repeated.',
+                    action='append', default=[], metavar='')
+parser.add_argument('--json', help='Directory of recorded JSON chips, '
+                                   'synthetic ones are used if not given.',
+                    default=None, metavar='')
+parser.add_argument('--class', dest='class_input',
+                    help='Directory of recorded classification pickles, '
+                         'synthetic ones are used if not given.',
+                    default=None, metavar='')
+parser.add_argument('--tile', help='ARD h,v of the chips.',
+                    default='5,2', metavar='')
+parser.add_argument('-c', '--chips', help='Number of synthetic chips.',
+                    default=2, type=int, metavar='')
+parser.add_argument('--pixels', help='Pixels with results per synthetic '
+                                     'chip.',
+                    default=10000, type=int, metavar='')
+parser.add_argument('--seed', default=0, type=int, metavar='')
+parser.add_argument('--frequency',
+                    help='Query dates to compare on: annual, monthly or daily.',
+                    default='annual', choices=dates.FREQUENCIES, metavar='')
+parser.add_argument('--rtol', help='Relative tolerance for float values.',
+                    default=eq.RTOL, type=float, metavar='')
+parser.add_argument('--atol', help='Absolute tolerance for float values.',
+                    default=eq.ATOL, type=float, metavar='')
+parser.add_argument('--save', help='Write the full report to this JSON file.',
+                    default=None, metavar='')
+parser.add_argument('--log-level', default='INFO', metavar='')
+
+args = parser.parse_args()
+
+set_level(args.log_level)
+
+h, v = [int(i) for i in args.tile.split(',')]
+candidates = dict(c.split('=', 1) for c in args.candidate)
+
+try:
+    results = eq.run(checks=args.checks.split(','), h=h, v=v, chips=args.chips,
+                     seed=args.seed, json_dir=args.json,
+                     class_dir=args.class_input,
+                     query_dates=dates.query_dates(args.frequency),
+                     candidates=candidates, rtol=args.rtol, atol=args.atol,
+                     pixels=args.pixels)
+except (ValueError, ImportError, AttributeError) as e:
+    parser.error(str(e))
+
+print('{:<10}{:>8}{:>14}{:>14}{:>10}{:>12}'.format('check', 'items', 'ref/sec',
+                                                   'cand/sec', 'speedup',
+                                                   'mismatches'))
+for check in args.checks.split(','):
+    res = results['checks'][check]
+
+    if 'equivalent' in res:
+        print('{:<10}{:>8}{:>14.2f}{:>14.2f}{:>10.2f}{:>12}'
+              .format(check, res['items'], res['reference_per_sec'],
+                      res['candidate_per_sec'], res['speedup'],
+                      res['mismatches']))
+        for detail in res['details']:
+            print('    {}'.format(detail))
+    else:
+        print('{:<10}{}'.format(check, res.get('skipped', res.get('error'))))
+
+if args.save:
+    with open(args.save, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+sys.exit(0 if eq.equivalent(results) else 1)
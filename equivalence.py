@@ -0,0 +1,616 @@
+"""
+Reference equivalence checks for alternative engines
+
+Runs the reference implementation and a candidate on the same chips,
+synthetic ones from benchmark or recorded ones, compares what they produce
+exactly for integers and within a tolerance for floats, and times both.
+
+    change   baseline_change, the original per-pixel loop, against
+             change_maps.changemap_vals with the 'sweep' engine
+    class    baseline_class, the original per-pixel loop, against
+             class_maps.classmap_vals with the 'sweep' engine
+    records  json_matlab.chip_to_records against the same rec_cg records
+             after save_record and load_record
+    rowfile  changemap_vals on the chips against matmap_vals on the row
+             files json_matlab builds from them
+    writer   output_chip opening the rasters for every chip against holding
+             them open
+
+Any candidate can be replaced by a function with the same signature as the
+default one, given as module:function, so a new engine can be proven
+against the reference before it is used.
+
+Synthetic inputs include edge chips, see write_edge_chips, with pixels that
+have no results or no models and chips with nothing in them. A check that
+is skipped or fails to run counts against equivalence.
+"""
+
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import importlib
+from collections import OrderedDict
+from timeit import default_timer
+
+import numpy as np
+
+from logger import log
+
+
+CHECKS = ('change', 'class', 'records', 'rowfile', 'writer')
+
+RTOL = 1e-5
+ATOL = 1e-6
+
+# Mismatches described in a report, the rest are only counted
+MAX_DETAILS = 20
+
+
+def resolve(spec):
+    """
+    :param spec: module:function, or a callable which is returned as is
+    """
+    if callable(spec):
+        return spec
+
+    module, _, name = spec.partition(':')
+
+    return getattr(importlib.import_module(module), name)
+
+
+def compare_arrays(name, ref, cand, rtol=RTOL, atol=ATOL):
+    """
+    :return: list of mismatch descriptions, empty if equivalent
+    """
+    ref = np.asarray(ref)
+    cand = np.asarray(cand)
+
+    if ref.shape != cand.shape:
+        return ['{}: shape {} != {}'.format(name, ref.shape, cand.shape)]
+
+    if ref.dtype.kind in 'fc' or cand.dtype.kind in 'fc':
+        bad = ~np.isclose(cand, ref, rtol=rtol, atol=atol, equal_nan=True)
+    else:
+        bad = ref != cand
+
+    count = int(np.count_nonzero(bad))
+    if not count:
+        return []
+
+    idx = np.unravel_index(np.argmax(bad), bad.shape) if bad.ndim else ()
+
+    return ['{}: {} of {} values differ, first at {} {!r} != {!r}'
+            .format(name, count, bad.size, idx, ref[idx], cand[idx])]
+
+
+def compare_maps(name, ref, cand, rtol=RTOL, atol=ATOL):
+    """
+    Map dictionaries as made by changemap_vals and classmap_vals, a product
+    left out of one is compared as zeros, which is what output_chip leaves
+    in the raster for it
+    """
+    ret = []
+
+    for key in ('chip_x', 'chip_y'):
+        if ref.get(key) != cand.get(key):
+            ret.append('{} {}: {} != {}'.format(name, key, ref.get(key),
+                                                cand.get(key)))
+
+    prods = set(ref) | set(cand)
+    prods.discard('chip_x')
+    prods.discard('chip_y')
+
+    for prod in sorted(prods):
+        if prod not in ref or prod not in cand:
+            given = ref[prod] if prod in ref else cand[prod]
+            zeros = dict((label, np.zeros_like(vals)) for label, vals in given.items())
+
+            r, c = (given, zeros) if prod in ref else (zeros, given)
+            for label in sorted(given, key=str):
+                ret.extend(compare_arrays('{} {} {}'.format(name, prod, label),
+                                          r[label], c[label], rtol, atol))
+            continue
+
+        labels = set(ref[prod]) | set(cand[prod])
+        for label in sorted(labels, key=str):
+            if label not in ref[prod] or label not in cand[prod]:
+                ret.append('{} {} {}: only in the {}'
+                           .format(name, prod, label,
+                                   'reference' if label in ref[prod] else 'candidate'))
+                continue
+
+            ret.extend(compare_arrays('{} {} {}'.format(name, prod, label),
+                                      ref[prod][label], cand[prod][label],
+                                      rtol, atol))
+
+    return ret
+
+
+def compare_records(name, ref, cand, rtol=RTOL, atol=ATOL):
+    """
+    Dictionaries of row -> rec_cg records, as made by chip_to_records
+    """
+    ret = []
+
+    for row in sorted(set(ref) | set(cand)):
+        if row not in ref or row not in cand:
+            ret.append('{} row {}: only in the {}'
+                       .format(name, row, 'reference' if row in ref else 'candidate'))
+            continue
+
+        r = _concat(ref[row])
+        c = _concat(cand[row])
+
+        if r.dtype.names != c.dtype.names:
+            ret.append('{} row {}: fields {} != {}'.format(name, row,
+                                                           r.dtype.names,
+                                                           c.dtype.names))
+            continue
+
+        for field in r.dtype.names:
+            ret.extend(compare_arrays('{} row {} {}'.format(name, row, field),
+                                      r[field], c[field], rtol, atol))
+
+    return ret
+
+
+def _concat(records):
+    if isinstance(records, np.ndarray):
+        return records
+
+    return np.concatenate(records)
+
+
+def _timed(func, items):
+    start = default_timer()
+    ret = [func(item) for item in items]
+
+    return ret, default_timer() - start
+
+
+def _result(items, ref_seconds, cand_seconds, mismatches):
+    return {'items': items,
+            'reference_seconds': ref_seconds,
+            'candidate_seconds': cand_seconds,
+            'reference_per_sec': items / ref_seconds if ref_seconds else 0,
+            'candidate_per_sec': items / cand_seconds if cand_seconds else 0,
+            'speedup': ref_seconds / cand_seconds if cand_seconds else 0,
+            'mismatches': len(mismatches),
+            'details': mismatches[:MAX_DETAILS],
+            'equivalent': not mismatches}
+
+
+def baseline_change(path, query_dates):
+    """
+    changemap_vals as it was before the engines, every pixel with a result
+    is computed, even one without change models
+    """
+    import dates
+    import change_maps
+    import change_products as cp
+
+    data = change_maps.load_jsondata(change_maps.get_json(path)).flatten()
+    chip_x, chip_y = change_maps.coords_frompath(path)
+    labels = dates.date_labels(query_dates)
+
+    temp = change_maps.map_template(labels=labels)
+    temp['chip_x'] = int(chip_x)
+    temp['chip_y'] = int(chip_y)
+
+    coverage = change_maps.determine_coverage(data)
+
+    funcs = (('ChangeMap', cp.changedate_val), ('ChangeMagMap', cp.changemag_val),
+             ('QAMap', cp.qa_val), ('SegLength', cp.seglength_val),
+             ('LastChange', cp.lastchange_val))
+
+    for pix, result in enumerate(data):
+        if result:
+            row, col = divmod(pix, 100)
+            models = change_maps.pixel_models(result)
+
+            for prod, func in funcs:
+                for label, qd in zip(labels, query_dates):
+                    temp[prod][label][row, col] = func(models, qd)
+
+    return temp, coverage
+
+
+def baseline_class(path, query_dates):
+    """
+    classmap_vals as it was before the engines, every pixel in the pickle is
+    computed, even one without models
+    """
+    import dates
+    import class_maps
+    import class_products as clp
+
+    data = class_maps.open_classpickle(path)
+    chip_x, chip_y = class_maps.coords_frompath(path)
+    labels = dates.date_labels(query_dates)
+
+    temp = class_maps.map_template(labels=labels)
+    temp['chip_x'] = int(chip_x)
+    temp['chip_y'] = int(chip_y)
+
+    funcs = (('CoverPrim', clp.class_primary), ('CoverSec', clp.class_secondary),
+             ('CoverConfPrim', clp.conf_primary), ('CoverConfSec', clp.conf_secondary),
+             ('SegChange', clp.segchange))
+
+    for pix, result in enumerate(data):
+        row, col = divmod(pix, 100)
+        models = class_maps.pixel_models(result)
+
+        for prod, func in funcs:
+            for label, d in zip(labels, query_dates):
+                temp[prod][label][row, col] = func(models, d)
+
+    return temp
+
+
+def sweep_change(path, query_dates):
+    import change_maps
+
+    return change_maps.changemap_vals(path, query_dates, engine='sweep')
+
+
+def sweep_class(path, query_dates):
+    import class_maps
+
+    return class_maps.classmap_vals(path, query_dates, engine='sweep')
+
+
+def records_roundtrip(chip, tile_ulx, tile_uly):
+    """
+    chip_to_records, passed through save_record and load_record
+    """
+    import json_matlab
+
+    scratch = tempfile.mkdtemp(prefix='equiv_rec_')
+
+    try:
+        ret = {}
+        for row, records in json_matlab.chip_to_records(chip, tile_ulx, tile_uly).items():
+            outfile = os.path.join(scratch, 'record_change{}.mat'.format(row))
+            json_matlab.save_record(outfile, np.concatenate(records))
+            ret[row] = json_matlab.load_record(outfile)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return ret
+
+
+def row_vals(row_file, h, v, query_dates):
+    import change_maps
+
+    return change_maps.matmap_vals(row_file, h, v, query_dates)
+
+
+def write_held_open(chips, output_dir, h, v):
+    """
+    Write (map dictionary, coverage) chips as multi_output does
+    """
+    import change_maps
+
+    datasets = OrderedDict()
+    for data, coverage in chips:
+        change_maps.output_chip(dict(data), coverage, output_dir, h, v, datasets)
+    change_maps.close_datasets(datasets)
+
+
+def check_change(inputs, candidate=None, rtol=RTOL, atol=ATOL):
+    files = inputs['json'] + inputs['edge_json']
+    query_dates = inputs['query_dates']
+    candidate = resolve(candidate or sweep_change)
+
+    ref, ref_secs = _timed(lambda f: baseline_change(f, query_dates), files)
+    cand, cand_secs = _timed(lambda f: candidate(f, query_dates), files)
+
+    mismatches = []
+    for f, (r_data, r_cov), (c_data, c_cov) in zip(files, ref, cand):
+        name = os.path.basename(f)
+        mismatches.extend(compare_maps(name, r_data, c_data, rtol, atol))
+        mismatches.extend(compare_arrays('{} coverage'.format(name), r_cov, c_cov))
+
+    return _result(len(files), ref_secs, cand_secs, mismatches)
+
+
+def check_class(inputs, candidate=None, rtol=RTOL, atol=ATOL):
+    files = inputs['class'] + inputs['edge_class']
+    query_dates = inputs['query_dates']
+    candidate = resolve(candidate or sweep_class)
+
+    ref, ref_secs = _timed(lambda f: baseline_class(f, query_dates), files)
+    cand, cand_secs = _timed(lambda f: candidate(f, query_dates), files)
+
+    mismatches = []
+    for f, r, c in zip(files, ref, cand):
+        mismatches.extend(compare_maps(os.path.basename(f), r, c, rtol, atol))
+
+    return _result(len(files), ref_secs, cand_secs, mismatches)
+
+
+def check_records(inputs, candidate=None, rtol=RTOL, atol=ATOL):
+    import geo_utils
+    import change_maps
+    import json_matlab
+
+    files = inputs['json'] + inputs['edge_json']
+    ext, _ = geo_utils.extent_from_hv(inputs['h'], inputs['v'])
+    chips = [change_maps.get_json(f) for f in files]
+    candidate = resolve(candidate or records_roundtrip)
+
+    ref, ref_secs = _timed(lambda c: json_matlab.chip_to_records(c, ext.x_min,
+                                                                 ext.y_max),
+                           chips)
+    cand, cand_secs = _timed(lambda c: candidate(c, ext.x_min, ext.y_max), chips)
+
+    mismatches = []
+    for f, r, c in zip(files, ref, cand):
+        mismatches.extend(compare_records(os.path.basename(f), r, c, rtol, atol))
+
+    return _result(len(chips), ref_secs, cand_secs, mismatches)
+
+
+def check_rowfile(inputs, candidate=None, rtol=RTOL, atol=ATOL):
+    """
+    Row files are built from the chips before timing, matmap_vals stores
+    magnitudes as float32 so ChangeMagMap only matches within tolerance.
+    Row files only hold pixels with models so the edge chips are left out
+    """
+    import geo_utils
+    import change_maps
+    import json_matlab
+
+    h, v = inputs['h'], inputs['v']
+    query_dates = inputs['query_dates']
+    ext, _ = geo_utils.extent_from_hv(h, v)
+    candidate = resolve(candidate or row_vals)
+
+    row_dir = os.path.join(inputs['scratch'], 'rows')
+    os.makedirs(row_dir)
+    json_matlab.output_lines(row_dir, json_matlab.compress_record_chips(
+        [json_matlab.chip_to_records(change_maps.get_json(f), ext.x_min, ext.y_max)
+         for f in inputs['json']]))
+    row_files = sorted(os.path.join(row_dir, f) for f in os.listdir(row_dir)
+                       if change_maps.is_matfile(f))
+
+    files = inputs['json']
+    ref, ref_secs = _timed(lambda f: baseline_change(f, query_dates), files)
+    cand, cand_secs = _timed(lambda f: candidate(f, h, v, query_dates), row_files)
+
+    # Tile row -> (values, coverage, row within them)
+    rows = {}
+    for data, coverage in cand:
+        first = int(round((ext.y_max - data['chip_y']) / 30.0))
+        for idx in range(coverage.shape[0]):
+            rows[first + idx] = (data, coverage, idx)
+
+    mismatches = []
+    for f, (r_data, r_cov) in zip(files, ref):
+        name = os.path.basename(f)
+        col, row = change_maps.xyoff(h, v, r_data['chip_x'], r_data['chip_y'])
+        cols = slice(col, col + 100)
+
+        for idx in range(r_cov.shape[0]):
+            data, coverage, at = rows.get(row + idx, ({}, None, 0))
+
+            c_cov = (coverage[at, cols] if coverage is not None
+                     else np.zeros(100, dtype=r_cov.dtype))
+            mismatches.extend(compare_arrays('{} row {} coverage'.format(name, idx),
+                                             r_cov[idx], c_cov))
+
+            for prod in change_maps.MAP_NAMES:
+                for label in r_data.get(prod, {}):
+                    c_vals = (data[prod][label][at, cols] if prod in data
+                              else np.zeros(100))
+                    mismatches.extend(compare_arrays('{} row {} {} {}'
+                                                     .format(name, idx, prod, label),
+                                                     r_data[prod][label][idx],
+                                                     c_vals, rtol, atol))
+
+    return _result(len(files), ref_secs, cand_secs, mismatches)
+
+
+def check_writer(inputs, candidate=None, rtol=RTOL, atol=ATOL):
+    """
+    Both writers get the same chips, the rasters they leave are compared
+    """
+    from osgeo import gdal
+    import change_maps
+
+    h, v = inputs['h'], inputs['v']
+    candidate = resolve(candidate or write_held_open)
+
+    chips = change_maps.order_files(inputs['json'], h, v)
+    chips = [change_maps.changemap_vals(f, inputs['query_dates']) for f in chips]
+
+    ref_dir = os.path.join(inputs['scratch'], 'writer_ref')
+    cand_dir = os.path.join(inputs['scratch'], 'writer_cand')
+
+    start = default_timer()
+    for data, coverage in chips:
+        change_maps.output_chip(dict(data), coverage, ref_dir, h, v)
+    ref_secs = default_timer() - start
+
+    start = default_timer()
+    candidate(chips, cand_dir, h, v)
+    cand_secs = default_timer() - start
+
+    mismatches = []
+    names = set(os.listdir(ref_dir)) | set(os.listdir(cand_dir))
+    for name in sorted(n for n in names if n.endswith('.tif')):
+        if not os.path.exists(os.path.join(cand_dir, name)) or \
+                not os.path.exists(os.path.join(ref_dir, name)):
+            mismatches.append('{}: only written by one writer'.format(name))
+            continue
+
+        ref = gdal.Open(os.path.join(ref_dir, name)).ReadAsArray()
+        cand = gdal.Open(os.path.join(cand_dir, name)).ReadAsArray()
+        mismatches.extend(compare_arrays(name, ref, cand, rtol, atol))
+
+    return _result(len(chips), ref_secs, cand_secs, mismatches)
+
+
+def write_edge_chips(output_dir, h, v, start=0, seed=0):
+    """
+    Chips the synthetic tile does not otherwise have, placed after its first
+    start chips. For each of JSON and class pickles, one chip where some
+    pixels have no result, no entry or no models, and one with nothing in it
+
+    :return: list of JSON paths, list of class pickle paths
+    """
+    import benchmark
+
+    json_dir = os.path.join(output_dir, 'json')
+    class_dir = os.path.join(output_dir, 'class')
+
+    for d in (json_dir, class_dir):
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    (px, py), (ex, ey) = benchmark.chip_origins(h, v, start + 2)[start:]
+
+    partial = benchmark.synthetic_chip(px, py, seed=seed)
+    for idx, pixel in enumerate(partial):
+        if idx % 7 == 0:
+            pixel['result_ok'] = False
+        elif idx % 5 == 0:
+            result = json.loads(pixel['result'])
+            result['change_models'] = []
+            pixel['result'] = json.dumps(result)
+    # The last rows have no entries at all
+    partial = partial[:9000]
+
+    class_partial = benchmark.synthetic_classchip(seed=seed)
+    for idx in range(0, len(class_partial), 5):
+        class_partial[idx] = []
+
+    json_files = []
+    class_files = []
+    for (x, y), chip, class_chip in (((px, py), partial, class_partial),
+                                     ((ex, ey), [], [[] for _ in range(10000)])):
+        json_file = os.path.join(json_dir,
+                                 'H{:02d}V{:02d}_{}_{}.json'.format(h, v, x, y))
+        with open(json_file, 'w') as f:
+            json.dump(chip, f)
+        json_files.append(json_file)
+
+        class_file = os.path.join(class_dir,
+                                  'H{:02d}V{:02d}_{}_{}'.format(h, v, x, y))
+        with open(class_file, 'wb') as f:
+            pickle.dump(class_chip, f)
+        class_files.append(class_file)
+
+    return json_files, class_files
+
+
+def load_inputs(work_dir, h=5, v=2, chips=2, seed=0, json_dir=None,
+                class_dir=None, query_dates=None, **kwargs):
+    """
+    Recorded chips from json_dir and class_dir, synthetic ones from
+    benchmark for whichever is not given, along with the edge chips from
+    write_edge_chips
+
+    :param kwargs: passed to benchmark.synthetic_chip/synthetic_classchip
+    """
+    import benchmark
+    import change_maps
+
+    json_files = class_files = None
+    edge_json = edge_class = []
+
+    if json_dir is not None:
+        json_files = sorted(os.path.join(json_dir, f) for f in os.listdir(json_dir)
+                            if change_maps.is_input(f) and not change_maps.is_matfile(f))
+    if class_dir is not None:
+        class_files = sorted(os.path.join(class_dir, f) for f in os.listdir(class_dir))
+
+    if json_files is None or class_files is None:
+        synth_json, synth_class = benchmark.write_synthetic_tile(
+            os.path.join(work_dir, 'synthetic'), h, v, chips, seed=seed, **kwargs)
+        edges = write_edge_chips(os.path.join(work_dir, 'edge'), h, v,
+                                 chips, seed)
+
+        if json_files is None:
+            json_files, edge_json = synth_json, edges[0]
+        if class_files is None:
+            class_files, edge_class = synth_class, edges[1]
+
+    return {'json': json_files,
+            'class': class_files,
+            'edge_json': edge_json,
+            'edge_class': edge_class,
+            'h': h,
+            'v': v,
+            'query_dates': query_dates or change_maps.QUERY_DATES,
+            'scratch': work_dir}
+
+
+def run(checks=CHECKS, h=5, v=2, chips=2, seed=0, json_dir=None,
+        class_dir=None, query_dates=None, candidates=None, rtol=RTOL,
+        atol=ATOL, work_dir=None, **kwargs):
+    """
+    :param checks: subset of CHECKS
+    :param json_dir: recorded JSON chips of tile h, v, synthetic if None
+    :param class_dir: recorded classification pickles, synthetic if None
+    :param candidates: dictionary of check -> module:function or callable
+        replacing the default candidate, resolved before any check runs
+    :param work_dir: scratch space, a temporary directory is used and
+        removed if None
+    :return: dictionary keyed on check
+    """
+    candidates = candidates or {}
+
+    unknown = (set(checks) | set(candidates)) - set(CHECKS)
+    if unknown:
+        raise ValueError('Unknown checks: {}'.format(', '.join(sorted(unknown))))
+
+    # A candidate that does not import is a mistake in the request, not a
+    # check to skip
+    resolved = dict((check, resolve(spec)) for check, spec in candidates.items())
+
+    cleanup = work_dir is None
+    if cleanup:
+        work_dir = tempfile.mkdtemp(prefix='equiv_')
+
+    try:
+        results = {}
+        for check in checks:
+            scratch = tempfile.mkdtemp(prefix='{}_'.format(check), dir=work_dir)
+            inputs = load_inputs(scratch, h, v, chips, seed, json_dir,
+                                 class_dir, query_dates, **kwargs)
+
+            try:
+                res = globals()['check_{}'.format(check)](inputs,
+                                                          resolved.get(check),
+                                                          rtol, atol)
+            except ImportError as e:
+                res = {'skipped': str(e)}
+            except Exception as e:
+                log.exception('Check failed: {}'.format(check))
+                res = {'error': repr(e)}
+
+            log.debug('{}: {}'.format(check, res))
+            results[check] = res
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'params': dict(chips=chips, seed=seed, h=h, v=v, rtol=rtol,
+                           atol=atol, json_dir=json_dir, class_dir=class_dir,
+                           candidates=dict((k, str(c)) for k, c in candidates.items()),
+                           **kwargs),
+            'checks': results}
+
+
+def equivalent(results):
+    """
+    :return: whether every requested check ran and matched its reference,
+        one that was skipped or failed to run is not equivalent
+    """
+    checks = results['checks']
+
+    return bool(checks) and all(res.get('equivalent', False)
+                                for res in checks.values())
@@ -4,8 +4,11 @@ Geospatial Utilities
 Many assume the standard North up, which is not always true
 """
 import math
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
+import numpy as np
 from osgeo import gdal, ogr
 
 
@@ -14,12 +17,25 @@ GeoAffine = namedtuple('GeoAffine', ['ul_x', 'x_res', 'rot_1', 'ul_y', 'rot_2',
 GeoCoordinate = namedtuple('GeoCoordinate', ['x', 'y'])
 RowColumn = namedtuple('RowColumn', ['row', 'column'])
 RowColumnExtent = namedtuple('RowColumnExtent', ['start_row', 'start_col', 'end_row', 'end_col'])
+RasterBlock = namedtuple('RasterBlock', ['window', 'geo_extent', 'data'])
+
+# Area of interest within a tile, window is chip aligned with exclusive ends
+# and mask is the pixels inside the area over the window
+AOI = namedtuple('AOI', ['window', 'mask'])
 
 CONUS_EXTENT = GeoExtent(x_min=-2565585,
                          y_min=14805,
                          x_max=2384415,
                          y_max=3314805)
 
+# Number of read only GDAL datasets kept open per process
+DS_CACHE_SIZE = 16
+
+_DS_CACHE = OrderedDict()
+_AFFINE_CACHE = {}
+_EXTENT_CACHE = {}
+_HV_CACHE = {}
+
 
 def shapefile_extent(shapefile):
     ds = ogr.Open(shapefile)
@@ -40,26 +56,333 @@ def epsg_from_shapefile(shapefile):
     return spatialref.ExportToEPSG()
 
 
+def load_geometry(source):
+    """
+    Single geometry from a shapefile, the union of its features, or from WKT.
+    Expected to be in the same projection as the tiles.
+
+    :param source: shapefile path or WKT string
+    :return: ogr.Geometry
+    """
+    if not source.lower().endswith('.shp') and '(' in source:
+        return ogr.CreateGeometryFromWkt(source)
+
+    ds = ogr.Open(source)
+    layer = ds.GetLayer()
+
+    geom = None
+    for feature in layer:
+        fgeom = feature.GetGeometryRef()
+        geom = fgeom.Clone() if geom is None else geom.Union(fgeom)
+
+    return geom
+
+
+def extent_geometry(geo_extent):
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in ((geo_extent.x_min, geo_extent.y_max),
+                 (geo_extent.x_max, geo_extent.y_max),
+                 (geo_extent.x_max, geo_extent.y_min),
+                 (geo_extent.x_min, geo_extent.y_min),
+                 (geo_extent.x_min, geo_extent.y_max)):
+        ring.AddPoint(x, y)
+
+    poly = ogr.Geometry(ogr.wkbPolygon)
+    poly.AddGeometry(ring)
+
+    return poly
+
+
+def chips_in_geometry(h, v, geom, chip_size=3000):
+    """
+    Upper left of the chips in a tile that intersect the geometry
+
+    :return: set of (x, y)
+    """
+    ext, _ = extent_from_hv(h, v)
+    ret = set()
+
+    for y in range(ext.y_max, ext.y_min, -chip_size):
+        for x in range(ext.x_min, ext.x_max, chip_size):
+            chip = extent_geometry(GeoExtent(x_min=x, y_max=y,
+                                             x_max=x + chip_size,
+                                             y_min=y - chip_size))
+            if chip.Intersects(geom):
+                ret.add((x, y))
+
+    return ret
+
+
+def parse_bbox(value):
+    """
+    :param value: 'x_min,y_min,x_max,y_max' in the tile projection
+    :return: GeoExtent, None if value is not a bounding box
+    """
+    parts = str(value).split(',')
+
+    if len(parts) != 4:
+        return None
+
+    try:
+        x_min, y_min, x_max, y_max = [float(p) for p in parts]
+    except ValueError:
+        return None
+
+    return GeoExtent(x_min=x_min, y_max=y_max, x_max=x_max, y_min=y_min)
+
+
+def aoi_geometry(source):
+    """
+    :param source: bounding box, see parse_bbox, shapefile path or WKT
+    :return: ogr.Geometry
+    """
+    ext = parse_bbox(source)
+
+    if ext is not None:
+        return extent_geometry(ext)
+
+    return load_geometry(source)
+
+
+def window_affine(affine, window):
+    """
+    Affine of a window within the raster the affine describes
+    """
+    geo = rowcol_to_geo(affine, RowColumn(row=window.start_row,
+                                          column=window.start_col))
+
+    return affine._replace(ul_x=geo.x, ul_y=geo.y)
+
+
+def output_geometry(h, v, window=None, rows=5000, cols=5000):
+    """
+    Size and affine of a product raster covering a tile, or a window of it
+
+    :return: rows, columns, GeoAffine
+    """
+    _, affine = extent_from_hv(h, v)
+
+    if window is not None:
+        rows = window.end_row - window.start_row
+        cols = window.end_col - window.start_col
+        affine = window_affine(affine, window)
+
+    return rows, cols, affine
+
+
+def check_raster(ds, file_path, rows, cols, affine):
+    """
+    Raise ValueError if an existing raster does not have the size and
+    affine expected, ie it was made for a different area of interest
+    """
+    if ((ds.RasterYSize, ds.RasterXSize) != (rows, cols) or
+            not np.allclose(ds.GetGeoTransform(), affine)):
+        raise ValueError('{} is {}x{} at {}, expected {}x{} at {}, it was '
+                         'made for a different area'
+                         .format(file_path, ds.RasterYSize, ds.RasterXSize,
+                                 tuple(ds.GetGeoTransform()), rows, cols,
+                                 tuple(affine)))
+
+
+def geometry_window(affine, geom, rows=5000, cols=5000, align=100):
+    """
+    Envelope of the geometry as an exclusive window, grown out to multiples
+    of align and clipped to the raster
+    """
+    x_min, x_max, y_min, y_max = geom.GetEnvelope()
+
+    start_col = int(math.floor((x_min - affine.ul_x) / affine.x_res))
+    end_col = int(math.ceil((x_max - affine.ul_x) / affine.x_res))
+    start_row = int(math.floor((y_max - affine.ul_y) / affine.y_res))
+    end_row = int(math.ceil((y_min - affine.ul_y) / affine.y_res))
+
+    start_row = min(max(start_row // align * align, 0), rows)
+    start_col = min(max(start_col // align * align, 0), cols)
+    end_row = min(max(-(-end_row // align) * align, start_row), rows)
+    end_col = min(max(-(-end_col // align) * align, start_col), cols)
+
+    return RowColumnExtent(start_row=start_row, start_col=start_col,
+                           end_row=end_row, end_col=end_col)
+
+
+def rasterize_geometry(geom, affine, rows, cols):
+    """
+    Pixels whose centers fall within the geometry
+
+    :return: bool np.array shape=(rows, cols)
+    """
+    if not rows or not cols:
+        return np.zeros(shape=(rows, cols), dtype=bool)
+
+    src = ogr.GetDriverByName('Memory').CreateDataSource('aoi')
+    layer = src.CreateLayer('aoi', geom_type=geom.GetGeometryType())
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geom)
+    layer.CreateFeature(feature)
+
+    ds = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform(affine)
+    gdal.RasterizeLayer(ds, [1], layer, burn_values=[1])
+
+    return ds.GetRasterBand(1).ReadAsArray().astype(bool)
+
+
+def tile_aoi(h, v, source, align=100):
+    """
+    Rasterize an area of interest over the part of a tile it covers
+
+    :param source: bounding box, shapefile or WKT, see aoi_geometry
+    :return: AOI, None if source is None
+    """
+    if source is None:
+        return None
+
+    geom = aoi_geometry(source)
+    _, affine = extent_from_hv(h, v)
+    window = geometry_window(affine, geom, align=align)
+
+    mask = rasterize_geometry(geom, window_affine(affine, window),
+                              window.end_row - window.start_row,
+                              window.end_col - window.start_col)
+
+    return AOI(window=window, mask=mask)
+
+
+def aoi_pixels(aoi, rows, cols):
+    """
+    Which tile pixels are within the area
+
+    :param rows: array-like of tile rows, 0 based
+    :param cols: array-like of tile columns, 0 based
+    :return: bool np.array
+    """
+    rows = np.asarray(rows) - aoi.window.start_row
+    cols = np.asarray(cols) - aoi.window.start_col
+    height, width = aoi.mask.shape
+
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    ret = np.zeros(shape=rows.shape, dtype=bool)
+    ret[inside] = aoi.mask[rows[inside], cols[inside]]
+
+    return ret
+
+
+def aoi_contains(aoi, h, v, xs, ys):
+    """
+    Which coordinates are within the area
+    """
+    _, affine = extent_from_hv(h, v)
+    rowcol = geo_to_rowcol_array(affine, xs, ys)
+
+    return aoi_pixels(aoi, rowcol.row, rowcol.column)
+
+
+def aoi_chip_mask(aoi, h, v, chip_x, chip_y, size=100):
+    """
+    Pixels of a chip within the area
+
+    :return: bool np.array shape=(size, size)
+    """
+    _, affine = extent_from_hv(h, v)
+    ul = geo_to_rowcol(affine, GeoCoordinate(x=chip_x, y=chip_y))
+    rows, cols = np.mgrid[ul.row:ul.row + size, ul.column:ul.column + size]
+
+    return aoi_pixels(aoi, rows, cols)
+
+
+def aoi_chips(h, v, aoi, chip_size=3000):
+    """
+    Upper left of the chips in a tile with any pixel in the area
+
+    :return: set of (x, y)
+    """
+    ext, _ = extent_from_hv(h, v)
+    size = chip_size // 30
+    ret = set()
+
+    height, width = aoi.mask.shape
+    for row in range(0, height, size):
+        for col in range(0, width, size):
+            if aoi.mask[row:row + size, col:col + size].any():
+                ret.add((ext.x_min + (aoi.window.start_col + col) * 30,
+                         ext.y_max - (aoi.window.start_row + row) * 30))
+
+    return ret
+
+
 def fifteen_offset(coord):
     return (coord // 30) * 30 + 15
 
 
+def fifteen_offset_array(coords):
+    """
+    Array version of fifteen_offset, snaps every coordinate to the center of
+    the 30m pixel that contains it
+
+    :param coords: array-like of x or y values
+    :return: np.array
+    """
+    coords = np.asarray(coords)
+
+    return (coords // 30) * 30 + 15
+
+
+def _inverse_affine(affine):
+    """
+    Determinant of the 2x2 portion of the affine, required for going from
+    map space back to image space when the affine is rotated
+    """
+    det = affine.x_res * affine.y_res - affine.rot_1 * affine.rot_2
+
+    if det == 0:
+        raise ValueError('Affine is not invertible: {0}'.format(affine))
+
+    return det
+
+
 def geo_to_rowcol(affine, coord):
     """
-    Yline = (Ygeo - GT(3) - Xpixel*GT(4)) / GT(5)
-    Xpixel = (Xgeo - GT(0) - Yline*GT(2)) / GT(1)
+    Invert:
+    Xgeo = GT(0) + Xpixel*GT(1) + Yline*GT(2)
+    Ygeo = GT(3) + Xpixel*GT(4) + Yline*GT(5)
 
     :param affine:
     :param coord:
     :return:
     """
-    col = (coord.x - affine.ul_x - affine.ul_y * affine.rot_1) / affine.x_res
-    row = (coord.y - affine.ul_y - affine.ul_x * affine.rot_2) / affine.y_res
+    det = _inverse_affine(affine)
+
+    dx = coord.x - affine.ul_x
+    dy = coord.y - affine.ul_y
+
+    col = (affine.y_res * dx - affine.rot_1 * dy) / float(det)
+    row = (affine.x_res * dy - affine.rot_2 * dx) / float(det)
 
     return RowColumn(row=int(row),
                      column=int(col))
 
 
+def geo_to_rowcol_array(affine, xs, ys):
+    """
+    Array version of geo_to_rowcol, values are truncated the same way
+
+    :param affine:
+    :param xs: array-like of x values
+    :param ys: array-like of y values
+    :return: RowColumn of np.array's
+    """
+    det = _inverse_affine(affine)
+
+    dx = np.asarray(xs, dtype=np.float64) - affine.ul_x
+    dy = np.asarray(ys, dtype=np.float64) - affine.ul_y
+
+    cols = (affine.y_res * dx - affine.rot_1 * dy) / det
+    rows = (affine.x_res * dy - affine.rot_2 * dx) / det
+
+    return RowColumn(row=rows.astype(np.int64),
+                     column=cols.astype(np.int64))
+
+
 def rowcol_to_geo(affine, rowcol):
     """
     Xgeo = GT(0) + Xpixel*GT(1) + Yline*GT(2)
@@ -75,6 +398,38 @@ def rowcol_to_geo(affine, rowcol):
     return GeoCoordinate(x=x, y=y)
 
 
+def rowcol_to_geo_array(affine, rows, cols):
+    """
+    Array version of rowcol_to_geo
+
+    :param affine:
+    :param rows: array-like of row values
+    :param cols: array-like of column values
+    :return: GeoCoordinate of np.array's
+    """
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+
+    return GeoCoordinate(x=affine.ul_x + cols * affine.x_res + rows * affine.rot_1,
+                         y=affine.ul_y + cols * affine.rot_2 + rows * affine.y_res)
+
+
+def geo_to_pos_array(affine, xs, ys, width=5000):
+    """
+    Map coordinates to their row, column, and position within the flattened
+    raster described by the affine
+
+    :param affine:
+    :param xs: array-like of x values
+    :param ys: array-like of y values
+    :param width: number of columns in the raster
+    :return: rows, cols, pos as np.array's, all zero based
+    """
+    rowcol = geo_to_rowcol_array(affine, xs, ys)
+
+    return rowcol.row, rowcol.column, rowcol.row * width + rowcol.column
+
+
 def rowcolext_to_components(rowcol_ext):
     """
     Split the extent into it's components
@@ -139,23 +494,97 @@ def geoext_to_rowcolext(geo_extent, affine):
                            end_col=rc_lr.column)
 
 
+def vsi_path(raster_file):
+    """
+    Route gzip compressed rasters through GDAL's streaming /vsigzip/ handler
+
+    :param raster_file:
+    :return: path GDAL can open directly
+    """
+    if raster_file.endswith('.gz') and not raster_file.startswith('/vsi'):
+        return '/vsigzip/' + raster_file
+
+    return raster_file
+
+
 def get_raster_ds(raster_file, readonly=True):
-    if readonly:
-        return gdal.Open(raster_file, gdal.GA_ReadOnly)
-    else:
+    """
+    Open a raster, read only handles are kept in a bounded LRU cache so that
+    repeated metadata lookups do not go back to the filesystem
+
+    The cache is per process, handles opened before a fork should not be
+    used by the children, call close_raster_ds first.
+
+    :param raster_file:
+    :param readonly:
+    :return: gdal.Dataset
+    """
+    if not readonly:
+        # Any cached read only view of the file will be stale after an update
+        invalidate(raster_file)
         return gdal.Open(raster_file, gdal.GA_Update)
 
+    ds = _DS_CACHE.pop(raster_file, None)
+
+    if ds is None:
+        ds = gdal.Open(raster_file, gdal.GA_ReadOnly)
+
+        if ds is None:
+            raise IOError('Unable to open raster: {0}'.format(raster_file))
+
+    _DS_CACHE[raster_file] = ds
+
+    while len(_DS_CACHE) > DS_CACHE_SIZE:
+        _DS_CACHE.popitem(last=False)
+
+    return ds
+
+
+def close_raster_ds(raster_file=None):
+    """
+    Close cached dataset handles, memoized metadata is retained
+
+    :param raster_file: single raster to close, or all of them if None
+    """
+    if raster_file is None:
+        _DS_CACHE.clear()
+    else:
+        _DS_CACHE.pop(raster_file, None)
+
+
+def invalidate(raster_file=None):
+    """
+    Close cached dataset handles and forget any memoized metadata, needed if
+    a raster is modified or replaced on disk
+
+    :param raster_file: single raster to invalidate, or everything if None
+    """
+    close_raster_ds(raster_file)
+
+    if raster_file is None:
+        _AFFINE_CACHE.clear()
+        _EXTENT_CACHE.clear()
+        _HV_CACHE.clear()
+    else:
+        _AFFINE_CACHE.pop(raster_file, None)
+        _EXTENT_CACHE.pop(raster_file, None)
+
 
 def get_raster_geoextent(raster_file):
-    ds = get_raster_ds(raster_file)
+    if raster_file not in _EXTENT_CACHE:
+        ds = get_raster_ds(raster_file)
 
-    affine = get_raster_affine(raster_file)
-    rowcol = RowColumn(row=ds.RasterYSize, column=ds.RasterXSize)
+        affine = get_raster_affine(raster_file)
+        rowcol = RowColumn(row=ds.RasterYSize, column=ds.RasterXSize)
 
-    geo_lr = rowcol_to_geo(affine, rowcol)
+        geo_lr = rowcol_to_geo(affine, rowcol)
 
-    return GeoExtent(x_min=affine.ul_x, x_max=geo_lr.x,
-                     y_min=geo_lr.y, y_max=affine.ul_y)
+        _EXTENT_CACHE[raster_file] = GeoExtent(x_min=affine.ul_x,
+                                               x_max=geo_lr.x,
+                                               y_min=geo_lr.y,
+                                               y_max=affine.ul_y)
+
+    return _EXTENT_CACHE[raster_file]
 
 
 def get_raster_affine(raster_file):
@@ -165,9 +594,12 @@ def get_raster_affine(raster_file):
     :param raster_file:
     :return:
     """
-    ds = get_raster_ds(raster_file)
+    if raster_file not in _AFFINE_CACHE:
+        ds = get_raster_ds(raster_file)
+
+        _AFFINE_CACHE[raster_file] = GeoAffine(*ds.GetGeoTransform())
 
-    return GeoAffine(*ds.GetGeoTransform())
+    return _AFFINE_CACHE[raster_file]
 
 
 def array_from_rasterband(raster_file, geo_extent=None, band=1):
@@ -191,16 +623,148 @@ def array_from_rasterband(raster_file, geo_extent=None, band=1):
         return ds.GetRasterBand(band).ReadAsArray()
 
 
+def raster_windows(raster_file, band=1, block_size=None):
+    """
+    Break a raster into windows aligned with its native block layout
+
+    :param raster_file:
+    :param band:
+    :param block_size: optional (rows, cols), rounded up to a multiple of the
+        native block size so every read stays block aligned
+    :return: list of RowColumnExtent, end values are exclusive
+    """
+    ds = get_raster_ds(raster_file)
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+    native_cols, native_rows = ds.GetRasterBand(band).GetBlockSize()
+
+    if block_size is None:
+        win_rows, win_cols = native_rows, native_cols
+    else:
+        win_rows = int(math.ceil(block_size[0] / float(native_rows))) * native_rows
+        win_cols = int(math.ceil(block_size[1] / float(native_cols))) * native_cols
+
+    return [RowColumnExtent(start_row=r,
+                            start_col=c,
+                            end_row=min(r + win_rows, rows),
+                            end_col=min(c + win_cols, cols))
+            for r in range(0, rows, win_rows)
+            for c in range(0, cols, win_cols)]
+
+
+def _read_window(raster_file, band, window, local=None):
+    if local is not None:
+        # GDAL handles can not be shared between threads
+        if not hasattr(local, 'ds'):
+            local.ds = gdal.Open(raster_file, gdal.GA_ReadOnly)
+        ds = local.ds
+    else:
+        ds = get_raster_ds(raster_file)
+
+    return (ds.GetRasterBand(band)
+            .ReadAsArray(window.start_col,
+                         window.start_row,
+                         window.end_col - window.start_col,
+                         window.end_row - window.start_row))
+
+
+def iter_raster_blocks(raster_file, band=1, block_size=None, read_ahead=0):
+    """
+    Generator yielding a raster band one block aligned window at a time, so
+    rasters larger than memory can be processed
+
+    :param raster_file:
+    :param band:
+    :param block_size: optional (rows, cols) see raster_windows
+    :param read_ahead: number of windows to read ahead of the consumer on
+        background threads, 0 reads synchronously
+    :return: RasterBlock(window, geo_extent, data)
+    """
+    affine = get_raster_affine(raster_file)
+    windows = raster_windows(raster_file, band, block_size)
+
+    if read_ahead < 1:
+        for window in windows:
+            yield RasterBlock(window=window,
+                              geo_extent=rowcolext_to_geoext(affine, window),
+                              data=_read_window(raster_file, band, window))
+        return
+
+    local = threading.local()
+    pool = ThreadPool(processes=read_ahead)
+    pending = deque()
+    windows = iter(windows)
+
+    try:
+        for window in windows:
+            pending.append((window, pool.apply_async(_read_window,
+                                                     (raster_file, band,
+                                                      window, local))))
+            if len(pending) > read_ahead:
+                break
+
+        while pending:
+            window, res = pending.popleft()
+
+            for nxt in windows:
+                pending.append((nxt, pool.apply_async(_read_window,
+                                                      (raster_file, band,
+                                                       nxt, local))))
+                break
+
+            yield RasterBlock(window=window,
+                              geo_extent=rowcolext_to_geoext(affine, window),
+                              data=res.get())
+    finally:
+        pool.terminate()
+
+
+def set_cache_max(nbytes):
+    """
+    Size of GDAL's block cache for this process, set before writing so whole
+    rows of chips stay cached across all of the open rasters
+    """
+    if nbytes:
+        gdal.SetCacheMax(int(nbytes))
+
+
+def held_dataset(datasets, key, opener, max_open):
+    """
+    Writable dataset kept open by the caller between writes
+
+    :param datasets: OrderedDict the caller keeps, an LRU of open datasets,
+        the least recently used are flushed and closed beyond max_open
+    :param opener: called to open the dataset if it is not held
+    :return: gdal.Dataset
+    """
+    ds = datasets.pop(key, None)
+
+    if ds is None:
+        ds = opener()
+
+    datasets[key] = ds
+
+    while len(datasets) > max_open:
+        datasets.pop(next(iter(datasets))).FlushCache()
+
+    return ds
+
+
 def extent_from_hv(h, v, loc='conus'):
     """
     Retrieve the geospatial extent for the given tile h/v
 
+    Results are memoized, the values are immutable so they are safe to share
+
     :param h:
     :param v:
     :param loc:
     :return:
     """
     loc = loc.lower()
+    key = (h, v, loc)
+
+    if key in _HV_CACHE:
+        return _HV_CACHE[key]
 
     if loc == 'conus':
         xmin = CONUS_EXTENT.x_min + h * 5000 * 30
@@ -211,5 +775,7 @@ def extent_from_hv(h, v, loc='conus'):
         raise Exception('Location not implemented: {0}'
                         .format(loc))
 
-    return (GeoExtent(x_min=xmin, x_max=xmax, y_max=ymax, y_min=ymin),
-            GeoAffine(ul_x=xmin, x_res=30, rot_1=0, ul_y=ymax, rot_2=0, y_res=-30))
+    _HV_CACHE[key] = (GeoExtent(x_min=xmin, x_max=xmax, y_max=ymax, y_min=ymin),
+                      GeoAffine(ul_x=xmin, x_res=30, rot_1=0, ul_y=ymax, rot_2=0, y_res=-30))
+
+    return _HV_CACHE[key]
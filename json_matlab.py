@@ -1,14 +1,19 @@
 import os
+import threading
 import multiprocessing as mp
 from logger import log
 import json
 from functools import partial
+from collections import OrderedDict
 
 import scipy.io as sio
 import numpy as np
 
 import geo_utils
 import api
+import commons
+import metrics
+import ledger
 
 
 BAND_NAMES = ('blue',
@@ -37,8 +42,13 @@ def pyordinal_to_matordinal(ord_date):
     return ord_date + 366
 
 
+def matordinal_to_pyordinal(ord_date):
+    return ord_date - 366
+
+
 def save_record(outfile, record):
     sio.savemat(outfile, {'rec_cg': record}, do_compression=True)
+    save_index(outfile, record)
 
 
 def build_spectral(model, band_names=BAND_NAMES):
@@ -57,59 +67,108 @@ def build_spectral(model, band_names=BAND_NAMES):
     return coefs, rmse, magnitude
 
 
-def worker(output_path, input_path, h, v, alg, line):
+def worker(output_path, input_path, h, v, alg, line, footprint=None,
+           aoi=None):
+    """
+    :param footprint: set of chip (x, y) that can have results, chips
+        outside it are not requested, all chips are if None
+    :param aoi: geo_utils.AOI, only records for its pixels are written
+    """
     # output_path, input_path, h, v, alg, line = args
-    log.debug('Received lines beginning at {}'.format(line))
+    log.debug('Received lines beginning at %s', line)
     ext, affine = geo_utils.extent_from_hv(h, v)
 
     y = ext.y_max - line * 30
 
     records = tuple()
     for x in xrange(ext.x_min, ext.x_max, 3000):
-        log.debug('Requesting chip x: {} y: {}'.format(x, y))
+        if footprint is not None and (x, y) not in footprint:
+            metrics.incr('chips_skipped')
+            continue
 
-        result_chip = get_data(input_path, h, v, x, y, alg)
+        log.debug('Requesting chip x: %s y: %s', x, y)
+
+        with metrics.timer('matlab.fetch'):
+            result_chip = get_data(input_path, h, v, x, y, alg,
+                                   ledger.ledger_path(output_path))
+
+        if aoi is not None and result_chip:
+            result_chip = clip_chip(result_chip, h, v, aoi)
 
         if result_chip is None or len(result_chip) == 0:
-            log.debug('Received no results for chip x: {} y: {}'
-                      .format(x, y))
+            log.debug('Received no results for chip x: %s y: %s', x, y)
             continue
 
-        log.debug('Received {} results for chip x: {} y: {}'
-                  .format(len(result_chip), x, y))
+        log.debug('Received %s results for chip x: %s y: %s',
+                  len(result_chip), x, y)
+        metrics.incr('chips_read')
+
+        try:
+            with metrics.timer('matlab.records'):
+                records += (chip_to_records(result_chip, ext.x_min, ext.y_max),)
+        except Exception as e:
+            log.exception('Failed building records for chip x: %s y: %s', x, y)
+            ledger.record(ledger.ledger_path(output_path), chip_key(x, y), e,
+                          h=h, v=v, x=x, y=y, input_path=input_path, alg=alg)
+            continue
+        log.debug('Record chip accumulation: %s', len(records))
 
-        records += (chip_to_records(result_chip, ext.x_min, ext.y_max),)
-        log.debug('Record chip accumulation: {}'.format(len(records)))
+    log.debug('Outputting lines starting from: %s', line)
+    with metrics.timer('matlab.output'):
+        output_lines(output_path, compress_record_chips(records))
 
-    log.debug('Outputting lines starting from: {}'.format(line))
-    output_lines(output_path, compress_record_chips(records))
+    metrics.flush()
 
     return True
 
 
-def get_data(input_path, h, v, x, y, alg):
+def chip_key(x, y):
+    return '{}_{}'.format(x, y)
+
+
+def chip_filename(h, v, x, y):
+    return 'H{:02d}V{:02d}_{}_{}.json'.format(h, v, x, y)
+
+
+def get_data(input_path, h, v, x, y, alg, ledger_file=None):
     """
     Return chip results from either the api, or from files. Depends on whether
     input_path is not None.
+
+    Failures are recorded in the ledger, a chip that simply has no results
+    is not a failure.
     """
     try:
         if input_path:
+            if commons.find_input(os.path.join(input_path,
+                                               chip_filename(h, v, x, y))) is None:
+                return None
+
             return fetch_file_results(input_path, h, v, x, y)
         else:
             return api.fetch_results_chip(x, y, alg)
-    except:
+    except Exception as e:
+        log.debug('Failed retrieving chip x: %s y: %s', x, y)
+        metrics.incr('chip_errors')
+        ledger.record(ledger_file, chip_key(x, y), e,
+                      h=h, v=v, x=x, y=y, input_path=input_path, alg=alg)
         return None
 
 
 def fetch_file_results(dir, h, v, x, y):
     """
     Create a dictionary from a JSON file matching a certain naming convention. 
+    The file may also be gzip, bz2, xz or zstd compressed, ie .json.gz
     """
-    filename = 'H{:02d}V{:02d}_{}_{}.json'.format(h, v, x, y)
-    filepath = os.path.join(dir, filename)
+    filename = chip_filename(h, v, x, y)
+    filepath = commons.find_input(os.path.join(dir, filename))
 
-    with open(filepath, 'r') as f:
-        return json.load(f)
+    if filepath is None:
+        raise IOError('No results file for {}'.format(filename))
+
+    metrics.incr('bytes_read', os.path.getsize(filepath))
+
+    return commons.read_json(filepath)
 
 
 def compress_record_chips(record_chips):
@@ -130,10 +189,200 @@ def output_lines(output_path, records):
         output_line(output_path, records[row], row)
 
 
+def load_record(infile):
+    """
+    Read a record_change file back into the record_template layout
+    """
+    mat = np.atleast_1d(sio.loadmat(infile, squeeze_me=True)['rec_cg'])
+    record = np.zeros(mat.shape[0], dtype=record_template().dtype)
+
+    for name in record.dtype.names:
+        record[name] = (np.array(mat[name].tolist())
+                        .reshape(record[name].shape))
+
+    return record
+
+
+def record_filename(output_path, row):
+    """
+    :param row: 1 based row within the tile, as used by Matlab
+    """
+    return os.path.join(output_path, 'record_change{}.mat'.format(row))
+
+
+def index_filename(record_file):
+    return os.path.splitext(record_file)[0] + '.idx.npy'
+
+
+def build_index(record):
+    """
+    Offset and count of the records for each column of a row file. Records
+    for a pixel are always contiguous within a row file.
+
+    :return: (5000, 2) int32 array, count 0 where a pixel has no records
+    """
+    index = np.zeros((5000, 2), dtype=np.int32)
+
+    if not len(record):
+        return index
+
+    upos, offsets, counts = np.unique(record['pos'], return_index=True,
+                                      return_counts=True)
+    cols = (upos - 1) % 5000
+
+    index[cols, 0] = offsets
+    index[cols, 1] = counts
+
+    return index
+
+
+def save_index(record_file, record):
+    np.save(index_filename(record_file), build_index(record))
+
+
+def index_records(output_path):
+    """
+    Write the index for any row files made before indexes existed
+
+    :return: number of indexes written
+    """
+    count = 0
+
+    for f in sorted(os.listdir(output_path)):
+        if not (f.startswith('record_change') and f.endswith('.mat')):
+            continue
+
+        record_file = os.path.join(output_path, f)
+        if not os.path.exists(index_filename(record_file)):
+            save_index(record_file, load_record(record_file))
+            count += 1
+
+    return count
+
+
+ROW_CACHE_SIZE = 64
+_ROW_CACHE = OrderedDict()
+_ROW_LOCK = threading.Lock()
+
+
+def _cached_row(record_file):
+    """
+    Decoded records and index for a row file, kept in an LRU so repeated
+    lookups in the same rows do not decompress again. Entries are keyed on
+    the modification time so rewritten rows are picked up.
+    """
+    mtime = os.path.getmtime(record_file)
+
+    with _ROW_LOCK:
+        entry = _ROW_CACHE.pop(record_file, None)
+        if entry is not None and entry[0] == mtime:
+            _ROW_CACHE[record_file] = entry
+            return entry[1], entry[2]
+
+    record = load_record(record_file)
+    index_file = index_filename(record_file)
+
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= mtime:
+        index = np.load(index_file)
+    else:
+        index = build_index(record)
+
+    with _ROW_LOCK:
+        _ROW_CACHE[record_file] = (mtime, record, index)
+        while len(_ROW_CACHE) > ROW_CACHE_SIZE:
+            _ROW_CACHE.popitem(last=False)
+
+    return record, index
+
+
+def clear_row_cache():
+    with _ROW_LOCK:
+        _ROW_CACHE.clear()
+
+
+def pixel_count(output_path, row, col):
+    """
+    Number of records for a pixel, read from the index alone
+
+    :param row: 0 based row within the tile
+    :param col: 0 based column within the tile
+    """
+    record_file = record_filename(output_path, row + 1)
+    index_file = index_filename(record_file)
+
+    if not os.path.exists(record_file):
+        return 0
+
+    if os.path.exists(index_file):
+        return int(np.load(index_file, mmap_mode='r')[col, 1])
+
+    return int(_cached_row(record_file)[1][col, 1])
+
+
+def pixel_records(output_path, row, col):
+    """
+    The rec_cg records for a single pixel
+
+    :param output_path: directory holding the tile's row files
+    :param row: 0 based row within the tile
+    :param col: 0 based column within the tile
+    :return: record_template array, empty if the pixel has no records
+    """
+    record_file = record_filename(output_path, row + 1)
+
+    if not os.path.exists(record_file):
+        return np.zeros(0, dtype=record_template().dtype)
+
+    record, index = _cached_row(record_file)
+    offset, count = index[col]
+
+    return record[offset:offset + count].copy()
+
+
+def pixel_records_at(output_path, h, v, x, y):
+    """
+    The rec_cg records for the pixel containing a map coordinate
+
+    :param h: ARD grid h the row files belong to
+    :param v: ARD grid v
+    :param x: projected x coordinate
+    :param y: projected y coordinate
+    """
+    _, affine = geo_utils.extent_from_hv(h, v)
+    rowcol = geo_utils.geo_to_rowcol(affine, geo_utils.GeoCoordinate(x=x, y=y))
+
+    if not (0 <= rowcol.row < 5000 and 0 <= rowcol.column < 5000):
+        raise ValueError('Coordinate {}, {} is outside of h{:02d}v{:02d}'
+                         .format(x, y, h, v))
+
+    return pixel_records(output_path, rowcol.row, rowcol.column)
+
+
+def merge_line(output_path, records, row):
+    """
+    Replace the records for the given pixels within an existing row file,
+    or create it
+    """
+    outfile = record_filename(output_path, row)
+    new = np.concatenate(records)
+
+    if os.path.exists(outfile):
+        existing = load_record(outfile)
+        keep = existing[~np.in1d(existing['pos'], new['pos'])]
+        new = np.concatenate((keep, new))
+
+    new = new[np.argsort(new['pos'], kind='mergesort')]
+    save_record(outfile, new)
+
+
 def output_line(output_path, records, row):
-    outfile = os.path.join(output_path, 'record_change{}.mat'.format(row))
+    outfile = record_filename(output_path, row)
 
-    save_record(outfile, np.concatenate(records))
+    record = np.concatenate(records)
+    save_record(outfile, record)
+
+    metrics.incr('records_built', len(record))
+    metrics.incr('files_written')
 
 
 def chip_to_records(chip, tile_ulx, tile_uly):
@@ -145,19 +394,29 @@ def chip_to_records(chip, tile_ulx, tile_uly):
     """
     ret = {}
 
-    for result in chip:
-        if result.get('result_ok') is True:
-            models = json.loads(result['result'])
-        else:
-            continue
+    results = [result for result in chip if result.get('result_ok') is True]
+
+    if not results:
+        return ret
+
+    affine = geo_utils.GeoAffine(ul_x=tile_ulx, x_res=30, rot_1=0,
+                                 ul_y=tile_uly, rot_2=0, y_res=-30)
 
-        # + 1 for Matlab
-        row = (tile_uly - int(result['y'])) / 30 + 1
-        # column is expected to be a continuous value, as if the extent was
-        # a flattened array
-        pos = ((int(result['x'] - tile_ulx)) / 30 + 1) + (row - 1) * 5000
+    xs = [int(result['x']) for result in results]
+    ys = [int(result['y']) for result in results]
 
-        records = result_to_records(models, pos)
+    # pos is expected to be a continuous value, as if the extent was
+    # a flattened array
+    rows, _, pos = geo_utils.geo_to_pos_array(affine, xs, ys)
+
+    # + 1 for Matlab
+    rows += 1
+    pos += 1
+
+    for result, row, p in zip(results, rows.tolist(), pos.tolist()):
+        models = json.loads(result['result'])
+
+        records = result_to_records(models, p)
 
         if row not in ret:
             ret[row] = tuple()
@@ -190,13 +449,55 @@ def result_to_records(models, pos):
     return records
 
 
-def run(output_path, h, v, alg, cpus, input_path, resume=True):
+def clip_chip(chip, h, v, aoi):
+    """
+    Only the results of a chip for pixels within the area of interest
+    """
+    keep = geo_utils.aoi_contains(aoi, h, v,
+                                  [int(r['x']) for r in chip],
+                                  [int(r['y']) for r in chip])
+
+    return [r for r, k in zip(chip, keep.tolist()) if k]
+
+
+def footprint_chips(h, v, footprint):
+    """
+    :param footprint: shapefile or WKT of where there is data
+    :return: set of chip (x, y) within it, None if footprint is None
+    """
+    if footprint is None:
+        return None
+
+    return geo_utils.chips_in_geometry(h, v, geo_utils.load_geometry(footprint))
+
+
+def run(output_path, h, v, alg, cpus, input_path, resume=True,
+        metrics_path=None, footprint=None, aoi=None):
+    """
+    :param footprint: shapefile or WKT of the data footprint, chips outside
+        of it are never requested
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi. Only
+        chips within it are requested and records written for its pixels
+    """
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    pool = mp.Pool(processes=cpus)
+    metrics.configure(metrics_path)
+
+    chips = footprint_chips(h, v, footprint)
+    ext, _ = geo_utils.extent_from_hv(h, v)
 
-    lines = [l for l in range(0, 5000, 100)]
+    aoi = geo_utils.tile_aoi(h, v, aoi)
+    if aoi is not None:
+        in_aoi = geo_utils.aoi_chips(h, v, aoi)
+        chips = in_aoi if chips is None else chips & in_aoi
+
+    chip_ys = None if chips is None else set(y for _, y in chips)
+
+    lines = [l for l in range(0, 5000, 100)
+             if chip_ys is None or ext.y_max - l * 30 in chip_ys]
+
+    pool = mp.Pool(processes=cpus)
 
     # Disabled for now
     if resume is True:
@@ -206,11 +507,109 @@ def run(output_path, h, v, alg, cpus, input_path, resume=True):
         #     if not line % 100:
         #         lines.remove(line)
 
-    func = partial(worker, output_path, input_path, h, v, alg)
+    func = partial(worker, output_path, input_path, h, v, alg,
+                   footprint=chips, aoi=aoi)
 
     success = pool.map(func, lines)
 
     log.debug('Successful workers: {}'.format(np.sum(success)))
+    metrics.finish()
+
+
+def run_when_ready(output_path, h, v, alg, cpus, submit=True, interval=300,
+                   timeout=None, metrics_path=None):
+    """
+    Build the row files from the API as the tile is processed, rather than
+    waiting for all of it. Chips are polled and each band of lines goes to
+    the pool as soon as all of its chips have finished.
+
+    :param submit: queue the tile for processing first
+    :param interval: seconds between polls
+    :param timeout: stop polling after this many seconds
+    :return: list of the lines processed
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    metrics.configure(metrics_path)
+
+    if submit:
+        api.queue_tile_processing(h, v, algorithm=alg)
+
+    ext, _ = geo_utils.extent_from_hv(h, v)
+    chips_per_line = len(range(ext.x_min, ext.x_max, 3000))
+    done = {}
+    results = []
+
+    pool = mp.Pool(processes=cpus)
+
+    try:
+        for x, y in api.poll_tile(h, v, algorithm=alg, interval=interval,
+                                  timeout=timeout):
+            line = (ext.y_max - y) // 30
+            done[line] = done.get(line, 0) + 1
+
+            if done[line] == chips_per_line:
+                log.info('Chips ready for lines beginning at %s', line)
+                results.append((line, pool.apply_async(
+                    worker, (output_path, None, h, v, alg, line))))
+
+        for line, res in results:
+            res.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    metrics.finish()
+
+    incomplete = sorted(l for l in done if done[l] < chips_per_line)
+    if incomplete:
+        log.info('Lines not processed, chips outstanding: %s', incomplete)
+
+    return [line for line, _ in results]
+
+
+def rerun(output_path, h, v, alg, input_path=None):
+    """
+    Re-process only the chips recorded in the failure ledger, merging their
+    records into the existing row files
+
+    :return: number of chips recovered
+    """
+    ledger_file = ledger.ledger_path(output_path)
+    ext, _ = geo_utils.extent_from_hv(h, v)
+
+    recovered = 0
+    for entry in ledger.outstanding(ledger_file):
+        info = entry['info']
+        x, y = info['x'], info['y']
+
+        log.info('Retrying chip x: {} y: {}, attempt {}'
+                 .format(x, y, entry['attempts'] + 1))
+
+        try:
+            if input_path or info.get('input_path'):
+                result_chip = fetch_file_results(input_path or info['input_path'],
+                                                 h, v, x, y)
+            else:
+                result_chip = api.fetch_results_chip(x, y, alg or info['alg'])
+
+            if result_chip:
+                records = chip_to_records(result_chip, ext.x_min, ext.y_max)
+
+                for row in records:
+                    merge_line(output_path, records[row], row)
+        except Exception as e:
+            log.exception('Retry failed for chip x: {} y: {}'.format(x, y))
+            ledger.record(ledger_file, entry['key'], e, **info)
+            continue
+
+        ledger.resolve(ledger_file, entry['key'])
+        recovered += 1
+
+    log.info('Recovered {} chips'.format(recovered))
+
+    return recovered
 #
 #
 # if __name__ == '__main__':
@@ -0,0 +1,118 @@
+"""
+Per chip failure ledger
+
+An append only JSON lines file kept with the outputs. Every chip that
+raises is recorded with its key, what is needed to run it again and the
+exception. A chip that later succeeds gets a resolved entry, so the
+outstanding failures are whatever was not resolved after its last failure.
+"""
+
+import os
+import json
+import time
+import traceback
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from logger import log
+
+
+LEDGER_NAME = 'failures.jsonl'
+
+
+def ledger_path(output_dir):
+    return os.path.join(output_dir, LEDGER_NAME)
+
+
+def _append(path, entry):
+    line = json.dumps(entry, sort_keys=True) + '\n'
+
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def record(path, key, exc, **info):
+    """
+    Record a failure, call from within the except block
+
+    :param path: ledger file
+    :param key: identifies the chip, ie the input file or 'x_y'
+    :param exc: the exception raised
+    :param info: anything else needed to run the chip again
+    """
+    if path is None:
+        return
+
+    entry = {'key': key,
+             'time': time.time(),
+             'error': repr(exc),
+             'traceback': traceback.format_exc(),
+             'info': info}
+
+    _append(path, entry)
+    log.debug('Recorded failure for %s', key)
+
+
+def resolve(path, key):
+    """
+    Mark a previously failed chip as done
+    """
+    if path is None:
+        return
+
+    _append(path, {'key': key, 'time': time.time(), 'resolved': True})
+
+
+def load(path):
+    """
+    Replay the ledger
+
+    :return: dictionary of key -> last failure entry, with 'attempts' and
+        'resolved' filled in
+    """
+    ret = {}
+
+    if path is None or not os.path.exists(path):
+        return ret
+
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            entry = json.loads(line)
+            key = entry['key']
+
+            if entry.get('resolved'):
+                if key in ret:
+                    ret[key]['resolved'] = True
+                continue
+
+            attempts = ret[key]['attempts'] + 1 if key in ret else 1
+            entry['attempts'] = attempts
+            entry['resolved'] = False
+            ret[key] = entry
+
+    return ret
+
+
+def outstanding(path):
+    """
+    Failures that have not been resolved since
+
+    :return: list of entries, ordered by key
+    """
+    entries = load(path)
+
+    return [entries[k] for k in sorted(entries) if not entries[k]['resolved']]
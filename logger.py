@@ -1,4 +1,5 @@
 import logging
+import os
 import sys
 
 log = logging.getLogger()
@@ -8,4 +9,16 @@ formatter = logging.Formatter('%(asctime)s %(processName)s: %(message)s')
 handler.setFormatter(formatter)
 
 log.addHandler(handler)
-log.setLevel(logging.DEBUG)
+log.setLevel(os.environ.get('CCD_LOG_LEVEL', 'DEBUG').upper())
+
+
+def set_level(level):
+    """
+    Change the logging level, ie 'INFO' or logging.WARNING. Child processes
+    inherit the level through CCD_LOG_LEVEL.
+    """
+    if not isinstance(level, int):
+        level = level.upper()
+
+    log.setLevel(level)
+    os.environ['CCD_LOG_LEVEL'] = logging.getLevelName(log.level)
@@ -1,5 +1,7 @@
 import argparse
+import api
 import json_matlab as jm
+from logger import set_level
 
 
 parser = argparse.ArgumentParser(
@@ -22,7 +24,55 @@ parser.add_argument('-p', '--proc',
                     help='Number of child processes to use.',
                     default=1, type=int, metavar='')
 
+parser.add_argument('--host',
+                    help='Base URL of the changes results service, ie a '
+                         'local mock_api.',
+                    default=None, metavar='')
+parser.add_argument('--metrics',
+                    help='Write stage metrics to this file, Prometheus text '
+                         'if it ends in .prom, otherwise JSON.',
+                    default=None, metavar='')
+parser.add_argument('--rerun',
+                    help='Only re-process chips in the failure ledger of a '
+                         'previous run, merging them into its output.',
+                    action='store_true')
+parser.add_argument('--footprint',
+                    help='Shapefile or WKT of the data footprint, chips '
+                         'outside of it are skipped.',
+                    default=None, metavar='')
+parser.add_argument('--aoi',
+                    help='Area of interest, x_min,y_min,x_max,y_max in the '
+                         'tile projection, a shapefile or WKT. Only the '
+                         'chips and pixels within it are processed.',
+                    default=None, metavar='')
+parser.add_argument('--when-ready',
+                    help='Queue the tile on the API and build each band of '
+                         'lines as soon as its chips have finished.',
+                    action='store_true')
+parser.add_argument('--index',
+                    help='Only write the pixel index for existing row files '
+                         'that do not have one.',
+                    action='store_true')
+parser.add_argument('--log-level',
+                    help='Logging level, ie DEBUG, INFO, WARNING.',
+                    default='DEBUG', metavar='')
+
 args = parser.parse_args()
 
-jm.run(args.output, args.h, args.v, args.algorithm, args.proc, args.input)
+set_level(args.log_level)
+
+if args.host:
+    api.set_host(args.host)
+
+if args.index:
+    jm.index_records(args.output)
+elif args.when_ready:
+    jm.run_when_ready(args.output, args.h, args.v, args.algorithm, args.proc,
+                      metrics_path=args.metrics)
+elif args.rerun:
+    jm.rerun(args.output, args.h, args.v, args.algorithm, args.input)
+else:
+    jm.run(args.output, args.h, args.v, args.algorithm, args.proc, args.input,
+           metrics_path=args.metrics, footprint=args.footprint,
+           aoi=args.aoi)
 # run(output_dir, horiz, vert, cpu_count)
@@ -0,0 +1,225 @@
+"""
+Low overhead stage timers and counters
+
+Every process accumulates into module level dictionaries. When a metrics
+path has been configured, each process periodically writes a cumulative
+snapshot to <path>.parts/<pid>.json, which the parent merges into a single
+JSON or Prometheus text report.
+"""
+
+import os
+import json
+import shutil
+from contextlib import contextmanager
+from timeit import default_timer
+
+
+PATH_ENV = 'CCD_METRICS_PATH'
+
+_counters = {}
+_timers = {}
+_gauges = {}
+_last_flush = [0]
+
+
+def configure(path):
+    """
+    Start collecting metrics to path, ending in .prom for Prometheus text or
+    anything else for JSON. Must be called before worker processes are
+    started so they inherit it.
+
+    :param path: None disables the file output
+    """
+    if path is None:
+        os.environ.pop(PATH_ENV, None)
+        return
+
+    parts = _parts_dir(path)
+    if os.path.exists(parts):
+        shutil.rmtree(parts)
+    os.makedirs(parts)
+
+    os.environ[PATH_ENV] = path
+    reset()
+
+
+def configured():
+    return os.environ.get(PATH_ENV)
+
+
+def _parts_dir(path):
+    return path + '.parts'
+
+
+def reset():
+    _counters.clear()
+    _timers.clear()
+    _gauges.clear()
+
+
+def incr(name, value=1):
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    """
+    Record a level, ie queue depth, the maximum seen is kept
+    """
+    if value > _gauges.get(name, value - 1):
+        _gauges[name] = value
+
+
+def add_time(name, seconds, calls=1):
+    timer = _timers.get(name)
+
+    if timer is None:
+        _timers[name] = [seconds, calls]
+    else:
+        timer[0] += seconds
+        timer[1] += calls
+
+
+@contextmanager
+def timer(name):
+    start = default_timer()
+    try:
+        yield
+    finally:
+        add_time(name, default_timer() - start)
+
+
+def snapshot():
+    return {'counters': dict(_counters),
+            'timers': dict((k, list(v)) for k, v in _timers.items()),
+            'gauges': dict(_gauges)}
+
+
+def flush(interval=0):
+    """
+    Write this process's snapshot if a metrics path is configured
+
+    :param interval: skip the write if the last one was more recent than
+        this many seconds
+    """
+    path = configured()
+
+    if path is None:
+        return
+
+    now = default_timer()
+    if interval and now - _last_flush[0] < interval:
+        return
+    _last_flush[0] = now
+
+    outfile = os.path.join(_parts_dir(path), '{}.json'.format(os.getpid()))
+
+    with open(outfile + '.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.rename(outfile + '.tmp', outfile)
+
+
+def merge(snapshots):
+    """
+    Combine snapshots from several processes, counters and timers are
+    summed, gauges keep the maximum
+    """
+    ret = {'counters': {}, 'timers': {}, 'gauges': {}}
+
+    for snap in snapshots:
+        for k, v in snap['counters'].items():
+            ret['counters'][k] = ret['counters'].get(k, 0) + v
+
+        for k, (secs, calls) in snap['timers'].items():
+            total = ret['timers'].setdefault(k, [0, 0])
+            total[0] += secs
+            total[1] += calls
+
+        for k, v in snap['gauges'].items():
+            ret['gauges'][k] = max(v, ret['gauges'].get(k, v))
+
+    return ret
+
+
+def collect(path=None):
+    """
+    Merge the snapshots written by every process, including this one
+    """
+    path = path or configured()
+
+    snapshots = [snapshot()]
+    parts = _parts_dir(path)
+
+    if os.path.exists(parts):
+        for f in os.listdir(parts):
+            if f.endswith('.json') and f != '{}.json'.format(os.getpid()):
+                with open(os.path.join(parts, f), 'r') as fh:
+                    snapshots.append(json.load(fh))
+
+    return merge(snapshots)
+
+
+def _metric_name(name, prefix):
+    return prefix + '_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def to_prometheus(merged, prefix='ccd'):
+    lines = []
+
+    for k, v in sorted(merged['counters'].items()):
+        lines.append('{} {}'.format(_metric_name(k, prefix) + '_total', v))
+
+    for k, (secs, calls) in sorted(merged['timers'].items()):
+        lines.append('{}_stage_seconds_total{{stage="{}"}} {}'.format(prefix, k, secs))
+        lines.append('{}_stage_calls_total{{stage="{}"}} {}'.format(prefix, k, calls))
+
+    for k, v in sorted(merged['gauges'].items()):
+        lines.append('{} {}'.format(_metric_name(k, prefix), v))
+
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path=None, interval=0):
+    """
+    Write the merged report for every process to the configured path
+
+    :param interval: skip if the last dump was more recent than this
+    :return: the merged metrics, or None if nothing was written
+    """
+    path = path or configured()
+
+    if path is None:
+        return
+
+    now = default_timer()
+    if interval and now - _last_flush[0] < interval:
+        return
+
+    merged = collect(path)
+
+    if path.endswith('.prom'):
+        out = to_prometheus(merged)
+    else:
+        out = json.dumps(merged, indent=2, sort_keys=True)
+
+    with open(path + '.tmp', 'w') as f:
+        f.write(out)
+    os.rename(path + '.tmp', path)
+
+    flush()
+
+    return merged
+
+
+def finish(path=None):
+    """
+    Write the final report and clean up the per process snapshots
+    """
+    path = path or configured()
+
+    if path is None:
+        return
+
+    merged = dump(path)
+    shutil.rmtree(_parts_dir(path), ignore_errors=True)
+
+    return merged
@@ -0,0 +1,40 @@
+import argparse
+import mock_api
+from logger import set_level
+
+
+parser = argparse.ArgumentParser(
+        description='Serve synthetic or recorded chips in place of the LCMAP '
+                    'changes API, for offline testing of the fetch path.')
+parser.add_argument('--host', default='127.0.0.1', metavar='')
+parser.add_argument('--port', default=8080, type=int, metavar='')
+parser.add_argument('-r', '--records', default=None, metavar='',
+                    help='Directory of recorded JSON chips to serve, '
+                         'synthetic chips are made if not given.')
+parser.add_argument('--latency', default=0.0, type=float, metavar='',
+                    help='Seconds added to every response.')
+parser.add_argument('--jitter', default=0.0, type=float, metavar='',
+                    help='Up to this many random seconds more.')
+parser.add_argument('--error-rate', default=0.0, type=float, metavar='',
+                    help='Fraction of requests that fail with a 500.')
+parser.add_argument('--bandwidth', default=None, type=float, metavar='',
+                    help='Bytes per second per response.')
+parser.add_argument('--ready-after', default=0.0, type=float, metavar='',
+                    help='Seconds before a chip reports as processed.')
+parser.add_argument('--pixels', default=10000, type=int, metavar='',
+                    help='Pixels with results in synthetic chips.')
+parser.add_argument('--seed', default=0, type=int, metavar='')
+parser.add_argument('--log-level', default='INFO', metavar='')
+
+args = parser.parse_args()
+
+set_level(args.log_level)
+
+config = mock_api.MockConfig(latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate,
+                             bandwidth=args.bandwidth,
+                             ready_after=args.ready_after,
+                             record_dir=args.records, pixels=args.pixels,
+                             seed=args.seed)
+
+mock_api.serve(config, args.host, args.port)
@@ -0,0 +1,272 @@
+"""
+Local stand-in for the LCMAP changes results service
+
+Serves the same routes api uses, from synthetic chips or from a directory
+of recorded H##V##_<x>_<y>.json chips, with tunable latency, error rate
+and bandwidth so the fetch path can be load tested on an isolated machine.
+Point api at it with api.set_host or the LCMAP_HOST environment variable.
+
+GET /changes/results/<algorithm>/chip?x=<x>&y=<y>
+GET /changes/results/<algorithm>/<x>/<y>?refresh=false
+GET /metrics
+"""
+
+import os
+import re
+import json
+import time
+import random
+import threading
+from collections import OrderedDict
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+import commons
+import benchmark
+from logger import log
+
+
+BASE_PATH = '/changes/results'
+CHIP_CACHE_SIZE = 32
+WRITE_CHUNK = 64 * 1024
+
+
+class MockConfig(object):
+    """
+    :param latency: seconds added to every response
+    :param jitter: up to this many seconds more, uniformly
+    :param error_rate: fraction of requests answered with a 500
+    :param bandwidth: bytes per second per response, None for unlimited
+    :param ready_after: seconds after a chip is first asked about before
+        it reports as processed, simulates the service working on a tile
+    :param record_dir: serve recorded chips from here, otherwise synthetic
+    :param pixels: pixels with results in synthetic chips
+    :param seed: makes errors, jitter and synthetic chips reproducible
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, bandwidth=None,
+                 ready_after=0.0, record_dir=None, pixels=10000, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.ready_after = ready_after
+        self.record_dir = record_dir
+        self.pixels = pixels
+        self.seed = seed
+
+
+class MockState(object):
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.first_seen = {}
+        self.chips = OrderedDict()
+        self.counts = {'requests': 0, 'errors': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """
+        :return: whether to fail the request, seconds of delay
+        """
+        with self._lock:
+            self.counts['requests'] += 1
+            fail = self.rng.random() < self.config.error_rate
+            delay = self.config.latency + self.rng.random() * self.config.jitter
+
+            if fail:
+                self.counts['errors'] += 1
+
+        return fail, delay
+
+    def ready(self, x, y):
+        with self._lock:
+            first = self.first_seen.setdefault((x, y), time.time())
+
+        return time.time() - first >= self.config.ready_after
+
+    def chip_origin(self, x, y):
+        """
+        Chips are aligned to 3000m from the CONUS grid origin
+        """
+        import geo_utils
+
+        conus = geo_utils.CONUS_EXTENT
+
+        return (conus.x_min + (x - conus.x_min) // 3000 * 3000,
+                conus.y_max - (conus.y_max - y) // 3000 * 3000)
+
+    def _recorded(self, x, y):
+        pattern = re.compile(r'^H\d\dV\d\d_{}_{}\.json'.format(x, y))
+
+        for f in os.listdir(self.config.record_dir):
+            if pattern.match(f):
+                return commons.read_json(os.path.join(self.config.record_dir, f))
+
+        return None
+
+    def chip(self, x, y):
+        """
+        Serialized chip, cached as generating them is slow
+        """
+        key = (x, y)
+
+        with self._lock:
+            body = self.chips.pop(key, None)
+            if body is not None:
+                self.chips[key] = body
+                return body
+
+        if self.config.record_dir is not None:
+            data = self._recorded(x, y)
+        else:
+            seed = (self.config.seed + x * 31 + y) % (2 ** 32)
+            data = benchmark.synthetic_chip(x, y, pixels=self.config.pixels,
+                                            seed=seed)
+
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+
+        with self._lock:
+            self.chips[key] = body
+            while len(self.chips) > CHIP_CACHE_SIZE:
+                self.chips.popitem(last=False)
+
+        return body
+
+    def pixel(self, x, y, algorithm):
+        chip_x, chip_y = self.chip_origin(x, y)
+        ok = self.ready(chip_x, chip_y)
+
+        ret = {'x': x, 'y': y, 'chip_x': chip_x, 'chip_y': chip_y,
+               'algorithm': algorithm, 'result_ok': ok, 'result': None}
+
+        if ok:
+            ret['result'] = json.dumps({'change_models': [],
+                                        'processing_mask': []})
+
+        return json.dumps(ret).encode('utf-8')
+
+    def metrics_text(self):
+        with self._lock:
+            counts = dict(self.counts)
+
+        return ''.join('ccd_mock_{}_total {}\n'.format(k, counts[k])
+                       for k in sorted(counts))
+
+
+def _handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            log.debug('%s - %s', self.address_string(), format % args)
+
+        def _send(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+            bandwidth = state.config.bandwidth
+            for idx in range(0, len(body), WRITE_CHUNK):
+                chunk = body[idx:idx + WRITE_CHUNK]
+                start = time.time()
+                self.wfile.write(chunk)
+
+                if bandwidth:
+                    wait = len(chunk) / float(bandwidth) - (time.time() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+
+            with state._lock:
+                state.counts['bytes'] += len(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+
+            if url.path == '/metrics':
+                return self._send(200, state.metrics_text().encode('utf-8'),
+                                  'text/plain')
+
+            if not url.path.startswith(BASE_PATH + '/'):
+                return self._send(404, b'{"error": "not found"}')
+
+            fail, delay = state.draw()
+            time.sleep(delay)
+
+            if fail:
+                return self._send(500, b'{"error": "mock failure"}')
+
+            parts = url.path[len(BASE_PATH) + 1:].split('/')
+            params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+
+            try:
+                if len(parts) == 2 and parts[1] == 'chip':
+                    x, y = int(params['x']), int(params['y'])
+                    if not state.ready(x, y):
+                        return self._send(200, b'[]')
+
+                    body = state.chip(x, y)
+                    if body is None:
+                        return self._send(404, b'{"error": "no chip"}')
+
+                    return self._send(200, body)
+
+                if len(parts) == 3:
+                    return self._send(200, state.pixel(int(parts[1]),
+                                                       int(parts[2]),
+                                                       parts[0]))
+            except (KeyError, ValueError):
+                return self._send(400, b'{"error": "bad request"}')
+
+            return self._send(404, b'{"error": "not found"}')
+
+    return Handler
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(config=None, host='127.0.0.1', port=8080):
+    """
+    :return: server, base URL to hand to api.set_host
+    """
+    state = MockState(config or MockConfig())
+    server = ThreadedHTTPServer((host, port), _handler(state))
+    server.state = state
+
+    base = 'http://{}:{}{}'.format(host, server.server_address[1], BASE_PATH)
+
+    return server, base
+
+
+def start(config=None, host='127.0.0.1', port=0):
+    """
+    Run a mock in a background thread, port 0 picks a free port
+
+    :return: server, base URL
+    """
+    server, base = make_server(config, host, port)
+
+    thread = threading.Thread(target=server.serve_forever, name='MockAPI')
+    thread.daemon = True
+    thread.start()
+
+    return server, base
+
+
+def serve(config=None, host='127.0.0.1', port=8080):
+    server, base = make_server(config, host, port)
+    log.info('Mock changes API at {}'.format(base))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
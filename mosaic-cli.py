@@ -0,0 +1,38 @@
+import argparse
+import batch
+import mosaic
+from logger import set_level
+
+
+parser = argparse.ArgumentParser(
+        description='Mosaic per tile products into regional VRTs or merged '
+                    'GeoTIFFs. Only tiles that changed since the last run are '
+                    're-read.')
+
+parser.add_argument('tiles', help='Tiles to mosaic, ie "5,2 6,2" or a region '
+                                  '"h3-5v2-4".')
+parser.add_argument('input', help='Per tile product directory template, may '
+                                  'use {h}, {v} and {product}.')
+parser.add_argument('output', help='Output location for the mosaics.')
+parser.add_argument('--product', default='change', metavar='',
+                    help='change or class.')
+parser.add_argument('--names', default=None, metavar='',
+                    help='Comma separated product names, all if not given.')
+parser.add_argument('--years', default=None, metavar='',
+                    help='Comma separated years, all if not given.')
+parser.add_argument('-f', '--format', default='vrt', metavar='',
+                    help='vrt or tif.')
+parser.add_argument('-p', '--proc',
+                    help='Number of child processes reading blocks.',
+                    default=1, type=int, metavar='')
+parser.add_argument('--log-level', default='INFO', metavar='')
+
+args = parser.parse_args()
+
+set_level(args.log_level)
+
+mosaic.run(args.input, batch.parse_tiles(args.tiles), args.output,
+           product=args.product,
+           names=args.names.split(',') if args.names else None,
+           years=[int(y) for y in args.years.split(',')] if args.years else None,
+           fmt=args.format, cpus=args.proc)
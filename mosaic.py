@@ -0,0 +1,358 @@
+"""
+Regional mosaics of the per tile products
+
+Places each tile's GeoTIFFs with extent_from_hv and either writes a VRT
+that references them or merges them into one tiled GeoTIFF. Reading is
+done in parallel in blocks, all writes happen in the parent. A state file
+next to each mosaic remembers the tiles it was built from, so a later run
+only rebuilds the parts covered by tiles that changed.
+"""
+
+import os
+import json
+import multiprocessing as mp
+from xml.sax.saxutils import escape
+
+import numpy as np
+from osgeo import gdal
+
+import geo_utils
+from logger import log
+
+
+TILE_SIZE = 5000
+BLOCK_SIZE = 512
+# Rows per strip written, must be a multiple of BLOCK_SIZE
+BLOCK_ROWS = BLOCK_SIZE
+FORMATS = ('vrt', 'tif')
+
+CREATE_OPTIONS = ('TILED=YES',
+                  'BLOCKXSIZE={}'.format(BLOCK_SIZE),
+                  'BLOCKYSIZE={}'.format(BLOCK_SIZE),
+                  'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER')
+
+
+def product_module(product):
+    if product == 'change':
+        import change_maps
+        return change_maps
+    elif product == 'class':
+        import class_maps
+        return class_maps
+
+    raise ValueError('Unknown product: {}'.format(product))
+
+
+def raster_name(product, name, year, h, v):
+    """
+    File name change_maps or class_maps gives a product within a tile
+    """
+    if product == 'class':
+        return 'h{:02d}v{:02d}_{}_{}.tif'.format(h, v, name, year)
+
+    return '{}_{}.tif'.format(name, year)
+
+
+def tile_rasters(template, tiles, product, name, year):
+    """
+    :param template: per tile output directory, ie /data/h{h:02d}v{v:02d}/{product}
+    :return: dictionary of (h, v) -> raster path, for the tiles that have it
+    """
+    import batch
+
+    ret = {}
+    for h, v in tiles:
+        path = os.path.join(batch.tile_path(template, h, v, product),
+                            raster_name(product, name, year, h, v))
+        if os.path.exists(path):
+            ret[(h, v)] = path
+
+    return ret
+
+
+def mosaic_affine(tiles):
+    """
+    :return: GeoAffine of the upper left tile, rows, columns
+    """
+    hs = [h for h, _ in tiles]
+    vs = [v for _, v in tiles]
+
+    _, affine = geo_utils.extent_from_hv(min(hs), min(vs))
+
+    return (affine,
+            (max(vs) - min(vs) + 1) * TILE_SIZE,
+            (max(hs) - min(hs) + 1) * TILE_SIZE)
+
+
+def tile_offset(tiles, h, v):
+    """
+    Row and column of the tile's upper left within the mosaic
+    """
+    return ((v - min(t[1] for t in tiles)) * TILE_SIZE,
+            (h - min(t[0] for t in tiles)) * TILE_SIZE)
+
+
+def file_state(path):
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def state_path(mosaic_path):
+    return mosaic_path + '.state.json'
+
+
+def load_state(mosaic_path):
+    path = state_path(mosaic_path)
+
+    if not os.path.exists(mosaic_path) or not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_state(mosaic_path, rasters):
+    state = {'tiles': dict(('{},{}'.format(h, v), [p] + file_state(p))
+                           for (h, v), p in rasters.items())}
+
+    with open(state_path(mosaic_path), 'w') as f:
+        json.dump(state, f, sort_keys=True)
+
+
+def changed_tiles(mosaic_path, rasters):
+    """
+    Tiles whose rasters differ from when the mosaic was last built
+
+    :return: list of (h, v), None if the mosaic has to be built from scratch
+    """
+    state = load_state(mosaic_path)
+
+    if state is None:
+        return None
+
+    keys = dict(('{},{}'.format(h, v), (h, v)) for h, v in rasters)
+    if set(keys) != set(state['tiles']):
+        return None
+
+    return [keys[k] for k in sorted(keys)
+            if state['tiles'][k] != [rasters[keys[k]]] + file_state(rasters[keys[k]])]
+
+
+def write_vrt(vrt_path, rasters, data_type, proj):
+    """
+    VRT referencing each tile's raster in place
+
+    :param rasters: dictionary of (h, v) -> raster path
+    :param data_type: GDAL data type name, ie 'UInt16'
+    """
+    tiles = sorted(rasters)
+    affine, rows, cols = mosaic_affine(tiles)
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_path))
+
+    lines = ['<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(cols, rows),
+             '  <SRS>{}</SRS>'.format(escape(proj)),
+             '  <GeoTransform>{}, {}, {}, {}, {}, {}</GeoTransform>'
+             .format(*affine),
+             '  <VRTRasterBand dataType="{}" band="1">'.format(data_type),
+             '    <NoDataValue>0</NoDataValue>']
+
+    for h, v in tiles:
+        row_off, col_off = tile_offset(tiles, h, v)
+        source = os.path.relpath(os.path.abspath(rasters[(h, v)]), vrt_dir)
+
+        lines.extend(['    <SimpleSource>',
+                      '      <SourceFilename relativeToVRT="1">{}</SourceFilename>'
+                      .format(escape(source)),
+                      '      <SourceBand>1</SourceBand>',
+                      '      <SrcRect xOff="0" yOff="0" xSize="{0}" ySize="{0}"/>'
+                      .format(TILE_SIZE),
+                      '      <DstRect xOff="{}" yOff="{}" xSize="{}" ySize="{}"/>'
+                      .format(col_off, row_off, TILE_SIZE, TILE_SIZE),
+                      '    </SimpleSource>'])
+
+    lines.extend(['  </VRTRasterBand>', '</VRTDataset>', ''])
+
+    with open(vrt_path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def block_tasks(rasters, tiles=None, block_rows=BLOCK_ROWS):
+    """
+    Full width strips of the mosaic. Tiles are not aligned to the 512 pixel
+    block grid, so the strips are, and every compressed block is written
+    whole and only once.
+
+    :param tiles: only the strips covering these tiles, all if None
+    :return: list of (mosaic row, rows, columns, sources), sources are
+        (raster path, row within tile, rows, row within strip, mosaic column)
+    """
+    if block_rows % BLOCK_SIZE:
+        raise ValueError('block_rows must be a multiple of {}'.format(BLOCK_SIZE))
+
+    all_tiles = sorted(rasters)
+    _, rows, cols = mosaic_affine(all_tiles)
+    offsets = dict((t, tile_offset(all_tiles, *t)) for t in all_tiles)
+    wanted = all_tiles if tiles is None else tiles
+
+    tasks = []
+    for start in range(0, rows, block_rows):
+        end = min(start + block_rows, rows)
+
+        if not any(offsets[t][0] < end and start < offsets[t][0] + TILE_SIZE
+                   for t in wanted):
+            continue
+
+        sources = []
+        for t in all_tiles:
+            row_off, col_off = offsets[t]
+            top = max(start, row_off)
+            bottom = min(end, row_off + TILE_SIZE)
+
+            if top < bottom:
+                sources.append((rasters[t], top - row_off, bottom - top,
+                                top - start, col_off))
+
+        if sources:
+            tasks.append((start, end - start, cols, sources))
+
+    return tasks
+
+
+def read_block(task):
+    """
+    Pool side, assemble one strip of the mosaic from the tiles it crosses
+    """
+    mosaic_row, nrows, cols, sources = task
+
+    data = None
+    for path, row, src_rows, strip_row, mosaic_col in sources:
+        ds = geo_utils.get_raster_ds(path)
+        src = ds.GetRasterBand(1).ReadAsArray(0, row, TILE_SIZE, src_rows)
+
+        if data is None:
+            data = np.zeros((nrows, cols), dtype=src.dtype)
+
+        data[strip_row:strip_row + src_rows,
+             mosaic_col:mosaic_col + TILE_SIZE] = src
+
+    return mosaic_row, data
+
+
+def create_mosaic(tif_path, rasters, data_type, proj):
+    tiles = sorted(rasters)
+    affine, rows, cols = mosaic_affine(tiles)
+
+    ds = (gdal
+          .GetDriverByName('GTiff')
+          .Create(tif_path, cols, rows, 1, data_type, list(CREATE_OPTIONS)))
+
+    ds.SetGeoTransform(affine)
+    ds.SetProjection(proj)
+    ds.GetRasterBand(1).SetNoDataValue(0)
+
+    return ds
+
+
+def write_tif(tif_path, rasters, data_type, proj, pool, tiles=None,
+              block_rows=BLOCK_ROWS):
+    """
+    Merge the tiles into one tiled GeoTIFF, or rewrite the strips of an
+    existing one that cross tiles
+
+    :param data_type: GDAL data type
+    :param pool: multiprocessing pool doing the reads
+    :param tiles: tiles to update, the whole mosaic is built if None
+    """
+    if tiles is None or not os.path.exists(tif_path):
+        ds = create_mosaic(tif_path, rasters, data_type, proj)
+        tiles = None
+    else:
+        ds = gdal.Open(tif_path, gdal.GA_Update)
+
+    band = ds.GetRasterBand(1)
+    tasks = block_tasks(rasters, tiles, block_rows)
+
+    # In order, so each strip's blocks are flushed before the next begins
+    for mosaic_row, data in pool.imap(read_block, tasks):
+        band.WriteArray(data, 0, mosaic_row)
+
+    ds.FlushCache()
+    ds = None
+
+    return len(tasks)
+
+
+def mosaic_product(template, tiles, output_dir, product, name, year, fmt,
+                   pool, block_rows=BLOCK_ROWS):
+    """
+    Build or refresh the mosaic of one product for one year
+
+    :return: path of the mosaic, None if no tile has the product
+    """
+    rasters = tile_rasters(template, tiles, product, name, year)
+
+    if not rasters:
+        return None
+
+    mod = product_module(product)
+    data_type = mod.prod_data_type(name)
+    out = os.path.join(output_dir, '{}_{}_{}.{}'.format(product, name, year, fmt))
+
+    changed = changed_tiles(out, rasters)
+
+    if changed is not None and not changed:
+        log.debug('%s is up to date', out)
+        return out
+
+    if fmt == 'vrt':
+        # Tile contents are read through the VRT, only the tile set matters
+        if changed is None:
+            write_vrt(out, rasters, gdal.GetDataTypeName(data_type), mod.CONUS_WKT)
+    else:
+        count = write_tif(out, rasters, data_type, mod.CONUS_WKT, pool,
+                          changed, block_rows)
+        log.debug('Wrote %s blocks to %s', count, out)
+
+    save_state(out, rasters)
+    log.info('Mosaicked %s from %s tiles', out, len(rasters))
+
+    return out
+
+
+def run(template, tiles, output_dir, product='change', names=None, years=None,
+        fmt='vrt', cpus=1, block_rows=BLOCK_ROWS):
+    """
+    :param template: per tile output directory, may use {h}, {v} and {product}
+    :param tiles: list of (h, v)
+    :param product: 'change' or 'class'
+    :param names: product names, all of the module's MAP_NAMES if None
+    :param years: all of the module's YEARS if None
+    :param fmt: 'vrt' or 'tif'
+    :return: list of mosaics written or already up to date
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format: {}'.format(fmt))
+
+    mod = product_module(product)
+    names = names or mod.MAP_NAMES
+    years = years or mod.YEARS
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    pool = mp.Pool(processes=cpus) if fmt == 'tif' else None
+
+    try:
+        ret = []
+        for name in names:
+            for year in years:
+                out = mosaic_product(template, tiles, output_dir, product,
+                                     name, year, fmt, pool, block_rows)
+                if out is not None:
+                    ret.append(out)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return ret
@@ -0,0 +1,35 @@
+import argparse
+import pixel_service as ps
+from logger import set_level
+
+
+parser = argparse.ArgumentParser(
+        description='Serve per pixel models and product values from local '
+                    'tile stores.')
+parser.add_argument('store', help='Root directory of the tile stores.')
+parser.add_argument('--log-level', default='INFO', metavar='')
+
+sub = parser.add_subparsers(dest='command')
+
+build = sub.add_parser('build', help='Build the store for a tile.')
+build.add_argument('h', help='ARD Grid h value.', type=int)
+build.add_argument('v', help='ARD Grid v value.', type=int)
+build.add_argument('-r', '--records', default=None, metavar='',
+                   help='Directory of record_change Matlab files.')
+build.add_argument('-c', '--classes', default=None, metavar='',
+                   help='Directory of class pickles.')
+
+serve = sub.add_parser('serve', help='Start the HTTP service.')
+serve.add_argument('--host', default='127.0.0.1', metavar='')
+serve.add_argument('--port', default=8070, type=int, metavar='')
+serve.add_argument('--hot-set', default=ps.HOT_SET_SIZE, type=int, metavar='',
+                   help='Pixels kept decoded per tile.')
+
+args = parser.parse_args()
+
+set_level(args.log_level)
+
+if args.command == 'build':
+    ps.build_store(args.store, args.h, args.v, args.records, args.classes)
+else:
+    ps.serve(args.store, args.host, args.port, args.hot_set)
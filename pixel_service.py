@@ -0,0 +1,553 @@
+"""
+Local pixel query service
+
+Answers "what models and product values does this pixel have" from tile
+stores on disk, without going to the LCMAP API. A tile store is built once
+from the json_matlab row files, and optionally the class pickles, into flat
+record arrays sorted on pixel position that are memory-mapped when served,
+so only the pages for the pixels asked about are ever read.
+
+GET  /pixel?h=5&v=2&row=10&col=20&dates=2000-07-01,2001-07-01
+GET  /pixel?x=-2115585&y=2564805
+POST /pixels  {"pixels": [{"h": 5, "v": 2, "row": 10, "col": 20}, ...],
+               "dates": ["2000-07-01"]}
+GET  /metrics  Prometheus text
+"""
+
+import os
+import json
+import threading
+import datetime as dt
+from bisect import bisect_left
+from collections import OrderedDict
+from timeit import default_timer
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+import numpy as np
+
+import geo_utils
+import json_matlab
+import change_products as cp
+import class_products as clp
+from logger import log
+
+
+CHANGE_NAMES = ('ChangeMap', 'ChangeMagMap', 'QAMap', 'SegLength', 'LastChange')
+CLASS_NAMES = ('CoverPrim', 'CoverSec', 'CoverConfPrim', 'CoverConfSec', 'SegChange')
+
+# Same as the annual products
+QUERY_DATES = tuple(dt.date(year=i, month=7, day=1).toordinal()
+                    for i in range(1984, 2016))
+
+MAX_CLASSES = 8
+
+# class_probs are kept as float64, the confidences truncate probs * 100 and
+# float32 rounding would change some of them
+CLASS_DTYPE = np.dtype([('pos', 'i4'),
+                        ('start_day', 'i4'),
+                        ('end_day', 'i4'),
+                        ('class_probs', 'f8', MAX_CLASSES),
+                        ('class_vals', 'i4', MAX_CLASSES)])
+
+STORE_META = 'store.json'
+HOT_SET_SIZE = 4096
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0)
+
+
+def store_dir(store_root, h, v):
+    return os.path.join(store_root, 'h{:02d}v{:02d}'.format(h, v))
+
+
+def _table_files(path, table):
+    return (os.path.join(path, '{}.npy'.format(table)),
+            os.path.join(path, '{}_rows.npy'.format(table)))
+
+
+def _write_table(path, table, dtype, row_arrays):
+    """
+    Write a table from an iterable of (row, records) with rows in ascending
+    order and records sorted on pos. Records go straight into the memory
+    mapped output, so a tile never has to fit in memory.
+
+    :param row_arrays: callable returning the iterable, it is walked twice,
+        once to size the output
+    """
+    data_file, rows_file = _table_files(path, table)
+
+    row_counts = np.zeros(5000, dtype=np.int64)
+    for row, records in row_arrays():
+        row_counts[row] += len(records)
+
+    row_starts = np.zeros(5001, dtype=np.int64)
+    row_starts[1:] = np.cumsum(row_counts)
+
+    out = np.lib.format.open_memmap(data_file, mode='w+', dtype=dtype,
+                                    shape=(max(int(row_starts[-1]), 1),))
+    filled = row_starts[:-1].copy()
+    for row, records in row_arrays():
+        out[filled[row]:filled[row] + len(records)] = records
+        filled[row] += len(records)
+
+    out.flush()
+    del out
+
+    np.save(rows_file, row_starts)
+
+    return int(row_starts[-1])
+
+
+def _change_rows(record_dir):
+    files = sorted((int(f[13:-4]) - 1, os.path.join(record_dir, f))
+                   for f in os.listdir(record_dir)
+                   if f.startswith('record_change') and f.endswith('.mat'))
+
+    for row, record_file in files:
+        record = json_matlab.load_record(record_file)
+        yield row, record[np.argsort(record['pos'], kind='mergesort')]
+
+
+def _class_rows(class_dir, h, v):
+    """
+    Class chips are 100 rows high, so each is split into its rows
+    """
+    import class_maps
+
+    ext, _ = geo_utils.extent_from_hv(h, v)
+
+    chips = []
+    for f in os.listdir(class_dir):
+        try:
+            chip_x, chip_y = (int(c) for c in class_maps.coords_frompath(f))
+        except (ValueError, IndexError):
+            continue
+        chips.append(((ext.y_max - chip_y) // 30, (chip_x - ext.x_min) // 30,
+                      os.path.join(class_dir, f)))
+
+    chips.sort()
+
+    # Group the chips in each band of rows so every row comes out once
+    for band in sorted(set(c[0] for c in chips)):
+        pos, start, end, vals, probs = [], [], [], [], []
+
+        for row0, col0, class_file in (c for c in chips if c[0] == band):
+            data = class_maps.open_classpickle(class_file)
+
+            for idx, models in enumerate(data):
+                p = (row0 + idx // 100) * 5000 + col0 + idx % 100 + 1
+
+                for m in models:
+                    m_vals = list(m['class_vals'])[:MAX_CLASSES]
+                    m_probs = np.asarray(m['class_probs']).ravel()[:MAX_CLASSES]
+
+                    pos.append(p)
+                    start.append(m['start_day'])
+                    end.append(m['end_day'])
+                    vals.append(np.pad(m_vals, (0, MAX_CLASSES - len(m_vals)),
+                                       'constant'))
+                    probs.append(np.pad(m_probs, (0, MAX_CLASSES - len(m_probs)),
+                                        'constant'))
+
+        if not pos:
+            continue
+
+        records = np.zeros(len(pos), dtype=CLASS_DTYPE)
+        records['pos'] = pos
+        records['start_day'] = start
+        records['end_day'] = end
+        records['class_vals'] = vals
+        records['class_probs'] = probs
+        records = records[np.argsort(records['pos'], kind='mergesort')]
+
+        rows = (records['pos'] - 1) // 5000
+        bounds = np.flatnonzero(np.diff(rows)) + 1
+
+        for chunk in np.split(records, bounds):
+            yield int((chunk['pos'][0] - 1) // 5000), chunk
+
+
+def build_store(store_root, h, v, record_dir=None, class_dir=None):
+    """
+    Build the memory-mappable store for a tile
+
+    :param store_root: stores are kept in store_root/hHHvVV
+    :param record_dir: directory of record_change{row}.mat files
+    :param class_dir: directory of class pickles, named as for class_maps
+    :return: dictionary of table -> number of records
+    """
+    path = store_dir(store_root, h, v)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    counts = {}
+
+    if record_dir is not None:
+        counts['change'] = _write_table(path, 'change',
+                                        json_matlab.record_template().dtype,
+                                        lambda: _change_rows(record_dir))
+
+    if class_dir is not None:
+        counts['class'] = _write_table(path, 'class', CLASS_DTYPE,
+                                       lambda: _class_rows(class_dir, h, v))
+
+    with open(os.path.join(path, STORE_META), 'w') as f:
+        json.dump({'h': h, 'v': v, 'tables': counts}, f)
+
+    log.info('Built store for h{:02d}v{:02d}: {}'.format(h, v, counts))
+
+    return counts
+
+
+class TileStore(object):
+    """
+    Memory-mapped tables for one tile, with an LRU of recently asked for
+    pixels
+    """
+    def __init__(self, path, hot_set=HOT_SET_SIZE):
+        with open(os.path.join(path, STORE_META), 'r') as f:
+            meta = json.load(f)
+
+        self.h = meta['h']
+        self.v = meta['v']
+        self.tables = {}
+
+        for table in meta['tables']:
+            data_file, rows_file = _table_files(path, table)
+            self.tables[table] = (np.load(data_file, mmap_mode='r'),
+                                  np.load(rows_file))
+
+        self.hot_set = hot_set
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _slice(self, table, row, col):
+        data, row_starts = self.tables[table]
+        start, end = int(row_starts[row]), int(row_starts[row + 1])
+
+        if start == end:
+            return data[0:0]
+
+        pos = row * 5000 + col + 1
+        row_pos = data['pos'][start:end]
+        first = start + int(np.searchsorted(row_pos, pos, side='left'))
+        last = start + int(np.searchsorted(row_pos, pos, side='right'))
+
+        return np.array(data[first:last])
+
+    def pixel(self, row, col):
+        """
+        :return: dictionary of table -> records for the pixel
+        """
+        key = (row, col)
+
+        with self._lock:
+            ret = self._cache.pop(key, None)
+            if ret is not None:
+                self._cache[key] = ret
+                self.hits += 1
+                return ret
+            self.misses += 1
+
+        ret = dict((t, self._slice(t, row, col)) for t in self.tables)
+
+        with self._lock:
+            self._cache[key] = ret
+            while len(self._cache) > self.hot_set:
+                self._cache.popitem(last=False)
+
+        return ret
+
+
+def change_models(records):
+    return [cp.ChangeModel(start_day=json_matlab.matordinal_to_pyordinal(int(r['t_start'])),
+                           end_day=json_matlab.matordinal_to_pyordinal(int(r['t_end'])),
+                           break_day=json_matlab.matordinal_to_pyordinal(int(r['t_break'])),
+                           qa=int(r['category']),
+                           magnitudes=r['magnitude'].astype(np.float64),
+                           change_prob=int(r['change_prob']))
+            for r in records]
+
+
+def class_models(records):
+    models = [clp.ClassModel(start_day=int(r['start_day']),
+                             end_day=int(r['end_day']),
+                             class_probs=r['class_probs'].reshape(1, -1),
+                             class_vals=r['class_vals'].tolist())
+              for r in records]
+
+    return clp.sort_models(models) if models else models
+
+
+def change_values(models, ord_date):
+    return {'ChangeMap': cp.changedate_val(models, ord_date),
+            'ChangeMagMap': float(cp.changemag_val(models, ord_date)),
+            'QAMap': cp.qa_val(models, ord_date),
+            'SegLength': cp.seglength_val(models, ord_date),
+            'LastChange': cp.lastchange_val(models, ord_date)}
+
+
+def class_values(models, ord_date):
+    if not models:
+        return dict((n, 0) for n in CLASS_NAMES)
+
+    return {'CoverPrim': int(clp.class_primary(models, ord_date)),
+            'CoverSec': int(clp.class_secondary(models, ord_date)),
+            'CoverConfPrim': clp.conf_primary(models, ord_date),
+            'CoverConfSec': clp.conf_secondary(models, ord_date),
+            'SegChange': clp.segchange(models, ord_date)}
+
+
+def parse_date(value):
+    """
+    ISO date, 2000-07-01, or an ordinal
+    """
+    value = str(value)
+
+    if '-' in value:
+        return dt.datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+
+    return int(value)
+
+
+def tile_for_coordinate(x, y):
+    conus = geo_utils.CONUS_EXTENT
+    size = 5000 * 30
+
+    return int((x - conus.x_min) // size), int((conus.y_max - y) // size)
+
+
+def _model_json(m):
+    ret = dict(m._asdict())
+    for k in ret:
+        if isinstance(ret[k], np.ndarray):
+            ret[k] = ret[k].tolist()
+
+    return ret
+
+
+class Latency(object):
+    """
+    Cumulative latency histogram, rendered as Prometheus text
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            idx = bisect_left(self.buckets, seconds)
+            if idx < len(self.counts):
+                self.counts[idx] += 1
+            self.count += 1
+            self.total += seconds
+
+    def to_prometheus(self, name, labels=''):
+        lines = []
+        with self._lock:
+            running = 0
+            for bound, count in zip(self.buckets, self.counts):
+                running += count
+                lines.append('{}_bucket{{{}le="{}"}} {}'
+                             .format(name, labels, bound, running))
+            lines.append('{}_bucket{{{}le="+Inf"}} {}'
+                         .format(name, labels, self.count))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels.rstrip(','), self.total))
+            lines.append('{}_count{{{}}} {}'.format(name, labels.rstrip(','), self.count))
+
+        return lines
+
+
+class PixelService(object):
+    """
+    Opens tile stores under store_root as they are asked for
+    """
+    def __init__(self, store_root, hot_set=HOT_SET_SIZE):
+        self.store_root = store_root
+        self.hot_set = hot_set
+        self.stores = {}
+        self.latency = {'pixel': Latency(), 'pixels': Latency()}
+        self._lock = threading.Lock()
+
+    def store(self, h, v):
+        with self._lock:
+            if (h, v) not in self.stores:
+                path = store_dir(self.store_root, h, v)
+                if not os.path.exists(os.path.join(path, STORE_META)):
+                    raise KeyError('No store for h{:02d}v{:02d}'.format(h, v))
+                self.stores[(h, v)] = TileStore(path, self.hot_set)
+
+            return self.stores[(h, v)]
+
+    def query(self, h=None, v=None, row=None, col=None, x=None, y=None,
+              dates=QUERY_DATES, models=True):
+        """
+        Models and product values for a pixel, given either tile row/col or
+        a map coordinate
+
+        :return: JSON serializable dictionary
+        """
+        if x is not None and y is not None:
+            x, y = float(x), float(y)
+            if h is None or v is None:
+                h, v = tile_for_coordinate(x, y)
+            _, affine = geo_utils.extent_from_hv(int(h), int(v))
+            rowcol = geo_utils.geo_to_rowcol(affine, geo_utils.GeoCoordinate(x=x, y=y))
+            row, col = rowcol.row, rowcol.column
+
+        h, v, row, col = int(h), int(v), int(row), int(col)
+
+        if not (0 <= row < 5000 and 0 <= col < 5000):
+            raise ValueError('Pixel {}, {} is outside of the tile'.format(row, col))
+
+        records = self.store(h, v).pixel(row, col)
+        chg = change_models(records['change']) if 'change' in records else []
+        cls = class_models(records['class']) if 'class' in records else []
+
+        values = {}
+        for d in dates:
+            vals = {}
+            if 'change' in records:
+                vals.update(change_values(chg, d))
+            if 'class' in records:
+                vals.update(class_values(cls, d))
+            values[dt.date.fromordinal(d).isoformat()] = vals
+
+        ret = {'h': h, 'v': v, 'row': row, 'col': col, 'values': values}
+
+        if models:
+            ret['change_models'] = [_model_json(m) for m in chg]
+            ret['class_models'] = [_model_json(m) for m in cls]
+
+        return ret
+
+    def query_many(self, pixels, dates=QUERY_DATES, models=True):
+        ret = []
+
+        for p in pixels:
+            try:
+                ret.append(self.query(dates=dates, models=models, **p))
+            except (KeyError, ValueError, TypeError) as e:
+                ret.append({'request': p, 'error': str(e)})
+
+        return ret
+
+    def metrics_text(self):
+        lines = ['# TYPE ccd_pixel_request_seconds histogram']
+        for endpoint in sorted(self.latency):
+            lines.extend(self.latency[endpoint]
+                         .to_prometheus('ccd_pixel_request_seconds',
+                                        'endpoint="{}",'.format(endpoint)))
+
+        lines.append('# TYPE ccd_pixel_cache_total counter')
+        for (h, v), store in sorted(self.stores.items()):
+            tile = 'h{:02d}v{:02d}'.format(h, v)
+            lines.append('ccd_pixel_cache_total{{tile="{}",result="hit"}} {}'
+                         .format(tile, store.hits))
+            lines.append('ccd_pixel_cache_total{{tile="{}",result="miss"}} {}'
+                         .format(tile, store.misses))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            log.debug('%s - %s', self.address_string(), format % args)
+
+        def _send(self, code, body, content_type='application/json'):
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _dates(self, values):
+            if not values:
+                return QUERY_DATES
+            return [parse_date(d) for d in values]
+
+        def do_GET(self):
+            url = urlparse(self.path)
+
+            if url.path == '/metrics':
+                return self._send(200, service.metrics_text(), 'text/plain')
+
+            if url.path != '/pixel':
+                return self._send(404, json.dumps({'error': 'not found'}))
+
+            start = default_timer()
+            params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+
+            try:
+                dates = self._dates(params.pop('dates', '').split(',')
+                                    if params.get('dates') else None)
+                models = params.pop('models', 'true').lower() != 'false'
+                ret = service.query(dates=dates, models=models, **params)
+            except KeyError as e:
+                return self._send(404, json.dumps({'error': str(e)}))
+            except (ValueError, TypeError) as e:
+                return self._send(400, json.dumps({'error': str(e)}))
+
+            self._send(200, json.dumps(ret))
+            service.latency['pixel'].observe(default_timer() - start)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+
+            if url.path != '/pixels':
+                return self._send(404, json.dumps({'error': 'not found'}))
+
+            start = default_timer()
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+                dates = self._dates(body.get('dates'))
+                ret = service.query_many(body['pixels'], dates,
+                                         body.get('models', True))
+            except (KeyError, ValueError, TypeError) as e:
+                return self._send(400, json.dumps({'error': str(e)}))
+
+            self._send(200, json.dumps(ret))
+            service.latency['pixels'].observe(default_timer() - start)
+
+    return Handler
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(store_root, host='127.0.0.1', port=8070, hot_set=HOT_SET_SIZE):
+    service = PixelService(store_root, hot_set)
+
+    return ThreadedHTTPServer((host, port), _handler(service))
+
+
+def serve(store_root, host='127.0.0.1', port=8070, hot_set=HOT_SET_SIZE):
+    server = make_server(store_root, host, port, hot_set)
+    log.info('Serving pixels from {} on {}:{}'.format(store_root, host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,310 @@
+"""
+Tile summary statistics
+
+Accumulated from each chip as the writer outputs it, so per year change
+counts, magnitude histograms and class transitions are available at the
+end of a run without reading the products back. Each chip's statistics
+are kept in a sidecar next to the summary, a rerun replaces the entries
+of the chips it wrote and the summary is rebuilt from all of them.
+"""
+
+import os
+import csv
+import json
+import pickle
+
+import numpy as np
+
+
+# Magnitude histogram bin edges, the last bin takes everything above
+MAG_EDGES = tuple(range(0, 5001, 100))
+
+# CoverPrim values, 1 - 8 plus 9 for transition and 0 for no data, which
+# is not counted
+CLASS_COUNT = 10
+
+
+def change_stats():
+    return {'covered': 0, 'magnitude_chips': 0, 'years': {}}
+
+
+def label_year(label):
+    """
+    Year of a product label, see dates.date_labels
+    """
+    return int(str(label)[:4])
+
+
+def _year_change(stats, year):
+    if year not in stats['years']:
+        stats['years'][year] = {'change': 0,
+                                'magnitude_sum': 0.0,
+                                'histogram': np.zeros(len(MAG_EDGES), dtype=np.int64)}
+
+    return stats['years'][year]
+
+
+def add_change(stats, data, coverage):
+    """
+    :param data: map dictionary from change_maps
+    :param coverage: coverage array of the chip
+    """
+    stats['covered'] += int(np.count_nonzero(coverage))
+
+    changes = data.get('ChangeMap', {})
+    mags = data.get('ChangeMagMap')
+
+    if mags is not None:
+        stats['magnitude_chips'] += 1
+
+    # Change is per year, so with more than one date a year every label in
+    # it repeats the same change and is only counted once
+    years = {}
+    for label in sorted(changes):
+        years.setdefault(label_year(label), []).append(label)
+
+    for year, labels in years.items():
+        changed = np.zeros(changes[labels[0]].shape, dtype=bool)
+        values = np.zeros(changed.shape)
+
+        for label in labels:
+            new = (changes[label] > 0) & ~changed
+            changed |= new
+
+            if mags is not None:
+                values[new] = mags[label][new]
+
+        count = int(np.count_nonzero(changed))
+
+        if not count:
+            continue
+
+        year_stats = _year_change(stats, year)
+        year_stats['change'] += count
+
+        if mags is not None:
+            values = values[changed]
+            bins = np.searchsorted(MAG_EDGES, values, side='right') - 1
+            year_stats['histogram'] += np.bincount(np.clip(bins, 0, None),
+                                                   minlength=len(MAG_EDGES))
+            year_stats['magnitude_sum'] += float(values.sum())
+
+
+def change_chip(data, coverage):
+    """
+    Packed stats of a single chip, for the sidecar
+    """
+    stats = change_stats()
+    add_change(stats, data, coverage)
+
+    return pack(stats)
+
+
+def change_summary(stats):
+    years = {}
+
+    # Without ChangeMagMap there are no magnitudes to summarize
+    has_mags = stats['magnitude_chips'] > 0
+
+    for year in sorted(stats['years']):
+        s = stats['years'][year]
+        years[str(year)] = {'change_pixels': s['change'],
+                            'change_fraction': (s['change'] / float(stats['covered'])
+                                                if stats['covered'] else 0.0),
+                            'mean_magnitude': ((s['magnitude_sum'] / s['change']
+                                                if s['change'] else 0.0)
+                                               if has_mags else None),
+                            'magnitude_histogram': (s['histogram'].tolist()
+                                                    if has_mags else None)}
+
+    return {'covered_pixels': stats['covered'],
+            'magnitude_edges': list(MAG_EDGES),
+            'years': years}
+
+
+def class_stats():
+    return {'counts': {}, 'transitions': {}}
+
+
+def add_class(stats, data):
+    """
+    :param data: map dictionary from class_maps
+    """
+    prims = data.get('CoverPrim', {})
+    years = sorted(prims)
+
+    for year in years:
+        values = np.clip(prims[year].astype(np.int64).ravel(), 0, CLASS_COUNT - 1)
+        counts = np.bincount(values[values > 0], minlength=CLASS_COUNT)
+
+        if year in stats['counts']:
+            stats['counts'][year] += counts
+        else:
+            stats['counts'][year] = counts
+
+    for prev, year in zip(years[:-1], years[1:]):
+        src = np.clip(prims[prev].astype(np.int64).ravel(), 0, CLASS_COUNT - 1)
+        dst = np.clip(prims[year].astype(np.int64).ravel(), 0, CLASS_COUNT - 1)
+
+        # Pixels without data in either year are left out, as are the
+        # chips that had none at all
+        keep = (src > 0) | (dst > 0)
+        trans = np.bincount(src[keep] * CLASS_COUNT + dst[keep],
+                            minlength=CLASS_COUNT ** 2).reshape(CLASS_COUNT,
+                                                                CLASS_COUNT)
+        key = (prev, year)
+
+        if key in stats['transitions']:
+            stats['transitions'][key] += trans
+        else:
+            stats['transitions'][key] = trans
+
+
+def class_chip(data):
+    stats = class_stats()
+    add_class(stats, data)
+
+    return pack(stats)
+
+
+def class_summary(stats):
+    return {'class_counts': dict((str(y), stats['counts'][y].tolist())
+                                 for y in sorted(stats['counts'])),
+            'transitions': dict(('{}-{}'.format(*k), stats['transitions'][k].tolist())
+                                for k in sorted(stats['transitions']))}
+
+
+def summary_path(output_dir, h, v, product, ext):
+    return os.path.join(output_dir, 'h{:02d}v{:02d}_{}_summary.{}'
+                        .format(h, v, product, ext))
+
+
+def chip_key(data):
+    return '{}_{}'.format(int(data['chip_x']), int(data['chip_y']))
+
+
+def pack(stats):
+    """
+    Stats with their arrays stored sparse, as kept per chip
+    """
+    if isinstance(stats, dict):
+        return dict((k, pack(v)) for k, v in stats.items())
+    elif isinstance(stats, np.ndarray):
+        idx = np.flatnonzero(stats)
+        return ('sparse', stats.shape, idx, stats.ravel()[idx])
+
+    return stats
+
+
+def unpack(stats):
+    if isinstance(stats, dict):
+        return dict((k, unpack(v)) for k, v in stats.items())
+    elif isinstance(stats, tuple) and stats[:1] == ('sparse',):
+        _, shape, idx, vals = stats
+        arr = np.zeros(shape, dtype=vals.dtype)
+        arr.ravel()[idx] = vals
+        return arr
+
+    return stats
+
+
+def merge(total, stats):
+    """
+    Add stats into total, both in the layout of change_stats or class_stats
+    """
+    for k, v in stats.items():
+        if isinstance(v, dict):
+            merge(total.setdefault(k, {}), v)
+        elif k in total:
+            total[k] = total[k] + v
+        else:
+            total[k] = v.copy() if isinstance(v, np.ndarray) else v
+
+    return total
+
+
+def chips_path(output_dir, h, v, product):
+    return os.path.join(output_dir, 'h{:02d}v{:02d}_{}_chips.p'
+                        .format(h, v, product))
+
+
+def update_chips(output_dir, h, v, product, chip_stats):
+    """
+    Replace the sidecar entries of the chips written
+
+    :param chip_stats: dictionary of chip_key -> packed stats
+    :return: every chip's packed stats
+    """
+    path = chips_path(output_dir, h, v, product)
+
+    entries = {}
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            entries = pickle.load(f)
+
+    entries.update(chip_stats)
+
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(entries, f, protocol=2)
+    os.rename(path + '.tmp', path)
+
+    return entries
+
+
+def write_change_chips(output_dir, h, v, chip_stats):
+    """
+    Save the chips' stats to the sidecar and rebuild the summary from it
+    """
+    total = change_stats()
+    for stats in update_chips(output_dir, h, v, 'change', chip_stats).values():
+        merge(total, unpack(stats))
+
+    return write_change_summary(output_dir, h, v, total)
+
+
+def write_class_chips(output_dir, h, v, chip_stats):
+    total = class_stats()
+    for stats in update_chips(output_dir, h, v, 'class', chip_stats).values():
+        merge(total, unpack(stats))
+
+    return write_class_summary(output_dir, h, v, total)
+
+
+def write_change_summary(output_dir, h, v, stats):
+    summary = change_summary(stats)
+
+    with open(summary_path(output_dir, h, v, 'change', 'json'), 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+
+    with open(summary_path(output_dir, h, v, 'change', 'csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['year', 'covered_pixels', 'change_pixels',
+                         'change_fraction', 'mean_magnitude'] +
+                        ['mag_{}'.format(e) for e in MAG_EDGES])
+
+        for year in sorted(summary['years']):
+            s = summary['years'][year]
+            writer.writerow([year, summary['covered_pixels'], s['change_pixels'],
+                             s['change_fraction'], s['mean_magnitude']] +
+                            (s['magnitude_histogram'] or [None] * len(MAG_EDGES)))
+
+    return summary
+
+
+def write_class_summary(output_dir, h, v, stats):
+    summary = class_summary(stats)
+
+    with open(summary_path(output_dir, h, v, 'class', 'json'), 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+
+    with open(summary_path(output_dir, h, v, 'class', 'csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['from_year', 'to_year', 'from_class', 'to_class',
+                         'pixels'])
+
+        for key in sorted(stats['transitions']):
+            trans = stats['transitions'][key]
+            for src, dst in zip(*np.nonzero(trans)):
+                writer.writerow([key[0], key[1], src, dst, trans[src, dst]])
+
+    return summary
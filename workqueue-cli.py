@@ -0,0 +1,81 @@
+import argparse
+import json
+import dates
+import workqueue as wq
+from logger import set_level
+
+
+parser = argparse.ArgumentParser(
+        description='Distribute a tile job across machines through a work '
+                    'directory on shared storage.')
+parser.add_argument('work_dir', help='Shared work directory for the job.')
+parser.add_argument('--log-level', default='INFO', metavar='')
+
+sub = parser.add_subparsers(dest='command')
+
+pub = sub.add_parser('publish', help='Create the job and its tasks.')
+pub.add_argument('product', help='One of: {}'.format(', '.join(wq.PRODUCTS)))
+pub.add_argument('h', help='ARD Grid h value.', type=int)
+pub.add_argument('v', help='ARD Grid v value.', type=int)
+pub.add_argument('output', help='Output location for the products.')
+pub.add_argument('-i', '--input', help='Input location of the chips.',
+                 default=None, metavar='')
+pub.add_argument('-a', '--algorithm', default=None, metavar='',
+                 help='Algorithm version, for matlab pulled from the API.')
+pub.add_argument('--products', default=None, metavar='',
+                 help='Comma separated products to make, all if not given.')
+pub.add_argument('--frequency', default='annual', choices=dates.FREQUENCIES,
+                 metavar='', help='Make products for one date a year, a '
+                                  'month or a day: annual, monthly or daily.')
+pub.add_argument('--start-year', default=1984, type=int, metavar='',
+                 help='First year to make products for.')
+pub.add_argument('--end-year', default=2015, type=int, metavar='',
+                 help='Last year to make products for.')
+pub.add_argument('--engine', default='sweep', metavar='',
+                 help='How dates are evaluated: sweep or reference.')
+pub.add_argument('--aoi', default=None, metavar='',
+                 help='Area of interest, x_min,y_min,x_max,y_max in the tile '
+                      'projection, a shapefile or WKT, reachable from every '
+                      'worker.')
+
+work = sub.add_parser('work', help='Pull and execute tasks.')
+work.add_argument('-p', '--proc', help='Number of local worker processes.',
+                  default=1, type=int, metavar='')
+work.add_argument('--lease-timeout', default=wq.LEASE_TIMEOUT, type=int,
+                  metavar='', help='Seconds before a silent lease is '
+                                   'reclaimed.')
+work.add_argument('--heartbeat', default=wq.HEARTBEAT, type=int, metavar='')
+work.add_argument('--max-attempts', default=wq.MAX_ATTEMPTS, type=int,
+                  metavar='', help='Times a task is tried before it is '
+                                   'left failed.')
+
+sub.add_parser('status', help='Report progress of the job.')
+
+asm = sub.add_parser('assemble', help='Write finished chips to the rasters.')
+asm.add_argument('--lease-timeout', default=wq.LEASE_TIMEOUT, type=int,
+                 metavar='', help='Seconds before a silent lease is '
+                                  'reclaimed.')
+asm.add_argument('--heartbeat', default=wq.HEARTBEAT, type=int, metavar='')
+asm.add_argument('--max-attempts', default=wq.MAX_ATTEMPTS, type=int,
+                 metavar='', help='Times a task is tried before it is left '
+                                  'failed.')
+
+args = parser.parse_args()
+
+set_level(args.log_level)
+
+if args.command == 'publish':
+    wq.publish(args.work_dir, args.product, args.h, args.v, args.input,
+               args.output, args.algorithm,
+               query_dates=dates.query_dates(args.frequency, args.start_year,
+                                             args.end_year),
+               products=args.products.split(',') if args.products else None,
+               aoi=args.aoi, engine=args.engine)
+elif args.command == 'work':
+    wq.run_local(args.work_dir, args.proc, lease_timeout=args.lease_timeout,
+                 heartbeat=args.heartbeat, max_attempts=args.max_attempts)
+elif args.command == 'assemble':
+    wq.assemble(args.work_dir, lease_timeout=args.lease_timeout,
+                heartbeat=args.heartbeat, max_attempts=args.max_attempts)
+
+print(json.dumps(wq.status(args.work_dir)))
@@ -0,0 +1,565 @@
+"""
+Shared filesystem work queue
+
+Lets several machines work through the same tile job without a central
+service. A coordinator publishes tasks as files in a work directory on
+shared storage, workers claim a task by atomically creating its lease file,
+keep the lease fresh with a heartbeat while they work, and mark it done.
+Leases that stop being refreshed are reclaimed by other workers.
+
+work_dir/
+    job.json            product, tile, paths, dates, products and area of
+                        interest
+    tasks/<id>.json     one per chip or line band
+    leases/<id>         owner of the task, mtime is the heartbeat
+    done/<id>           finished
+    failed/<id>.json    attempt count and last error
+    results/<id>.npz    map values waiting to be assembled into rasters
+
+json_matlab tasks write their .mat files directly. change_maps and
+class_maps tasks save their chip values to results/, and assemble writes
+them to the GeoTIFFs from a single process once every task is done. A task
+that runs out of attempts stops the job from being assembled until it is
+retried.
+"""
+
+import os
+import json
+import time
+import errno
+import random
+import socket
+import threading
+import traceback
+import multiprocessing as mp
+from collections import OrderedDict
+
+import numpy as np
+
+from logger import log
+
+
+PRODUCTS = ('matlab', 'change', 'class')
+
+LEASE_TIMEOUT = 300
+HEARTBEAT = 30
+MAX_ATTEMPTS = 3
+
+ASSEMBLE_ID = '_assemble'
+
+
+def _dirs(work_dir):
+    return dict((d, os.path.join(work_dir, d))
+                for d in ('tasks', 'leases', 'done', 'failed', 'results'))
+
+
+def _write_json(path, data):
+    """
+    Write via a temporary file and rename so readers never see partial files
+    """
+    tmp = '{}.{}.{}.tmp'.format(path, socket.gethostname(), os.getpid())
+
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+
+    os.rename(tmp, path)
+
+
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def publish(work_dir, product, h, v, input_dir, output_dir, alg=None,
+            query_dates=None, products=None, aoi=None, engine='sweep'):
+    """
+    Create the job and its tasks
+
+    :param product: one of PRODUCTS
+    :param input_dir: JSON chips or json_matlab row files for change, JSON
+        chips for matlab, class pickles for class, None for matlab pulls
+        from the API
+    :param query_dates: ordinals to make the products for, the maps
+        module's QUERY_DATES if None
+    :param products: subset of the maps module's MAP_NAMES, all if None
+    :param aoi: bounding box, shapefile or WKT, see geo_utils.tile_aoi. A
+        shapefile must be reachable from every worker at the same path
+    :param engine: one of the maps module's ENGINES
+    :return: number of tasks published
+    """
+    if product not in PRODUCTS:
+        raise ValueError('Unknown product: {}'.format(product))
+
+    maps = _maps(product)
+    if maps is not None:
+        query_dates = list(query_dates or maps.QUERY_DATES)
+        products = list(maps.select_products(products))
+
+        if engine not in maps.ENGINES:
+            raise ValueError('Unknown engine: {}'.format(engine))
+
+    for d in list(_dirs(work_dir).values()) + [output_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    job = {'product': product, 'h': h, 'v': v,
+           'input_dir': input_dir, 'output_dir': output_dir,
+           'alg': alg, 'query_dates': query_dates, 'products': products,
+           'aoi': aoi, 'engine': engine, 'created': time.time()}
+
+    if product == 'matlab':
+        tasks = [{'line': line} for line in range(0, 5000, 100)]
+    else:
+        if product == 'change':
+            files = [f for f in os.listdir(input_dir) if maps.is_input(f)]
+        else:
+            files = os.listdir(input_dir)
+
+        files = maps.aoi_files([os.path.join(input_dir, f) for f in files],
+                               h, v, _job_aoi(job))
+        tasks = [{'file': f} for f in maps.order_files(files, h, v)]
+
+    _write_json(os.path.join(work_dir, 'job.json'), job)
+
+    tasks_dir = _dirs(work_dir)['tasks']
+    for idx, task in enumerate(tasks):
+        _write_json(os.path.join(tasks_dir, '{:06d}.json'.format(idx)), task)
+
+    log.info('Published {} {} tasks to {}'.format(len(tasks), product, work_dir))
+
+    return len(tasks)
+
+
+def _maps(product):
+    """
+    The module making a product's rasters, None for matlab
+    """
+    if product == 'change':
+        import change_maps
+        return change_maps
+    elif product == 'class':
+        import class_maps
+        return class_maps
+
+    return None
+
+
+def _job_aoi(job):
+    import geo_utils
+
+    return geo_utils.tile_aoi(job['h'], job['v'], job.get('aoi'))
+
+
+def owner_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def _create_exclusive(path, content):
+    """
+    Atomic create, False if the file already exists
+    """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+
+    return True
+
+
+def _lease_owner(lease):
+    try:
+        with open(lease, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _reclaim_stale(lease, timeout):
+    """
+    Remove a lease whose heartbeat has stopped, True if it was removed
+    """
+    try:
+        stat = os.stat(lease)
+    except OSError:
+        return True
+
+    if time.time() - stat.st_mtime < timeout:
+        return False
+
+    # Move it aside first so only one reclaimer wins
+    aside = '{}.stale.{}'.format(lease, owner_id())
+    try:
+        os.rename(lease, aside)
+    except OSError:
+        return False
+
+    if os.stat(aside).st_ino != stat.st_ino:
+        # Someone else reclaimed it in between, give theirs back
+        try:
+            os.link(aside, lease)
+        except OSError:
+            pass
+        os.remove(aside)
+        return False
+
+    log.info('Reclaimed stale lease {} from {}'.format(os.path.basename(lease),
+                                                       _lease_owner(aside)))
+    os.remove(aside)
+
+    return True
+
+
+def claim(work_dir, task_id, owner, timeout=LEASE_TIMEOUT):
+    """
+    Try to take the lease on a task
+
+    :return: lease path or None
+    """
+    dirs = _dirs(work_dir)
+    lease = os.path.join(dirs['leases'], task_id)
+
+    if not (_create_exclusive(lease, owner) or
+            (_reclaim_stale(lease, timeout) and
+             _create_exclusive(lease, owner))):
+        return None
+
+    # The previous owner may have finished and released it after we last
+    # looked at done/
+    if os.path.exists(os.path.join(dirs['done'], task_id)):
+        release(lease)
+        return None
+
+    return lease
+
+
+def release(lease):
+    try:
+        os.remove(lease)
+    except OSError:
+        pass
+
+
+class Heartbeat(object):
+    """
+    Keep a lease fresh on a background thread while a task runs
+    """
+    def __init__(self, lease, owner, interval=HEARTBEAT):
+        self.lease = lease
+        self.owner = owner
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if _lease_owner(self.lease) != self.owner:
+                log.warning('Lost lease {}'.format(self.lease))
+                self.lost = True
+                return
+
+            os.utime(self.lease, None)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def _attempts(work_dir, task_id):
+    failed = os.path.join(_dirs(work_dir)['failed'], task_id + '.json')
+
+    if os.path.exists(failed):
+        return _read_json(failed)['attempts']
+
+    return 0
+
+
+def pending(work_dir, max_attempts=MAX_ATTEMPTS):
+    """
+    Task ids that are neither done nor out of attempts
+    """
+    dirs = _dirs(work_dir)
+    done = set(os.listdir(dirs['done']))
+
+    return [f[:-5] for f in sorted(os.listdir(dirs['tasks']))
+            if f.endswith('.json') and f[:-5] not in done
+            and _attempts(work_dir, f[:-5]) < max_attempts]
+
+
+def exhausted(work_dir, max_attempts=MAX_ATTEMPTS):
+    """
+    Task ids that are not done and out of attempts
+    """
+    dirs = _dirs(work_dir)
+    done = set(os.listdir(dirs['done']))
+
+    return [f[:-5] for f in sorted(os.listdir(dirs['failed']))
+            if f.endswith('.json') and f[:-5] not in done
+            and _attempts(work_dir, f[:-5]) >= max_attempts]
+
+
+def status(work_dir):
+    dirs = _dirs(work_dir)
+
+    tasks = [f for f in os.listdir(dirs['tasks']) if f.endswith('.json')]
+    leases = [f for f in os.listdir(dirs['leases']) if '.' not in f]
+
+    return {'tasks': len(tasks),
+            'done': len([f for f in os.listdir(dirs['done']) if f != ASSEMBLE_ID]),
+            'leased': len([f for f in leases if f != ASSEMBLE_ID]),
+            'failed': len(os.listdir(dirs['failed'])),
+            'assembled': os.path.exists(os.path.join(dirs['done'], ASSEMBLE_ID))}
+
+
+def save_chip(path, data, coverage=None):
+    """
+    Flatten a map dictionary, as made by changemap_vals or classmap_vals,
+    into an npz
+    """
+    arrays = {'chip_x': data['chip_x'], 'chip_y': data['chip_y']}
+
+    for prod in data:
+        if prod in ('chip_x', 'chip_y'):
+            continue
+        for year in data[prod]:
+            arrays['{}|{}'.format(prod, year)] = data[prod][year]
+
+    if coverage is not None:
+        arrays['coverage'] = coverage
+
+    tmp = path + '.{}.tmp.npz'.format(owner_id())
+    np.savez_compressed(tmp, **arrays)
+    os.rename(tmp, path)
+
+
+def load_chip(path):
+    """
+    Inverse of save_chip
+
+    :return: map dictionary, coverage or None
+    """
+    npz = np.load(path)
+
+    data = {'chip_x': int(npz['chip_x']), 'chip_y': int(npz['chip_y'])}
+    coverage = npz['coverage'] if 'coverage' in npz.files else None
+
+    for key in npz.files:
+        if '|' not in key:
+            continue
+
+        # Years are ints, monthly and daily labels stay strings, see
+        # dates.date_labels
+        prod, label = key.split('|')
+        label = int(label) if label.isdigit() else label
+        data.setdefault(prod, {})[label] = npz[key]
+
+    return data, coverage
+
+
+def execute(work_dir, job, task_id, task, aoi=None):
+    """
+    :param aoi: geo_utils.AOI of the job, see _job_aoi
+    """
+    if job['product'] == 'matlab':
+        import json_matlab
+        json_matlab.worker(job['output_dir'], job['input_dir'], job['h'],
+                           job['v'], job['alg'], task['line'])
+        return
+
+    maps = _maps(job['product'])
+    result = os.path.join(_dirs(work_dir)['results'], task_id + '.npz')
+    query_dates = job.get('query_dates') or maps.QUERY_DATES
+    engine = job.get('engine', 'sweep')
+    products = job.get('products')
+
+    if job['product'] == 'change':
+        data, coverage = maps.product_vals(task['file'], job['h'], job['v'],
+                                           query_dates, engine, aoi, products)
+        save_chip(result, data, coverage)
+    else:
+        save_chip(result, maps.chip_vals(task['file'], job['h'], job['v'],
+                                         query_dates, engine, aoi, products))
+
+
+def _record_failure(work_dir, task_id, owner, error):
+    failed = os.path.join(_dirs(work_dir)['failed'], task_id + '.json')
+
+    _write_json(failed, {'attempts': _attempts(work_dir, task_id) + 1,
+                         'owner': owner,
+                         'error': error})
+
+
+def run_worker(work_dir, owner=None, lease_timeout=LEASE_TIMEOUT,
+               heartbeat=HEARTBEAT, max_attempts=MAX_ATTEMPTS, assemble_when_done=True):
+    """
+    Claim and execute tasks until none are left
+
+    :return: number of tasks this worker completed
+    """
+    owner = owner or owner_id()
+    job = _read_json(os.path.join(work_dir, 'job.json'))
+    aoi = _job_aoi(job)
+    dirs = _dirs(work_dir)
+    completed = 0
+
+    while True:
+        task_ids = pending(work_dir, max_attempts)
+
+        if not task_ids:
+            break
+
+        # Spread workers out over the task list to limit lease contention
+        random.shuffle(task_ids)
+
+        claimed = False
+        for task_id in task_ids:
+            if os.path.exists(os.path.join(dirs['done'], task_id)):
+                continue
+
+            lease = claim(work_dir, task_id, owner, lease_timeout)
+            if lease is None:
+                continue
+
+            claimed = True
+            task = _read_json(os.path.join(dirs['tasks'], task_id + '.json'))
+
+            try:
+                with Heartbeat(lease, owner, heartbeat) as beat:
+                    execute(work_dir, job, task_id, task, aoi)
+
+                if not beat.lost:
+                    _create_exclusive(os.path.join(dirs['done'], task_id), owner)
+                    completed += 1
+            except Exception:
+                log.exception('Task failed: {}'.format(task_id))
+                _record_failure(work_dir, task_id, owner, traceback.format_exc())
+            finally:
+                if _lease_owner(lease) == owner:
+                    release(lease)
+
+        if not claimed:
+            # Everything left is leased by someone else, wait for them to
+            # finish or for their lease to go stale
+            time.sleep(min(heartbeat, lease_timeout / 4.0))
+
+    log.info('{} completed {} tasks'.format(owner, completed))
+
+    if assemble_when_done:
+        assemble(work_dir, owner, lease_timeout, heartbeat, max_attempts)
+
+    return completed
+
+
+def assemble(work_dir, owner=None, lease_timeout=LEASE_TIMEOUT,
+             heartbeat=HEARTBEAT, max_attempts=MAX_ATTEMPTS):
+    """
+    Write the saved chip results into the product rasters, only one process
+    does this, and only after every task is done. Tasks out of attempts
+    leave the job unassembled, so it can be once they are retried.
+
+    :return: True if the rasters were written by this call
+    """
+    import geo_utils
+    import tile_stats
+
+    owner = owner or owner_id()
+    job = _read_json(os.path.join(work_dir, 'job.json'))
+    dirs = _dirs(work_dir)
+    marker = os.path.join(dirs['done'], ASSEMBLE_ID)
+
+    if job['product'] == 'matlab' or os.path.exists(marker):
+        return False
+
+    if pending(work_dir, max_attempts):
+        log.info('Tasks still pending, not assembling')
+        return False
+
+    failed = exhausted(work_dir, max_attempts)
+    if failed:
+        log.error('Not assembling, {} tasks are out of attempts: {}'
+                  .format(len(failed), ', '.join(failed)))
+        return False
+
+    lease = claim(work_dir, ASSEMBLE_ID, owner, lease_timeout)
+    if lease is None:
+        return False
+
+    maps = _maps(job['product'])
+    h, v = job['h'], job['v']
+    output_dir = job['output_dir']
+    query_dates = job.get('query_dates') or maps.QUERY_DATES
+    aoi = _job_aoi(job)
+    window = aoi.window if aoi is not None else None
+
+    try:
+        with Heartbeat(lease, owner, heartbeat):
+            maps.check_outputs(output_dir, h, v, job.get('aoi'), query_dates,
+                               job.get('products'))
+
+            # Results in the order the single node writer takes the chips
+            results = {}
+            for f in os.listdir(dirs['results']):
+                if f.endswith('.npz') and '.tmp' not in f:
+                    task = _read_json(os.path.join(dirs['tasks'], f[:-4] + '.json'))
+                    results[task['file']] = os.path.join(dirs['results'], f)
+
+            geo_utils.set_cache_max(maps.GDAL_CACHE_MAX)
+            datasets = OrderedDict()
+            chip_stats = {}
+
+            try:
+                for f in maps.order_files(results, h, v):
+                    data, coverage = load_chip(results[f])
+                    key = tile_stats.chip_key(data)
+
+                    if job['product'] == 'change':
+                        chip_stats[key] = tile_stats.change_chip(data, coverage)
+                        maps.output_chip(data, coverage, output_dir, h, v,
+                                         datasets, window)
+                    else:
+                        chip_stats[key] = tile_stats.class_chip(data)
+                        maps.output_chip(data, output_dir, h, v, datasets,
+                                         window)
+            finally:
+                maps.close_datasets(datasets)
+
+            if job['product'] == 'change':
+                tile_stats.write_change_chips(output_dir, h, v, chip_stats)
+            else:
+                tile_stats.write_class_chips(output_dir, h, v, chip_stats)
+
+        _create_exclusive(marker, owner)
+    finally:
+        release(lease)
+
+    log.info('Assembled {} rasters in {}'.format(job['product'], output_dir))
+
+    return True
+
+
+def run_local(work_dir, workers, **kwargs):
+    """
+    Start several worker processes on this machine, for testing or for
+    single node runs
+    """
+    procs = [mp.Process(target=run_worker, args=(work_dir,), kwargs=kwargs,
+                        name='QueueWorker-{}'.format(i))
+             for i in range(workers)]
+
+    for p in procs:
+        p.start()
+
+    for p in procs:
+        p.join()
+
+    return status(work_dir)